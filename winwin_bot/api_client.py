@@ -1,77 +1,155 @@
-import hashlib
-import requests
+import asyncio
 import logging
+import time
 from datetime import datetime, timezone
+
+import httpx
+
+from cache import TTLCache
+from circuit_breaker import CircuitBreaker, CircuitOpenError
 from config import Config
+from metrics import API_SECONDS
+from signing import SofiaCashSigner
 
 logger = logging.getLogger(__name__)
 
+_CACHE_MISS = object()
+
 class SofiaCashAPI:
     def __init__(self):
         self.config = Config
         self.base_url = self.config.API_BASE_URL
+        self.signer = SofiaCashSigner.from_config(self.config)
+        self._client = None
+        self._transport = None
+        # Ограничение одновременных запросов к кассе
+        self._semaphore = asyncio.Semaphore(self.config.API_MAX_CONCURRENCY)
+        self._in_flight = 0
+        self._waiters = 0
+        # Счетчики по событиям trace: во сколько запросов обошлось каждое соединение
+        self._requests = 0
+        self._connections_opened = 0
+        # Автомат и адаптивный таймаут на каждый метод; у операций со счетом
+        # нижняя граница таймаута выше: обрыв по таймауту делает их исход неясным
+        self.breakers = {
+            'balance': CircuitBreaker('balance', self.config, self.config.API_TIMEOUT_MIN),
+            'find_user': CircuitBreaker('find_user', self.config, self.config.API_TIMEOUT_MIN),
+            'deposit': CircuitBreaker('deposit', self.config, self.config.API_WRITE_TIMEOUT_MIN),
+            'payout': CircuitBreaker('payout', self.config, self.config.API_WRITE_TIMEOUT_MIN)
+        }
+        # Кеш результатов find_user (None - игрок не найден)
+        self.user_cache = TTLCache(
+            max_size=self.config.FIND_USER_CACHE_SIZE,
+            ttl=self.config.FIND_USER_CACHE_TTL
+        )
+    
+    async def start(self):
+        """Открытие общей keep-alive сессии на время жизни приложения"""
+        if self._client is None:
+            limits = httpx.Limits(
+                max_connections=self.config.API_MAX_CONNECTIONS,
+                max_keepalive_connections=self.config.API_MAX_KEEPALIVE,
+                keepalive_expiry=self.config.API_KEEPALIVE_EXPIRY
+            )
+            self._transport = httpx.AsyncHTTPTransport(limits=limits)
+            self._client = httpx.AsyncClient(
+                transport=self._transport,
+                timeout=self.config.API_TIMEOUT
+            )
+    
+    async def close(self):
+        """Закрытие HTTP-сессии при остановке приложения"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._transport = None
+    
+    async def _request(self, api_method, method, url, **kwargs):
+        """Выполнение запроса через общую сессию (api_method - имя для метрик и автомата).
+        
+        При разомкнутом автомате метода сразу выбрасывает CircuitOpenError.
+        """
+        if self._client is None:
+            await self.start()
+        
+        breaker = self.breakers[api_method]
+        probe = breaker.before_request()
+        
+        self._waiters += 1
+        try:
+            await self._semaphore.acquire()
+        except BaseException:
+            breaker.cancel(probe)
+            raise
+        finally:
+            self._waiters -= 1
+        
+        self._in_flight += 1
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await self._client.request(
+                method, url, timeout=breaker.timeout(), extensions={'trace': self._trace}, **kwargs
+            )
+            outcome = str(response.status_code)
+            return response
+        except httpx.TimeoutException:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            API_SECONDS.observe(duration, api_method, outcome)
+            if outcome == 'cancelled':
+                breaker.cancel(probe)
+            else:
+                breaker.record(duration, outcome.isdigit() and int(outcome) < 500, probe)
+            self._in_flight -= 1
+            self._semaphore.release()
+    
+    def retry_after(self, api_method):
+        """Секунд до повтора, если автомат метода разомкнут (иначе None)"""
+        return self.breakers[api_method].retry_after()
+    
+    def get_breaker_stats(self):
+        """Состояние автоматов и таймауты по методам"""
+        return {name: breaker.get_stats() for name, breaker in self.breakers.items()}
+    
+    async def _trace(self, event, info):
+        """Обработчик расширения trace httpx: учет новых TCP-соединений"""
+        if event in ('http11.send_request_headers.started', 'http2.send_request_headers.started'):
+            self._requests += 1
+        elif event == 'connection.connect_tcp.complete':
+            self._connections_opened += 1
+    
+    def get_pool_stats(self):
+        """Статистика пула соединений для мониторинга.
+        
+        Соединения считаются по публичному расширению trace: чем больше
+        запросов на одно открытое соединение, тем лучше работает keep-alive.
+        """
+        return {
+            'requests': self._requests,
+            'connections_opened': self._connections_opened,
+            'in_flight': self._in_flight,
+            'waiters': self._waiters,
+            'max_concurrency': self.config.API_MAX_CONCURRENCY
+        }
     
     def _calculate_confirm(self, param_value):
         """Расчет confirm строки"""
-        data = f"{param_value}:{self.config.API_HASH}"
-        return hashlib.md5(data.encode()).hexdigest()
+        return self.signer.confirm(param_value)
     
     def _generate_signature(self, method, **params):
         """Генерация подписи в зависимости от метода"""
-        if method == "balance":
-            dt = params.get('dt')
-            str_a = f"hash={self.config.API_HASH}&cashierpass={self.config.API_CASHIERPASS}&dt={dt}"
-            hash_a = hashlib.sha256(str_a.encode()).hexdigest()
-            
-            str_b = f"dt={dt}&cashierpass={self.config.API_CASHIERPASS}&cashdeskid={self.config.API_CASHDESKID}"
-            hash_b = hashlib.md5(str_b.encode()).hexdigest()
-            
-            combined = hash_a + hash_b
-            return hashlib.sha256(combined.encode()).hexdigest()
-        
-        elif method == "find_user":
-            user_id = params.get('user_id')
-            str_a = f"hash={self.config.API_HASH}&userid={user_id}&cashdeskid={self.config.API_CASHDESKID}"
-            hash_a = hashlib.sha256(str_a.encode()).hexdigest()
-            
-            str_b = f"userid={user_id}&cashierpass={self.config.API_CASHIERPASS}&hash={self.config.API_HASH}"
-            hash_b = hashlib.md5(str_b.encode()).hexdigest()
-            
-            combined = hash_a + hash_b
-            return hashlib.sha256(combined.encode()).hexdigest()
-        
-        elif method == "deposit":
-            user_id = params.get('user_id')
-            amount = params.get('amount')
-            lng = params.get('lng', 'ru')
-            
-            str_a = f"hash={self.config.API_HASH}&lng={lng}&UserId={user_id}"
-            hash_a = hashlib.sha256(str_a.encode()).hexdigest()
-            
-            str_b = f"summa={amount}&cashierpass={self.config.API_CASHIERPASS}&cashdeskid={self.config.API_CASHDESKID}"
-            hash_b = hashlib.md5(str_b.encode()).hexdigest()
-            
-            combined = hash_a + hash_b
-            return hashlib.sha256(combined.encode()).hexdigest()
-        
-        elif method == "payout":
-            user_id = params.get('user_id')
-            code = params.get('code')
-            lng = params.get('lng', 'ru')
-            
-            str_a = f"hash={self.config.API_HASH}&lng={lng}&UserId={user_id}"
-            hash_a = hashlib.sha256(str_a.encode()).hexdigest()
-            
-            str_b = f"code={code}&cashierpass={self.config.API_CASHIERPASS}&cashdeskid={self.config.API_CASHDESKID}"
-            hash_b = hashlib.md5(str_b.encode()).hexdigest()
-            
-            combined = hash_a + hash_b
-            return hashlib.sha256(combined.encode()).hexdigest()
+        return self.signer.sign(method, **params)
     
-    def get_balance(self):
+    async def get_balance(self):
         """Получение баланса кассы"""
         dt = datetime.now(timezone.utc).strftime("%Y.%m.%d %H:%M:%S")
-        confirm = self._calculate_confirm(self.config.API_CASHDESKID)
+        confirm = self.signer.cashdesk_confirm
         signature = self._generate_signature("balance", dt=dt)
         
         url = f"{self.base_url}Cashdesk/{self.config.API_CASHDESKID}/Balance"
@@ -82,7 +160,7 @@ class SofiaCashAPI:
         headers = {"sign": signature}
         
         try:
-            response = requests.get(url, params=params, headers=headers, timeout=10)
+            response = await self._request("balance", "GET", url, params=params, headers=headers)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -92,8 +170,13 @@ class SofiaCashAPI:
             logger.error(f"Ошибка запроса баланса: {e}")
             return None
     
-    def find_user(self, user_id):
+    async def find_user(self, user_id):
         """Поиск игрока в системе Winwin"""
+        cache_key = str(user_id)
+        cached = self.user_cache.get(cache_key, _CACHE_MISS)
+        if cached is not _CACHE_MISS:
+            return cached
+        
         confirm = self._calculate_confirm(user_id)
         signature = self._generate_signature("find_user", user_id=user_id)
         
@@ -105,9 +188,14 @@ class SofiaCashAPI:
         headers = {"sign": signature}
         
         try:
-            response = requests.get(url, params=params, headers=headers, timeout=10)
+            response = await self._request("find_user", "GET", url, params=params, headers=headers)
             if response.status_code == 200:
-                return response.json()
+                user = response.json()
+                self.user_cache.set(cache_key, user)
+                return user
+            elif response.status_code == 404:
+                self.user_cache.set(cache_key, None, ttl=self.config.FIND_USER_NEGATIVE_TTL)
+                return None
             else:
                 logger.error(f"Ошибка поиска пользователя: {response.status_code}")
                 return None
@@ -115,8 +203,15 @@ class SofiaCashAPI:
             logger.error(f"Ошибка запроса пользователя: {e}")
             return None
     
-    def deposit_to_user(self, user_id, amount):
-        """Пополнение счета игрока через SofiaCash"""
+    async def deposit_to_user(self, user_id, amount):
+        """Пополнение счета игрока через SofiaCash.
+        
+        При ошибке в результате есть флаги: ambiguous - запрос мог дойти
+        до кассы (таймаут, 5xx, непонятный ответ), и повторять его можно
+        только после сверки; retryable - запрос точно не выполнен
+        (не удалось соединиться), его можно повторить. Если запрос не
+        отправлялся из-за разомкнутого автомата, есть еще retry_after.
+        """
         confirm = self._calculate_confirm(user_id)
         signature = self._generate_signature("deposit", user_id=user_id, amount=amount)
         
@@ -133,10 +228,11 @@ class SofiaCashAPI:
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = await self._request("deposit", "POST", url, json=payload, headers=headers)
             if response.status_code == 200:
                 result = response.json()
                 if result.get('success'):
+                    self.user_cache.invalidate(str(user_id))
                     return {
                         'success': True,
                         'amount': result.get('summa'),
@@ -151,16 +247,29 @@ class SofiaCashAPI:
             else:
                 return {
                     'success': False,
-                    'error': f"HTTP ошибка: {response.status_code}"
+                    'error': f"HTTP ошибка: {response.status_code}",
+                    'ambiguous': response.status_code >= 500
                 }
+        except CircuitOpenError as e:
+            return {'success': False, 'error': str(e), 'retryable': True, 'retry_after': e.retry_after}
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            return {
+                'success': False,
+                'error': str(e) or type(e).__name__,
+                'retryable': True
+            }
         except Exception as e:
             return {
                 'success': False,
-                'error': str(e)
+                'error': str(e) or type(e).__name__,
+                'ambiguous': True
             }
     
-    def payout_from_user(self, user_id, code):
-        """Выплата со счета игрока"""
+    async def payout_from_user(self, user_id, code):
+        """Выплата со счета игрока по одноразовому коду.
+        
+        Флаги ambiguous и retryable при ошибке - как у deposit_to_user.
+        """
         confirm = self._calculate_confirm(user_id)
         signature = self._generate_signature("payout", user_id=user_id, code=code)
         
@@ -177,11 +286,21 @@ class SofiaCashAPI:
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = await self._request("payout", "POST", url, json=payload, headers=headers)
             if response.status_code == 200:
                 result = response.json()
+                if result.get('success'):
+                    self.user_cache.invalidate(str(user_id))
                 return result
             else:
-                return {'success': False, 'error': f"HTTP ошибка: {response.status_code}"}
+                return {
+                    'success': False,
+                    'error': f"HTTP ошибка: {response.status_code}",
+                    'ambiguous': response.status_code >= 500
+                }
+        except CircuitOpenError as e:
+            return {'success': False, 'error': str(e), 'retryable': True, 'retry_after': e.retry_after}
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            return {'success': False, 'error': str(e) or type(e).__name__, 'retryable': True}
         except Exception as e:
-            return {'success': False, 'error': str(e)}
+            return {'success': False, 'error': str(e) or type(e).__name__, 'ambiguous': True}
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CashdeskBalance:
+    """Кешированный баланс кассы с объединением одновременных запросов"""
+
+    def __init__(self, api, refresh_interval, max_age):
+        self.api = api
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self._data = None
+        self._fetched_at = None  # time.monotonic() последнего успешного запроса
+        self._stale = False  # значение устарело после операции с кассой
+        self._inflight = None
+
+    @property
+    def data(self):
+        """Последний полученный ответ Balance (или None)"""
+        return self._data
+
+    def age(self):
+        """Возраст кешированного значения в секундах"""
+        if self._fetched_at is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def is_fresh(self, max_age=None):
+        age = self.age()
+        return not self._stale and age is not None and age <= (self.max_age if max_age is None else max_age)
+
+    async def refresh(self):
+        """Запрос баланса в API; параллельные вызовы ждут один запрос"""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._fetch())
+        # shield: отмена одного ожидающего не прерывает общий запрос
+        return await asyncio.shield(self._inflight)
+
+    async def _fetch(self):
+        try:
+            data = await self.api.get_balance()
+            if data and 'Balance' in data:
+                self._data = data
+                self._fetched_at = time.monotonic()
+                self._stale = False
+            return self._data
+        finally:
+            self._inflight = None
+
+    async def get(self, max_age=None):
+        """Баланс из кеша, если он не старше max_age, иначе свежий запрос"""
+        if self.is_fresh(max_age):
+            return self._data
+        return await self.refresh()
+
+    def invalidate(self):
+        """Пометить значение устаревшим (после операций с кассой).
+
+        Время получения сохраняется: если следующий запрос не удастся,
+        останется прежнее значение с его настоящим возрастом.
+        """
+        self._stale = True
+
+    async def run(self):
+        """Фоновое обновление баланса с заданным интервалом"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления баланса кассы: {e}")
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,242 @@
+"""Стресс-тест захвата депозитов несколькими администраторами.
+
+Скрипт создает WinWinBot на временной базе с заглушками Telegram и
+SofiaCash и для каждого депозита одновременно нажимает кнопки
+"Принять"/"Отклонить" от имени многих администраторов:
+- новый депозит - должен достаться ровно одному (ASSIGNED) или быть
+  отклонен (CANCELLED);
+- депозит с чеком - зачисление проходит через очередь credit_outbox,
+  заглушка кассы отвечает таймаутом на долю запросов (--ambiguous-share),
+  причем часть таких зачислений на самом деле проходит. Игрок должен
+  получить деньги не больше одного раза, итоговый статус - COMPLETED,
+  CANCELLED или CREDITING с пометкой "ручная проверка".
+Нарушения печатаются, код выхода 1.
+
+Запуск: python bench_claims.py [--deposits 200] [--admins 10] [--reject-share 0.02] [--ambiguous-share 0.1]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from metrics import percentile
+
+ADMIN_ID_BASE = 1000
+USER_ID_BASE = 10_000_000
+
+
+class FakeBot:
+    """Заглушка методов Bot API, которые вызывает бот"""
+
+    def __init__(self):
+        self.message_id = 0
+
+    async def _reply(self, **kwargs):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        self.message_id += 1
+        return SimpleNamespace(message_id=self.message_id)
+
+    send_message = send_document = send_photo = _reply
+    edit_message_text = edit_message_caption = _reply
+
+
+class FakeCashdesk:
+    """Заглушка кассы: баланс уменьшается на сумму каждого прошедшего зачисления"""
+
+    def __init__(self, ambiguous_share):
+        self.balance = 1_000_000_000.0
+        self.ambiguous_share = ambiguous_share
+        self.credited = Counter()  # user_id -> прошедших зачислений
+        self.requests = 0
+        self.ambiguous = 0
+
+    async def get_balance(self):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        return {'Balance': self.balance, 'Limit': 0}
+
+    async def find_user(self, user_id):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        return {'UserId': user_id}
+
+    async def deposit_to_user(self, user_id, amount):
+        self.requests += 1
+        await asyncio.sleep(random.uniform(0.001, 0.01))
+        ambiguous = random.random() < self.ambiguous_share
+        # При таймауте касса выполнила зачисление или нет - поровну
+        if not ambiguous or random.random() < 0.5:
+            self.balance -= amount
+            self.credited[user_id] += 1
+        await asyncio.sleep(random.uniform(0, 0.005))
+        if ambiguous:
+            self.ambiguous += 1
+            return {'success': False, 'error': 'ReadTimeout', 'ambiguous': True}
+        return {'success': True}
+
+
+def make_query(data, admin_id):
+    async def noop(*args, **kwargs):
+        await asyncio.sleep(random.uniform(0, 0.002))
+
+    return SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=admin_id, full_name=f"Admin {admin_id}"),
+        message=SimpleNamespace(text="deposit"),
+        answer=noop,
+        edit_message_text=noop,
+        edit_message_caption=noop
+    )
+
+
+async def press_all(bot, context_bot, deposit_id, admins, reject_share, latencies):
+    """Все администраторы одновременно нажимают кнопку депозита"""
+    async def press(admin_id):
+        action = 'reject' if random.random() < reject_share else 'accept'
+        context = SimpleNamespace(bot=context_bot, user_data={})
+        update = SimpleNamespace(callback_query=make_query(f"{action}_{deposit_id}", admin_id))
+        started = time.perf_counter()
+        await bot.handle_deposit_callback(update, context)
+        latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(press(ADMIN_ID_BASE + i) for i in range(admins)))
+
+
+async def run(args):
+    from bot import WinWinBot
+
+    bot = WinWinBot()
+    context_bot = FakeBot()
+
+    cashdesk = FakeCashdesk(args.ambiguous_share)
+    bot.api.get_balance = cashdesk.get_balance
+    bot.api.find_user = cashdesk.find_user
+    bot.api.deposit_to_user = cashdesk.deposit_to_user
+    credits = cashdesk.credited
+
+    # Выигранные переходы по (депозит, событие)
+    wins = Counter()
+    fire = bot.deposits.fire
+
+    async def counting_fire(deposit_id, event, *fire_args, **kwargs):
+        previous = await fire(deposit_id, event, *fire_args, **kwargs)
+        if previous is not None:
+            wins[deposit_id, event] += 1
+        return previous
+
+    bot.deposits.fire = counting_fire
+
+    deposit_ids = [
+        await bot.db.add_deposit(USER_ID_BASE + i, f"player{i}", 100.0 + i)
+        for i in range(args.deposits)
+    ]
+    violations = []
+
+    # Этап 1: новые депозиты
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        press_all(bot, context_bot, deposit_id, args.admins, args.reject_share, latencies)
+        for deposit_id in deposit_ids
+    ))
+    take_elapsed = time.perf_counter() - started
+    take_latencies = latencies
+
+    assigned = []
+    for deposit_id in deposit_ids:
+        deposit = await bot.db.get_deposit(deposit_id)
+        taken = wins[deposit_id, 'take'] + wins[deposit_id, 'reject']
+        if taken != 1:
+            violations.append(f"#{deposit_id}: выиграно переходов {taken}, ожидался 1")
+        if deposit[4] == 'ASSIGNED':
+            assigned.append((deposit_id, deposit[11]))
+        elif deposit[4] != 'CANCELLED':
+            violations.append(f"#{deposit_id}: статус {deposit[4]} после захвата")
+
+    # Реквизиты и чек - депозиты переходят в PROCESSING
+    for deposit_id, admin_id in assigned:
+        await bot.deposits.fire(deposit_id, 'send_details', owner_id=admin_id, payment_details='card')
+        await bot.deposits.fire(deposit_id, 'upload_receipt', receipt_file_id='file')
+
+    # Этап 2: подтверждение оплаты и зачисление через очередь
+    bot.credits.start(context_bot)
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        press_all(bot, context_bot, deposit_id, args.admins, args.reject_share, latencies)
+        for deposit_id, _ in assigned
+    ))
+    credit_elapsed = time.perf_counter() - started
+
+    while True:
+        queue = await bot.db.get_credit_stats()
+        if not any(queue.get(status) for status in ('pending', 'unknown', 'in_flight')):
+            break
+        await asyncio.sleep(0.05)
+    drain_elapsed = time.perf_counter() - started
+    await bot.credits.stop()
+
+    for deposit_id, _ in assigned:
+        deposit = await bot.db.get_deposit(deposit_id)
+        credited = credits[deposit[1]]
+        if credited > 1:
+            violations.append(f"#{deposit_id}: игрок получил зачисление {credited} раз")
+        if deposit[4] == 'CREDITING':
+            continue  # исход не определен, ручная проверка
+        expected = 'COMPLETED' if credited else 'CANCELLED'
+        if deposit[4] != expected:
+            violations.append(f"#{deposit_id}: статус {deposit[4]}, ожидался {expected} (зачислений {credited})")
+
+    statuses = Counter()
+    for deposit_id in deposit_ids:
+        statuses[(await bot.db.get_deposit(deposit_id))[4]] += 1
+
+    await bot.db.flush()
+    bot.db.close()
+
+    presses = args.admins * (len(deposit_ids) + len(assigned))
+    print(f"Депозитов: {len(deposit_ids)}, администраторов: {args.admins}, нажатий: {presses}")
+    print(f"Захват:        {take_elapsed:.2f} с, p50/p95 "
+          f"{percentile(take_latencies, 0.5) * 1000:.1f}/{percentile(take_latencies, 0.95) * 1000:.1f} мс")
+    if latencies:
+        print(f"Подтверждение: {credit_elapsed:.2f} с, p50/p95 "
+              f"{percentile(latencies, 0.5) * 1000:.1f}/{percentile(latencies, 0.95) * 1000:.1f} мс")
+    print(f"Очередь зачислений разобрана за {drain_elapsed:.2f} с: {dict(queue)}")
+    print(f"Запросов в кассу: {cashdesk.requests}, с неясным исходом: {cashdesk.ambiguous}, "
+          f"прошло зачислений: {sum(credits.values())}")
+    print(f"Статусы депозитов: {dict(statuses)}")
+
+    if violations:
+        print(f"\nНарушений: {len(violations)}")
+        for line in violations[:20]:
+            print(f"  {line}")
+        return 1
+    print("Нарушений нет")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deposits', type=int, default=200)
+    parser.add_argument('--admins', type=int, default=10)
+    parser.add_argument('--reject-share', type=float, default=0.02, help="доля нажатий 'Отклонить'")
+    parser.add_argument('--ambiguous-share', type=float, default=0.1, help="доля зачислений с таймаутом")
+    args = parser.parse_args()
+
+    os.environ['ADMINS'] = ','.join(str(ADMIN_ID_BASE + i) for i in range(args.admins))
+    os.environ.setdefault('METRICS_PORT', '0')
+    os.environ.setdefault('PERSISTENCE_BACKEND', 'memory')
+    os.environ.setdefault('CREDIT_BACKOFF_BASE', '0.05')
+    os.environ.setdefault('CREDIT_BACKOFF_MAX', '0.5')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
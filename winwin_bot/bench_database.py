@@ -0,0 +1,51 @@
+"""Бенчмарк SQLite-хранилища по профилям из STORAGE_PROFILES.
+
+Для каждого профиля создается временная база и измеряется скорость
+вставок и выборок по таблицам deposits и users через методы Database.
+
+Запуск: python bench_database.py [количество операций] [профиль ...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import Database, STORAGE_PROFILES
+
+
+def measure(label, count, func):
+    started = time.perf_counter()
+    for i in range(count):
+        func(i)
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<28} {count / elapsed:>12,.0f} оп/с")
+
+
+def bench_profile(profile, count):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), profile=profile)
+        print(f"[{profile}]")
+
+        measure("deposits: add_deposit", count,
+                lambda i: db.add_deposit(i % 5000, f"user{i}", 100.0 + i))
+        measure("users: add_or_update_user", count,
+                lambda i: db.add_or_update_user(i % 5000, f"user{i}", f"User {i}"))
+
+        deposit_ids = [random.randint(1, count) for _ in range(count)]
+        user_ids = [random.randint(0, 4999) for _ in range(count)]
+        measure("deposits: get_deposit", count, lambda i: db.get_deposit(deposit_ids[i]))
+        measure("users: get_user", count, lambda i: db.get_user(user_ids[i]))
+
+        db.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    profiles = sys.argv[2:] or list(STORAGE_PROFILES)
+    for profile in profiles:
+        bench_profile(profile, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Микро-бенчмарк подписи запросов SofiaCash: sign по одному против sign_many.
+
+Запуск: python bench_signing.py [количество подписей]
+"""
+import sys
+import timeit
+
+from signing import SofiaCashSigner
+
+
+def build_requests(count):
+    """Смешанная нагрузка: поиск игроков, депозиты, выплаты, баланс"""
+    requests = []
+    for i in range(count):
+        user_id = 10_000_000 + i
+        kind = i % 4
+        if kind == 0:
+            requests.append(("find_user", {"user_id": user_id}))
+        elif kind == 1:
+            requests.append(("deposit", {"user_id": user_id, "amount": 100.0 + i}))
+        elif kind == 2:
+            requests.append(("payout", {"user_id": user_id, "code": f"C{i:08d}"}))
+        else:
+            requests.append(("balance", {"dt": f"2024.01.01 12:{i % 60:02d}:{i % 60:02d}"}))
+    return requests
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    signer = SofiaCashSigner("a" * 64, "cashier-pass", "1234567")
+    requests = build_requests(count)
+
+    # Пакетная подпись должна совпадать с подписью по одному
+    sample = requests[:1000]
+    assert signer.sign_many(sample) == [signer.sign(method, **params) for method, params in sample]
+
+    def run_signer():
+        for method, params in requests:
+            signer.sign(method, **params)
+
+    def run_batch():
+        signer.sign_many(requests)
+
+    print(f"Подписей за прогон: {count}")
+    for name, func in (("sign", run_signer), ("sign_many", run_batch)):
+        best = min(timeit.repeat(func, number=1, repeat=15))
+        print(f"{name:>10}: {best / count * 1e6:7.2f} мкс/подпись  ({count / best:,.0f} подписей/с)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Нагрузочный тест получения обновлений: polling против webhook.
+
+Скрипт поднимает локальную заглушку Bot API, запускает bot.py с
+TELEGRAM_API_URL, указывающим на нее, и подает синтетические /start
+от разных пользователей с заданной частотой:
+- polling - обновления отдаются боту через getUpdates заглушки;
+- webhook - обновления отправляются POST-запросом на локальный
+  webhook бота с секретным токеном.
+Задержка обновления - время от подачи до ответа бота (sendMessage,
+пришедший в заглушку).
+
+Запуск: python bench_webhook.py [--count 500] [--rate 100] [--mode polling webhook]
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+from metrics import percentile
+
+BOT_TOKEN = "123456:BENCH"
+SECRET_TOKEN = "bench-secret"
+USER_ID_BASE = 10_000_000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI:
+    """Минимальная заглушка Bot API: getMe, getUpdates, setWebhook, sendMessage"""
+
+    def __init__(self):
+        self.updates = []
+        self.has_updates = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.replies = {}  # chat_id -> время получения sendMessage
+        self.all_replied = asyncio.Event()
+        self.expected = 0
+        self.message_id = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if headers.get('content-type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                result = await self.dispatch(target.rsplit('/', 1)[-1], params)
+
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, params):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            self.ready.set()
+            offset = int(params.get('offset', 0))
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            if not self.updates:
+                self.has_updates.clear()
+                try:
+                    await asyncio.wait_for(self.has_updates.wait(), float(params.get('timeout', 0)))
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:int(params.get('limit', 100))]
+        if method == 'setWebhook':
+            self.ready.set()
+            return True
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.replies.setdefault(chat_id, time.perf_counter())
+            if len(self.replies) >= self.expected:
+                self.all_replied.set()
+            self.message_id += 1
+            return {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        return True
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self.has_updates.set()
+
+
+def make_update(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Load'},
+            'from': user,
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }
+    }
+
+
+async def run_mode(mode, count, rate, timeout):
+    api = FakeBotAPI()
+    api.expected = count
+    api_port = free_port()
+    server = await asyncio.start_server(api.handle, '127.0.0.1', api_port)
+    webhook_port = free_port()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            BOT_TOKEN=BOT_TOKEN,
+            BOT_MODE=mode,
+            TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}/bot",
+            WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}",
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(webhook_port),
+            WEBHOOK_SECRET_TOKEN=SECRET_TOKEN,
+            ADMINS='',
+            BALANCE_REFRESH_INTERVAL='3600',
+            API_POOL_STATS_INTERVAL='0'
+        )
+        log_path = os.path.join(tmp, 'bot.log')
+        with open(log_path, 'wb') as log:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'),
+                cwd=tmp, env=env, stdout=log, stderr=log
+            )
+            try:
+                await asyncio.wait_for(api.ready.wait(), timeout)
+                sent_at, acks = await inject(api, mode, webhook_port, count, rate)
+                try:
+                    await asyncio.wait_for(api.all_replied.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.TimeoutError:
+                with open(log_path, encoding='utf-8', errors='replace') as f:
+                    print(f"[{mode}] бот не запустился:\n{f.read()[-2000:]}")
+                return
+            finally:
+                process.send_signal(signal.SIGINT)
+                await process.wait()
+                server.close()
+
+    latencies = [
+        (api.replies[user_id] - started) * 1000
+        for user_id, started in sent_at.items() if user_id in api.replies
+    ]
+    print(f"[{mode}] отправлено {count}, ответов {len(latencies)}")
+    if latencies:
+        print(
+            f"  задержка, мс: p50 {percentile(latencies, 0.5):.1f}  p95 {percentile(latencies, 0.95):.1f}  "
+            f"p99 {percentile(latencies, 0.99):.1f}  max {max(latencies):.1f}"
+        )
+    if acks:
+        print(f"  ответ webhook, мс: p50 {percentile(acks, 0.5):.1f}  p95 {percentile(acks, 0.95):.1f}")
+
+
+async def inject(api, mode, webhook_port, count, rate):
+    """Подача count обновлений с частотой rate в секунду"""
+    sent_at = {}
+    acks = []
+    url = f"http://127.0.0.1:{webhook_port}/telegram"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=100)) as client:
+        async def send(i):
+            user_id = USER_ID_BASE + i
+            update = make_update(i + 1, user_id)
+            sent_at[user_id] = time.perf_counter()
+            if mode == 'webhook':
+                response = await client.post(url, json=update, headers=headers)
+                acks.append((time.perf_counter() - sent_at[user_id]) * 1000)
+                response.raise_for_status()
+            else:
+                api.push_update(update)
+
+        started = time.perf_counter()
+        tasks = []
+        for i in range(count):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(i)))
+        await asyncio.gather(*tasks)
+    return sent_at, acks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=500, help="обновлений на режим")
+    parser.add_argument('--rate', type=float, default=100, help="обновлений в секунду")
+    parser.add_argument('--timeout', type=float, default=60, help="ожидание запуска и ответов, секунд")
+    parser.add_argument('--mode', nargs='+', default=['polling', 'webhook'], choices=['polling', 'webhook'])
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        asyncio.run(run_mode(mode, args.count, args.rate, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,40 @@
 import os
 import logging
 import asyncio
+import time
 from datetime import datetime, timedelta
-from telegram import Update, Message, Chat
+from telegram import Update, Message, Chat, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ContextTypes, ConversationHandler
 )
 from telegram.constants import ParseMode, ChatAction
+from telegram.error import BadRequest
 
 from config import Config
-from database import Database
+from database import AsyncDatabase
 from api_client import SofiaCashAPI
+from balance_service import CashdeskBalance
+from broadcast import BroadcastEngine
+from scheduler import DepositExpiryScheduler
+from persistence import SQLitePersistence
+from router import MessageRouter
+from update_processor import UserOrderedUpdateProcessor
+from tracing import DepositTracer, new_trace_id
+from fanout import AdminFanout
+from deposit_states import DepositStateMachine
+from credit_worker import DepositCreditWorker
+from circuit_breaker import STATE_VALUES
+from payout_worker import WithdrawalWorker, W_ID, W_USER_ID, W_USER_MESSAGE_ID
+from metrics import REGISTRY, MetricsServer, InstrumentedRequest, instrument_handler
 from keyboards import (
-    get_main_keyboard, get_admin_keyboard, get_deposit_keyboard,
+    get_main_keyboard, get_admin_keyboard, get_deposit_keyboard, get_manual_credit_keyboard,
     get_user_deposit_keyboard, get_payment_methods_keyboard,
-    get_broadcast_keyboard, get_support_keyboard
+    get_broadcast_keyboard, get_broadcast_cancel_keyboard,
+    get_support_keyboard, get_pagination_keyboard,
+    BTN_DEPOSIT, BTN_WITHDRAW, BTN_MY_BALANCE, BTN_MY_DEPOSITS, BTN_SUPPORT,
+    BTN_CONTACT_SUPPORT, BTN_STATS, BTN_PENDING_DEPOSITS, BTN_PROCESSING_DEPOSITS,
+    BTN_BROADCAST, BTN_CASHIER_BALANCE, BTN_SEARCH_PLAYER, BTN_CANCEL_BROADCAST, BTN_CREDITING_DEPOSITS
 )
 
 # Настройка логирования
@@ -27,15 +46,274 @@ logger = logging.getLogger(__name__)
 
 # Состояния для ConversationHandler
 DEPOSIT_AMOUNT, PAYMENT_METHOD, PAYMENT_DETAILS = range(3)
-BROADCAST_MESSAGE = range(3, 4)
+BROADCAST_MESSAGE = 3
+
+# Очереди депозитов для администраторов: view -> (статус, заголовок)
+ADMIN_DEPOSIT_VIEWS = {
+    'pending': ('PENDING', '⏳ Ожидающие депозиты'),
+    'processing': ('PROCESSING', '🔄 Депозиты в обработке'),
+    'crediting': ('CREDITING', '🏦 Зачисления в очереди и на проверке')
+}
+
+# Состояния автоматов запросов к SofiaCash в статистике
+BREAKER_STATE_TITLES = {
+    'closed': '✅ работает',
+    'half_open': '🟡 пробный запрос',
+    'open': '🔴 недоступен'
+}
+
+# Статусы заявок на вывод для игрока
+WITHDRAWAL_STATUS = {
+    'pending': '⏳ в очереди',
+    'in_flight': '🔄 выполняется',
+    'retry': '🔁 повтор',
+    'done': '✅ выплачено',
+    'failed': '❌ не выполнено',
+    'manual': '🕵️ на проверке'
+}
+
+# Типы обновлений, которые обрабатывает бот (остальные Telegram не присылает)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 class WinWinBot:
     def __init__(self):
         self.config = Config
-        self.db = Database()
+        self.db = AsyncDatabase()
         self.api = SofiaCashAPI()
+        self.balance = CashdeskBalance(
+            self.api,
+            refresh_interval=self.config.BALANCE_REFRESH_INTERVAL,
+            max_age=self.config.BALANCE_MAX_AGE
+        )
         self.pending_deposits = {}  # Временное хранение депозитов
+        self.tracer = DepositTracer(self.db)
+        self.deposits = DepositStateMachine(self.db)
+        self.credits = DepositCreditWorker(
+            self.db, self.api, self.balance, self.tracer, self.config,
+            on_settled=self.complete_deposit,
+            transitions=self.deposits.credit_transitions()
+        )
+        self.payouts = WithdrawalWorker(
+            self.db, self.api, self.balance, self.credits.gate, self.config,
+            on_progress=self.update_withdrawal_progress,
+            on_digest=self.send_withdrawal_digest
+        )
+        self.admin_fanout = AdminFanout(self.db, self.config.ADMINS, self.config.ADMIN_FANOUT_CONCURRENCY)
+        self.broadcasts = BroadcastEngine(self.db, self.config)
+        self.expiry = DepositExpiryScheduler(
+            self.db,
+            transition=self.deposits.expiry_transition(),
+            on_expired=self.notify_expired_deposits,
+            batch_size=self.config.DEPOSIT_EXPIRY_BATCH,
+            max_sleep=self.config.DEPOSIT_EXPIRY_MAX_SLEEP
+        )
+        self.persistence = None
+        if self.config.PERSISTENCE_BACKEND == 'sqlite':
+            self.persistence = SQLitePersistence(
+                self.db,
+                flush_interval=self.config.PERSISTENCE_FLUSH_INTERVAL,
+                shared=self.config.PERSISTENCE_SHARED
+            )
+        self.router = self.build_router()
+        self.update_processor = UserOrderedUpdateProcessor(
+            workers=self.config.CONCURRENT_UPDATES,
+            max_pending=self.config.UPDATE_QUEUE_LIMIT
+        )
+        self.metrics_server = None
+        if self.config.METRICS_PORT:
+            self.metrics_server = MetricsServer(REGISTRY, self.config.METRICS_HOST, self.config.METRICS_PORT)
+        self.register_metrics()
+        self.background_tasks = []
+        
+    def register_metrics(self):
+        """Метрики состояния компонентов, вычисляемые при запросе /metrics"""
+        REGISTRY.counter_callback(
+            'winwin_api_connections_opened_total', 'Открыто TCP-соединений к SofiaCash',
+            lambda: self.api.get_pool_stats()['connections_opened']
+        )
+        REGISTRY.gauge_callback(
+            'winwin_api_in_flight', 'Запросы к SofiaCash в работе', lambda: self.api.get_pool_stats()['in_flight']
+        )
+        REGISTRY.gauge_callback(
+            'winwin_api_waiters', 'Запросы к SofiaCash в ожидании слота', lambda: self.api.get_pool_stats()['waiters']
+        )
+        REGISTRY.gauge_callback(
+            'winwin_api_breaker_state', 'Автомат запросов к SofiaCash: 0 - замкнут, 1 - пробный запрос, 2 - разомкнут',
+            lambda: [((name,), STATE_VALUES[stats['state']]) for name, stats in self.api.get_breaker_stats().items()],
+            ['method']
+        )
+        REGISTRY.gauge_callback(
+            'winwin_api_timeout_seconds', 'Текущий таймаут запросов к SofiaCash',
+            lambda: [((name,), stats['timeout']) for name, stats in self.api.get_breaker_stats().items()],
+            ['method']
+        )
+        REGISTRY.gauge_callback(
+            'winwin_find_user_cache_size', 'Записей в кеше игроков', lambda: self.api.user_cache.get_stats()['size']
+        )
+        REGISTRY.counter_callback(
+            'winwin_find_user_cache_requests_total', 'Обращения к кешу игроков',
+            lambda: [(('hit',), self.api.user_cache.hits), (('miss',), self.api.user_cache.misses)],
+            ['result']
+        )
+        REGISTRY.counter_callback(
+            'winwin_find_user_cache_evictions_total', 'Вытеснения из кеша игроков', lambda: self.api.user_cache.evictions
+        )
+        REGISTRY.gauge_callback(
+            'winwin_cashdesk_balance', 'Последний известный баланс кассы',
+            lambda: self.balance.data['Balance'] if self.balance.data else None
+        )
+        REGISTRY.gauge_callback(
+            'winwin_cashdesk_balance_age_seconds', 'Возраст кешированного баланса кассы', self.balance.age
+        )
+        REGISTRY.gauge_callback(
+            'winwin_updates_waiting', 'Обновления в очереди на обработку', lambda: self.update_processor.waiting
+        )
+        REGISTRY.gauge_callback(
+            'winwin_updates_active', 'Обновления в обработке', lambda: self.update_processor.active
+        )
+        REGISTRY.counter_callback(
+            'winwin_updates_processed_total', 'Обработано обновлений', lambda: self.update_processor.processed
+        )
+        REGISTRY.counter_callback(
+            'winwin_route_messages_total', 'Текстовые сообщения по маршрутам',
+            lambda: [((name,), count) for name, count in self.router.get_stats().items()],
+            ['route']
+        )
+        REGISTRY.counter_callback(
+            'winwin_db_write_batches_total', 'Транзакции группового коммита', lambda: self.db.stats['batches']
+        )
+        REGISTRY.counter_callback(
+            'winwin_db_writes_total', 'Операции записи в базу', lambda: self.db.stats['writes']
+        )
+    
+    def build_router(self):
+        """Таблица маршрутов текстовых сообщений по кнопкам меню и роли"""
+        router = MessageRouter(lambda user_id: 'admin' if self.is_admin(user_id) else 'user')
+        
+        router.add_button('admin', BTN_STATS, self.admin_stats)
+        router.add_button('admin', BTN_PENDING_DEPOSITS, self.show_pending_deposits)
+        router.add_button('admin', BTN_PROCESSING_DEPOSITS, self.show_processing_deposits)
+        router.add_button('admin', BTN_CREDITING_DEPOSITS, self.show_crediting_deposits)
+        router.add_button('admin', BTN_CASHIER_BALANCE, self.show_cashier_balance)
+        router.add_button('admin', BTN_SEARCH_PLAYER, self.ask_player_id)
+        router.add_action('admin', 'search_user', self.search_player)
+        router.add_action('admin', 'add_payment_details', self.process_payment_details)
+        
+        router.add_button('user', BTN_WITHDRAW, self.start_withdrawal)
+        router.add_action('user', 'withdrawal_code', self.process_withdrawal_code)
+        router.add_button('user', BTN_MY_BALANCE, self.show_user_balance)
+        router.add_button('user', BTN_MY_DEPOSITS, self.show_user_deposits)
+        router.add_button('user', BTN_SUPPORT, self.show_support)
+        router.add_button('user', BTN_CONTACT_SUPPORT, self.contact_support)
+        # BTN_DEPOSIT и BTN_BROADCAST - точки входа ConversationHandler в main()
+        return router
+    
+    async def post_init(self, application: Application):
+        """Инициализация ресурсов после запуска приложения"""
+        await self.api.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
+        
+        self.background_tasks.append(asyncio.create_task(self.balance.run()))
+        if self.persistence:
+            self.background_tasks.append(asyncio.create_task(self.persistence.run()))
+        await self.recover_inflight_deposits(application.bot)
+        self.broadcasts.run(application.bot)
+        self.expiry.start(application.bot)
+        self.credits.start(application.bot)
+        self.payouts.start(application.bot)
+        if self.config.API_POOL_STATS_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(self.log_pool_stats()))
+    
+    async def post_shutdown(self, application: Application):
+        """Освобождение ресурсов при остановке приложения"""
+        await self.broadcasts.stop()
+        await self.expiry.stop()
+        await self.credits.stop()
+        await self.payouts.stop()
+        
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks.clear()
         
+        await self.api.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        self.db.close()
+    
+    async def recover_inflight_deposits(self, bot):
+        """Проверка открытых депозитов после перезапуска.
+        
+        Перевзводит сроки оплаты и отправляет администраторам одну сводку
+        по очереди. Без хранилища состояния (PERSISTENCE_BACKEND=memory)
+        context.user_data после перезапуска потеряны, и начатые действия
+        нужно повторить.
+        """
+        started = time.perf_counter()
+        try:
+            rearmed, summary = await asyncio.wait_for(
+                self.db.recover_open_deposits(self.config.DEPOSIT_TIMEOUT, self.config.RECOVERY_SAMPLE_SIZE),
+                timeout=self.config.RECOVERY_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Проверка открытых депозитов не уложилась в {self.config.RECOVERY_TIMEOUT} с")
+            return
+        
+        elapsed = time.perf_counter() - started
+        counts = {status: count for status, (count, _) in summary.items()}
+        logger.info(
+            f"Восстановление после перезапуска: {elapsed * 1000:.0f} мс, "
+            f"открытых депозитов {counts}, перевзведено сроков {rearmed}"
+        )
+        
+        if not any(counts.values()):
+            return
+        
+        lines = ["🔄 **Бот перезапущен**", "", "Открытые депозиты:"]
+        for status, (count, sample) in summary.items():
+            if not count:
+                continue
+            lines.append(f"\n{self.config.DEPOSIT_STATUS[status].capitalize()}: {count}")
+            for deposit_id, amount, created_at in sample:
+                lines.append(f"  #{deposit_id} • {amount:.2f} ₽ • {created_at[:16]}")
+            if count > len(sample):
+                lines.append(f"  … и еще {count - len(sample)}")
+        if not self.persistence:
+            lines.append("\n⚠️ Незавершенные действия (ввод реквизитов, поиск) нужно начать заново.")
+        text = "\n".join(lines)
+        
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id=admin_id, text=text, parse_mode=ParseMode.MARKDOWN)
+              for admin_id in self.config.ADMINS),
+            return_exceptions=True
+        )
+        for admin_id, result in zip(self.config.ADMINS, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось отправить сводку администратору {admin_id}: {result}")
+    
+    async def log_pool_stats(self):
+        """Периодический вывод статистики пула соединений SofiaCash"""
+        while True:
+            await asyncio.sleep(self.config.API_POOL_STATS_INTERVAL)
+            stats = self.api.get_pool_stats()
+            logger.info(
+                f"Пул SofiaCash: запросов {stats['requests']}, открыто соединений {stats['connections_opened']}, "
+                f"в работе {stats['in_flight']}/{stats['max_concurrency']}, ожидают {stats['waiters']}"
+            )
+            cache = self.api.user_cache.get_stats()
+            logger.info(
+                f"Кеш игроков: записей {cache['size']}, попаданий {cache['hits']}, "
+                f"промахов {cache['misses']} ({cache['hit_rate']:.0%}), вытеснено {cache['evictions']}"
+            )
+            logger.info(f"Маршруты сообщений: {self.router.get_stats()}")
+            updates = self.update_processor.get_stats()
+            logger.info(
+                f"Обновления: в работе {updates['active']}/{updates['workers']}, ожидают {updates['waiting']}, "
+                f"ожидание p95 {updates['wait_p95']:.0f} мс, обработка p50 {updates['handle_p50']:.0f} мс, "
+                f"p95 {updates['handle_p95']:.0f} мс, max {updates['handle_max']:.0f} мс"
+            )
+    
     def is_admin(self, user_id):
         """Проверка, является ли пользователь администратором"""
         return user_id in self.config.ADMINS
@@ -43,7 +321,7 @@ class WinWinBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
-        self.db.add_or_update_user(user.id, user.username, user.full_name)
+        await self.db.add_or_update_user(user.id, user.username, user.full_name)
         
         if self.is_admin(user.id):
             welcome_text = f"""
@@ -87,43 +365,23 @@ class WinWinBot:
             )
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка текстовых сообщений"""
-        user = update.effective_user
-        text = update.message.text
-        
-        if self.is_admin(user.id):
-            # Обработка сообщений администратора
-            if text == "📊 Статистика":
-                await self.admin_stats(update, context)
-            elif text == "⏳ Ожидающие депозиты":
-                await self.show_pending_deposits(update, context)
-            elif text == "🔄 В обработке":
-                await self.show_processing_deposits(update, context)
-            elif text == "📢 Рассылка":
-                await update.message.reply_text(
-                    "📢 Введите сообщение для рассылки:",
-                    reply_markup=ReplyKeyboardMarkup([["❌ Отменить рассылку"]], resize_keyboard=True)
-                )
-                return BROADCAST_MESSAGE
-            elif text == "💼 Баланс кассы":
-                await self.show_cashier_balance(update, context)
-            elif text == "👥 Поиск игрока":
-                await update.message.reply_text("🔍 Введите ID игрока для поиска:")
-                context.user_data['action'] = 'search_user'
-        else:
-            # Обработка сообщений пользователя
-            if text == "💰 Пополнить счет":
-                await self.start_deposit(update, context)
-            elif text == "💸 Вывести средства":
-                await self.start_withdrawal(update, context)
-            elif text == "📊 Мой баланс":
-                await self.show_user_balance(update, context)
-            elif text == "📋 Мои депозиты":
-                await self.show_user_deposits(update, context)
-            elif text == "🆘 Поддержка":
-                await self.show_support(update, context)
-            elif text == "📞 Связаться с поддержкой":
-                await self.contact_support(update, context)
+        """Обработка текстовых сообщений (по таблице маршрутов)"""
+        return await self.router.dispatch(update, context)
+    
+    async def ask_player_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Запрос ID игрока для поиска"""
+        await update.message.reply_text("🔍 Введите ID игрока для поиска:")
+        context.user_data['action'] = 'search_user'
+    
+    async def start_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Начало рассылки (только для администраторов)"""
+        if not self.is_admin(update.effective_user.id):
+            return ConversationHandler.END
+        await update.message.reply_text(
+            "📢 Введите сообщение для рассылки:",
+            reply_markup=get_broadcast_cancel_keyboard()
+        )
+        return BROADCAST_MESSAGE
 
     async def start_deposit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало процесса депозита"""
@@ -182,23 +440,29 @@ class WinWinBot:
         
         # Создаем депозит в базе данных
         user = update.effective_user
-        deposit_id = self.db.add_deposit(
+        trace_id = new_trace_id()
+        started_at, started = time.time(), time.perf_counter()
+        deposit_id = await self.db.add_deposit(
             user.id,
             user.username,
-            context.user_data['deposit_amount']
+            context.user_data['deposit_amount'],
+            trace_id
         )
+        await self.tracer.record(deposit_id, 'add_deposit', started_at, time.perf_counter() - started)
+        logger.info(f"Депозит #{deposit_id} создан (trace {trace_id})")
         
         # Сохраняем информацию о депозите
         context.user_data['deposit_id'] = deposit_id
         
         # Уведомляем администраторов
-        await self.notify_admins_about_deposit(
-            context, 
-            deposit_id, 
-            user, 
-            context.user_data['deposit_amount'],
-            method
-        )
+        async with self.tracer.span(deposit_id, 'notify_admins_about_deposit'):
+            await self.notify_admins_about_deposit(
+                context, 
+                deposit_id, 
+                user, 
+                context.user_data['deposit_amount'],
+                method
+            )
         
         # Отправляем сообщение пользователю
         user_message = await query.message.reply_text(
@@ -212,11 +476,7 @@ class WinWinBot:
         )
         
         # Сохраняем ID сообщения пользователя
-        self.db.conn.execute(
-            "UPDATE deposits SET user_message_id = ? WHERE id = ?",
-            (user_message.message_id, deposit_id)
-        )
-        self.db.conn.commit()
+        await self.db.set_user_message_id(deposit_id, user_message.message_id)
         
         return ConversationHandler.END
     
@@ -233,30 +493,27 @@ class WinWinBot:
             "👇 Для обработки нажмите кнопку ниже:"
         )
         
-        for admin_id in self.config.ADMINS:
-            try:
-                message = await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=admin_message,
-                    reply_markup=get_deposit_keyboard(deposit_id),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                
-                # Сохраняем ID сообщения администратора
-                self.db.conn.execute(
-                    "UPDATE deposits SET admin_message_id = ? WHERE id = ?",
-                    (message.message_id, deposit_id)
-                )
-                self.db.conn.commit()
-                
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление администратору {admin_id}: {e}")
+        # Отправляем всем администраторам сразу, ID сообщений сохраняются
+        await self.admin_fanout.send(
+            deposit_id,
+            lambda admin_id: context.bot.send_message(
+                chat_id=admin_id,
+                text=admin_message,
+                reply_markup=get_deposit_keyboard(deposit_id),
+                parse_mode=ParseMode.MARKDOWN
+            )
+        )
     
     async def handle_deposit_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка callback от администратора по депозиту"""
         query = update.callback_query
         await query.answer()
         
+        # Кнопки депозитов есть только у администраторов, но callback_data
+        # может прислать кто угодно
+        if not self.is_admin(query.from_user.id):
+            return
+        
         data = query.data
         deposit_id = int(data.split('_')[1])
         
@@ -268,12 +525,42 @@ class WinWinBot:
             await self.contact_user(query, deposit_id, context)
         elif data.startswith('view_'):
             await self.view_deposit(query, deposit_id, context)
+        elif data.startswith(('credited_', 'uncredited_')):
+            await self.resolve_manual_credit(query, deposit_id, data.startswith('credited_'), context)
     
     async def accept_deposit(self, query, deposit_id, context):
-        """Администратор принимает депозит"""
-        deposit = self.db.get_deposit(deposit_id)
+        """Администратор принимает депозит.
+        
+        Новый депозит администратор берет себе и вводит реквизиты, депозит
+        с чеком - подтверждает оплату и запускает зачисление. Если кнопку
+        нажали несколько администраторов сразу, депозит достается одному.
+        """
+        deposit = await self.db.get_deposit(deposit_id)
         if not deposit:
-            await query.edit_message_text("❌ Депозит не найден")
+            await edit_admin_message(query, "❌ Депозит не найден")
+            return
+        
+        admin = query.from_user
+        if self.deposits.can(deposit[4], 'start_credit'):
+            # Зачисление записывается в очередь вместе со сменой статуса
+            if await self.deposits.start_credit(deposit_id, admin.id) is None:
+                await self.show_deposit_taken(query, deposit_id)
+                return
+            self.credits.arm()
+            
+            text = f"⏳ Депозит #{deposit_id}: зачисление {deposit[3]:.2f} ₽ в очереди"
+            unavailable = self.api_unavailable_text('deposit')
+            if unavailable:
+                text += f"\n\n{unavailable}, зачисление начнется автоматически"
+            await edit_admin_message(query, text)
+            await self.admin_fanout.edit_others(
+                context.bot, deposit_id, admin.id,
+                f"🔒 Депозит #{deposit_id} подтвердил администратор {admin.full_name}"
+            )
+            return
+        
+        if await self.deposits.fire(deposit_id, 'take', admin_id=admin.id) is None:
+            await self.show_deposit_taken(query, deposit_id)
             return
         
         # Запрашиваем реквизиты оплаты
@@ -284,75 +571,165 @@ class WinWinBot:
             parse_mode=ParseMode.MARKDOWN
         )
         
+        # Убираем кнопки у остальных администраторов
+        await self.admin_fanout.edit_others(
+            context.bot, deposit_id, query.from_user.id,
+            f"🔒 Депозит #{deposit_id} взял администратор {query.from_user.full_name}"
+        )
+        
         # Сохраняем контекст для следующего шага
         context.user_data['action'] = 'add_payment_details'
         context.user_data['deposit_id'] = deposit_id
     
-    async def process_payment_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка реквизитов оплаты от администратора"""
-        if context.user_data.get('action') == 'add_payment_details':
-            deposit_id = context.user_data['deposit_id']
-            payment_details = update.message.text
-            
-            # Обновляем депозит
-            self.db.update_deposit_status(
-                deposit_id, 
-                'PAID', 
-                update.effective_user.id,
-                payment_details
-            )
-            
-            # Получаем информацию о депозите
-            deposit = self.db.get_deposit(deposit_id)
-            
-            # Отправляем реквизиты пользователю
+    async def show_deposit_taken(self, query, deposit_id):
+        """Переход не выполнен: депозит уже обработан другим администратором"""
+        deposit = await self.db.get_deposit(deposit_id)
+        status = self.config.DEPOSIT_STATUS.get(deposit[4], deposit[4]) if deposit else 'не найден'
+        await edit_admin_message(query, f"⚠️ Депозит #{deposit_id} уже обработан\n📌 Статус: {status}")
+    
+    async def resolve_manual_credit(self, query, deposit_id, credited, context):
+        """Администратор проверил в кассе зачисление с неясным исходом"""
+        if await self.deposits.resolve_credit(deposit_id, credited) is None:
+            await self.show_deposit_taken(query, deposit_id)
+            return
+        
+        deposit = await self.db.get_deposit(deposit_id)
+        admin = query.from_user
+        if credited:
             try:
                 await context.bot.send_message(
-                    chat_id=deposit[1],  # user_id
-                    text=f"💳 **Реквизиты для оплаты**\n\n"
-                         f"📋 Депозит #{deposit_id}\n"
-                         f"💰 Сумма: {deposit[3]:.2f} ₽\n\n"
-                         f"🔗 Реквизиты:\n"
-                         f"{payment_details}\n\n"
-                         f"⏳ Время на оплату: 10 минут\n"
-                         f"После оплаты нажмите кнопку 'Я оплатил'",
+                    chat_id=deposit[1],
+                    text=f"✅ **Депозит успешно зачислен!**\n\n"
+                         f"📋 Номер: #{deposit_id}\n"
+                         f"💵 Сумма: {deposit[3]:.2f} ₽\n"
+                         f"💰 Ваш счет пополнен",
                     parse_mode=ParseMode.MARKDOWN
                 )
+            except Exception as e:
+                logger.error(f"Не удалось уведомить игрока о депозите #{deposit_id}: {e}")
+            await edit_admin_message(
+                query, f"✅ Депозит #{deposit_id}: зачисление {deposit[3]:.2f} ₽ подтвердил {admin.full_name}"
+            )
+        else:
+            # Депозит вернулся в обработку: можно снова подтвердить или отклонить
+            await edit_admin_message(
+                query,
+                f"↩️ Депозит #{deposit_id}: зачисление не прошло (проверил {admin.full_name}), депозит в обработке",
+                reply_markup=get_deposit_keyboard(deposit_id)
+            )
+    
+    async def contact_user(self, query, deposit_id, context):
+        """Ссылка на чат с игроком депозита"""
+        deposit = await self.db.get_deposit(deposit_id)
+        if not deposit:
+            await query.message.reply_text("❌ Депозит не найден")
+            return
+        
+        player = f"@{deposit[2]}" if deposit[2] else f"ID {deposit[1]}"
+        await query.message.reply_text(
+            f"📞 Игрок депозита #{deposit_id}: {player}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💬 Написать игроку", url=f"tg://user?id={deposit[1]}")]
+            ])
+        )
+    
+    async def view_deposit(self, query, deposit_id, context):
+        """Карточка депозита отдельным сообщением (сообщение с кнопками не меняется)"""
+        deposit = await self.db.get_deposit(deposit_id)
+        if not deposit:
+            await query.message.reply_text("❌ Депозит не найден")
+            return
+        
+        lines = [
+            f"👁 Депозит #{deposit_id}",
+            f"👤 Игрок: @{deposit[2]}" if deposit[2] else f"👤 Игрок: ID {deposit[1]}",
+            f"💵 Сумма: {deposit[3]:.2f} ₽",
+            f"📌 Статус: {self.config.DEPOSIT_STATUS.get(deposit[4], deposit[4])}",
+            f"🕒 Создан: {deposit[9][:16]}"
+        ]
+        if deposit[11]:
+            lines.append(f"👨‍💼 Администратор: {deposit[11]}")
+        if deposit[5]:
+            lines.append(f"💳 Реквизиты: {deposit[5]}")
+        if deposit[6]:
+            lines.append("🧾 Чек загружен")
+        
+        reply_markup = None
+        if self.deposits.can(deposit[4], 'take') or self.deposits.can(deposit[4], 'start_credit'):
+            reply_markup = get_deposit_keyboard(deposit_id)
+        elif deposit[4] == 'CREDITING':
+            credit_status = (await self.db.get_credit_statuses([deposit_id])).get(deposit_id)
+            if credit_status == 'manual':
+                lines.append("🕵️ Зачисление на ручной проверке: проверьте операцию в кассе")
+                reply_markup = get_manual_credit_keyboard(deposit_id)
+            else:
+                lines.append("⏳ Зачисление в очереди")
+        await query.message.reply_text("\n".join(lines), reply_markup=reply_markup)
+    
+    async def process_payment_details(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка реквизитов оплаты от администратора"""
+        if context.user_data.get('action') == 'add_payment_details':
+            deposit_id = context.user_data['deposit_id']
+            async with self.tracer.span(deposit_id, 'process_payment_details'):
+                payment_details = update.message.text
                 
-                await update.message.reply_text(
-                    f"✅ Реквизиты отправлены игроку\n"
-                    f"Депозит #{deposit_id}\n"
-                    f"⏰ Таймер: 10 минут",
-                    reply_markup=get_admin_keyboard()
+                # Обновляем депозит и ставим срок оплаты (только если депозит
+                # все еще за этим администратором и не отменен)
+                previous = await self.deposits.fire(
+                    deposit_id,
+                    'send_details',
+                    owner_id=update.effective_user.id,
+                    payment_details=payment_details,
+                    expires_in=self.config.DEPOSIT_TIMEOUT
                 )
+                if previous is None:
+                    context.user_data.clear()
+                    await update.message.reply_text(
+                        f"⚠️ Депозит #{deposit_id} уже не ожидает реквизитов",
+                        reply_markup=get_admin_keyboard()
+                    )
+                    return
+                self.expiry.arm()
                 
-                # Запускаем таймер на 10 минут
-                asyncio.create_task(
-                    self.deposit_timeout_check(deposit_id, context)
-                )
+                # Получаем информацию о депозите
+                deposit = await self.db.get_deposit(deposit_id)
                 
-            except Exception as e:
-                await update.message.reply_text(
-                    f"❌ Не удалось отправить сообщение игроку: {e}",
-                    reply_markup=get_admin_keyboard()
-                )
+                # Отправляем реквизиты пользователю
+                try:
+                    await context.bot.send_message(
+                        chat_id=deposit[1],  # user_id
+                        text=f"💳 **Реквизиты для оплаты**\n\n"
+                             f"📋 Депозит #{deposit_id}\n"
+                             f"💰 Сумма: {deposit[3]:.2f} ₽\n\n"
+                             f"🔗 Реквизиты:\n"
+                             f"{payment_details}\n\n"
+                             f"⏳ Время на оплату: 10 минут\n"
+                             f"После оплаты нажмите кнопку 'Я оплатил'",
+                        parse_mode=ParseMode.MARKDOWN
+                    )
+                
+                    await update.message.reply_text(
+                        f"✅ Реквизиты отправлены игроку\n"
+                        f"Депозит #{deposit_id}\n"
+                        f"⏰ Таймер: 10 минут",
+                        reply_markup=get_admin_keyboard()
+                    )
+                
+                except Exception as e:
+                    await update.message.reply_text(
+                        f"❌ Не удалось отправить сообщение игроку: {e}",
+                        reply_markup=get_admin_keyboard()
+                    )
             
             # Очищаем контекст
             context.user_data.clear()
     
-    async def deposit_timeout_check(self, deposit_id, context):
-        """Проверка таймаута депозита (10 минут)"""
-        await asyncio.sleep(600)  # 10 минут
-        
-        deposit = self.db.get_deposit(deposit_id)
-        if deposit and deposit[4] == 'PAID':  # status == 'PAID'
-            # Депозит не оплачен вовремя
-            self.db.update_deposit_status(deposit_id, 'CANCELLED')
-            
-            # Уведомляем пользователя
+    async def notify_expired_deposits(self, bot, expired):
+        """Уведомление игроков об отмене депозитов по истечении срока оплаты"""
+        for deposit_id, user_id in expired:
             try:
-                await context.bot.send_message(
-                    chat_id=deposit[1],
+                await bot.send_message(
+                    chat_id=user_id,
                     text=f"❌ Депозит #{deposit_id} отменен\n"
                          f"Причина: истекло время оплаты"
                 )
@@ -387,41 +764,47 @@ class WinWinBot:
                 file_id = update.message.photo[-1].file_id
             
             if file_id:
-                # Сохраняем файл
-                self.db.add_receipt(deposit_id, file_id)
-                
-                # Уведомляем администраторов
-                deposit = self.db.get_deposit(deposit_id)
-                
-                for admin_id in self.config.ADMINS:
-                    try:
-                        # Отправляем сообщение с чеком
-                        if update.message.document:
-                            await context.bot.send_document(
-                                chat_id=admin_id,
-                                document=file_id,
-                                caption=f"📎 Чек для депозита #{deposit_id}\n"
-                                        f"👤 Игрок: {deposit[2]}\n"
-                                        f"💰 Сумма: {deposit[3]:.2f} ₽",
-                                reply_markup=get_deposit_keyboard(deposit_id)
-                            )
-                        else:
-                            await context.bot.send_photo(
-                                chat_id=admin_id,
-                                photo=file_id,
-                                caption=f"📎 Чек для депозита #{deposit_id}\n"
-                                        f"👤 Игрок: {deposit[2]}\n"
-                                        f"💰 Сумма: {deposit[3]:.2f} ₽",
-                                reply_markup=get_deposit_keyboard(deposit_id)
-                            )
-                    except Exception as e:
-                        logger.error(f"Не удалось отправить чек администратору {admin_id}: {e}")
-                
-                await update.message.reply_text(
-                    f"✅ Чек получен и отправлен администратору\n"
-                    f"Ожидайте подтверждения платежа",
-                    reply_markup=get_main_keyboard()
-                )
+                async with self.tracer.span(deposit_id, 'handle_receipt'):
+                    # Сохраняем файл
+                    if await self.deposits.fire(deposit_id, 'upload_receipt', receipt_file_id=file_id) is None:
+                        del context.user_data['waiting_for_receipt']
+                        await update.message.reply_text(
+                            f"❌ Депозит #{deposit_id} уже не ожидает чека",
+                            reply_markup=get_main_keyboard()
+                        )
+                        return
+                    
+                    # Уведомляем администраторов
+                    deposit = await self.db.get_deposit(deposit_id)
+                    
+                    caption = (
+                        f"📎 Чек для депозита #{deposit_id}\n"
+                        f"👤 Игрок: {deposit[2]}\n"
+                        f"💰 Сумма: {deposit[3]:.2f} ₽"
+                    )
+                    
+                    # Отправляем сообщение с чеком всем администраторам сразу
+                    if update.message.document:
+                        send_receipt = lambda admin_id: context.bot.send_document(
+                            chat_id=admin_id,
+                            document=file_id,
+                            caption=caption,
+                            reply_markup=get_deposit_keyboard(deposit_id)
+                        )
+                    else:
+                        send_receipt = lambda admin_id: context.bot.send_photo(
+                            chat_id=admin_id,
+                            photo=file_id,
+                            caption=caption,
+                            reply_markup=get_deposit_keyboard(deposit_id)
+                        )
+                    await self.admin_fanout.send(deposit_id, send_receipt, kind='caption')
+                    
+                    await update.message.reply_text(
+                        f"✅ Чек получен и отправлен администратору\n"
+                        f"Ожидайте подтверждения платежа",
+                        reply_markup=get_main_keyboard()
+                    )
                 
                 # Очищаем контекст
                 del context.user_data['waiting_for_receipt']
@@ -432,13 +815,11 @@ class WinWinBot:
     
     async def reject_deposit(self, query, deposit_id, context):
         """Администратор отклоняет депозит"""
-        self.db.update_deposit_status(
-            deposit_id, 
-            'CANCELLED', 
-            query.from_user.id
-        )
+        if await self.deposits.fire(deposit_id, 'reject', admin_id=query.from_user.id) is None:
+            await self.show_deposit_taken(query, deposit_id)
+            return
         
-        deposit = self.db.get_deposit(deposit_id)
+        deposit = await self.db.get_deposit(deposit_id)
         
         # Уведомляем пользователя
         try:
@@ -451,32 +832,33 @@ class WinWinBot:
         except:
             pass
         
-        await query.edit_message_text(
+        await edit_admin_message(
+            query,
             f"❌ Депозит #{deposit_id} отклонен\n"
             f"Игрок уведомлен"
         )
+        
+        await self.admin_fanout.edit_others(
+            context.bot, deposit_id, query.from_user.id,
+            f"❌ Депозит #{deposit_id} отклонил администратор {query.from_user.full_name}"
+        )
     
-    async def complete_deposit(self, deposit_id, admin_id, context):
-        """Завершение депозита (пополнение через API)"""
-        deposit = self.db.get_deposit(deposit_id)
+    async def complete_deposit(self, bot, job, status, result):
+        """Итог зачисления из очереди: уведомления игроку и администратору.
         
-        # Пополняем счет через API SofiaCash
-        result = self.api.deposit_to_user(deposit[1], deposit[3])
+        Статус депозита и баланс игрока уже обновлены DepositCreditWorker
+        в одной транзакции с записью итога.
+        """
+        deposit_id, user_id, amount, admin_id = job[0], job[1], job[2], job[3]
         
-        if result['success']:
-            # Обновляем статус депозита
-            self.db.update_deposit_status(deposit_id, 'COMPLETED', admin_id)
-            
-            # Обновляем баланс пользователя
-            self.db.update_user_balance(deposit[1], deposit[3])
-            
+        if status == 'done':
             # Уведомляем пользователя
             try:
-                await context.bot.send_message(
-                    chat_id=deposit[1],
+                await bot.send_message(
+                    chat_id=user_id,
                     text=f"✅ **Депозит успешно зачислен!**\n\n"
                          f"📋 Номер: #{deposit_id}\n"
-                         f"💵 Сумма: {deposit[3]:.2f} ₽\n"
+                         f"💵 Сумма: {amount:.2f} ₽\n"
                          f"💰 Ваш счет пополнен\n"
                          f"🎰 Удачной игры в WinWin!",
                     parse_mode=ParseMode.MARKDOWN
@@ -484,15 +866,17 @@ class WinWinBot:
             except:
                 pass
             
-            return True
-        else:
-            # Ошибка API
+            note = " (подтверждено сверкой баланса кассы)" if result.get('reconciled') else ""
+            admin_text = f"✅ Депозит #{deposit_id} зачислен: {amount:.2f} ₽{note}"
+            reply_markup = None
+        elif status == 'failed':
+            # Ошибка API - депозит вернулся в обработку, можно повторить
             try:
-                await context.bot.send_message(
-                    chat_id=deposit[1],
+                await bot.send_message(
+                    chat_id=user_id,
                     text=f"⚠️ **Ошибка зачисления депозита**\n\n"
                          f"📋 Номер: #{deposit_id}\n"
-                         f"💵 Сумма: {deposit[3]:.2f} ₽\n"
+                         f"💵 Сумма: {amount:.2f} ₽\n"
                          f"❌ Ошибка: {result.get('error', 'Неизвестная ошибка')}\n"
                          f"📞 Свяжитесь с поддержкой",
                     parse_mode=ParseMode.MARKDOWN
@@ -500,7 +884,205 @@ class WinWinBot:
             except:
                 pass
             
-            return False
+            admin_text = (
+                f"⚠️ Депозит #{deposit_id} не зачислен\n"
+                f"❌ {result.get('error', 'Неизвестная ошибка')}\n"
+                f"Можно повторить или отклонить"
+            )
+            reply_markup = get_deposit_keyboard(deposit_id)
+        else:
+            # Исход неизвестен: депозит остается в CREDITING до ручной проверки
+            admin_text = (
+                f"❗ Депозит #{deposit_id} ({amount:.2f} ₽, игрок {user_id})\n"
+                f"Не удалось определить, прошло ли зачисление.\n"
+                f"Проверьте операцию в кассе вручную и отметьте результат"
+            )
+            reply_markup = get_manual_credit_keyboard(deposit_id)
+        
+        recipients = [admin_id] if admin_id and status != 'manual' else self.config.ADMINS
+        for chat_id in recipients:
+            try:
+                await bot.send_message(chat_id=chat_id, text=admin_text, reply_markup=reply_markup)
+            except Exception as e:
+                logger.error(f"Не удалось отправить итог зачисления администратору {chat_id}: {e}")
+    
+    async def start_withdrawal(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Начало вывода: запрос кода выплаты"""
+        await update.message.reply_text(
+            "💸 **Вывод средств**\n\n"
+            "1. Создайте заявку на вывод в личном кабинете WinWin, выбрав кассу SofiaCash\n"
+            "2. Отправьте сюда код выплаты из заявки",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        context.user_data['action'] = 'withdrawal_code'
+    
+    async def process_withdrawal_code(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Код выплаты: заявка записывается в очередь, выплату выполняет WithdrawalWorker"""
+        code = update.message.text.strip()
+        if not 4 <= len(code) <= 64 or not code.replace('-', '').isalnum():
+            await update.message.reply_text("❌ Код выплаты должен состоять из букв и цифр. Попробуйте еще раз:")
+            return
+        
+        context.user_data.pop('action', None)
+        user = update.effective_user
+        withdrawal_id, created = await self.db.add_withdrawal(
+            user.id, user.username, code, self.config.PAYOUT_LEASE
+        )
+        if not created:
+            await update.message.reply_text(
+                f"ℹ️ Заявка на вывод #{withdrawal_id} уже принята, дождитесь ее завершения",
+                reply_markup=get_main_keyboard()
+            )
+            return
+        
+        # Заявка попадает в очередь только вместе с id сообщения игрока,
+        # иначе быстрая выплата не смогла бы показать ему итог
+        user_message = None
+        try:
+            user_message = await update.message.reply_text(
+                self.format_withdrawal(withdrawal_id, 'pending'),
+                reply_markup=get_main_keyboard()
+            )
+        finally:
+            await self.db.queue_withdrawal(withdrawal_id, user_message.message_id if user_message else None)
+            self.payouts.arm()
+    
+    def format_withdrawal(self, withdrawal_id, status, result=None):
+        """Текст сообщения заявки на вывод для игрока"""
+        result = result or {}
+        lines = [f"💸 Заявка на вывод #{withdrawal_id}", f"📌 Статус: {WITHDRAWAL_STATUS[status]}"]
+        if status == 'pending':
+            lines.append("Выплата начнется автоматически, сообщение обновится")
+        elif status == 'retry':
+            lines.append(f"Касса не ответила, повторим через {format_duration(result['delay'])}")
+        elif status == 'done' and result.get('amount') is not None:
+            lines.append(f"💵 Сумма: {result['amount']:.2f} ₽")
+        elif status == 'failed':
+            lines.append(f"Причина: {result.get('error') or 'Неизвестная ошибка'}")
+            lines.append(f"Проверьте код или обратитесь в поддержку: {self.config.SUPPORT_USERNAME}")
+        elif status == 'manual':
+            lines.append("Администратор проверит выплату и свяжется с вами")
+        return "\n".join(lines)
+    
+    async def update_withdrawal_progress(self, bot, withdrawal, status, result):
+        """Ход выплаты в сообщении заявки (из WithdrawalWorker)"""
+        text = self.format_withdrawal(withdrawal[W_ID], status, result)
+        if withdrawal[W_USER_MESSAGE_ID]:
+            try:
+                await bot.edit_message_text(
+                    chat_id=withdrawal[W_USER_ID], message_id=withdrawal[W_USER_MESSAGE_ID], text=text
+                )
+                return
+            except BadRequest:
+                pass
+        # Итог важен - если сообщение изменить не удалось, отправляем новое
+        if status in ('done', 'failed', 'manual'):
+            await bot.send_message(chat_id=withdrawal[W_USER_ID], text=text)
+    
+    async def send_withdrawal_digest(self, bot, rows):
+        """Сводка завершенных выплат администраторам (одно сообщение на период).
+        
+        Если сводку не получил ни один администратор, выбрасывает
+        исключение, и выплаты остаются для следующей сводки.
+        """
+        by_status = {}
+        for row in rows:
+            by_status.setdefault(row[3], []).append(row)
+        done = by_status.get('done', [])
+        
+        lines = [
+            f"💸 Выплаты за период: {len(rows)}",
+            f"✅ Выплачено: {len(done)} на {sum(row[4] or 0 for row in done):.2f} ₽"
+        ]
+        for status, title in (('failed', '❌ Не выполнены'), ('manual', '🕵️ Требуют проверки')):
+            if by_status.get(status):
+                lines += ["", f"{title}: {len(by_status[status])}"]
+                for withdrawal_id, user_id, username, _, _, error in by_status[status]:
+                    player = f"@{username}" if username else user_id
+                    lines.append(f"  #{withdrawal_id} • {player} • {error or '—'}")
+        text = "\n".join(lines)
+        
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id=admin_id, text=text) for admin_id in self.config.ADMINS),
+            return_exceptions=True
+        )
+        for admin_id, result in zip(self.config.ADMINS, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось отправить сводку выплат администратору {admin_id}: {result}")
+        if results and all(isinstance(result, Exception) for result in results):
+            raise RuntimeError("сводка выплат не доставлена ни одному администратору")
+    
+    async def show_user_deposits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Депозиты игрока (постранично)"""
+        text, markup = await self.render_deposits_page('my', update.effective_user.id)
+        await update.message.reply_text(text, reply_markup=markup)
+    
+    async def show_pending_deposits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Очередь ожидающих депозитов (постранично)"""
+        text, markup = await self.render_deposits_page('pending', update.effective_user.id)
+        await update.message.reply_text(text, reply_markup=markup)
+    
+    async def show_processing_deposits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Очередь депозитов в обработке (постранично)"""
+        text, markup = await self.render_deposits_page('processing', update.effective_user.id)
+        await update.message.reply_text(text, reply_markup=markup)
+    
+    async def show_crediting_deposits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Депозиты в зачислении, в том числе ожидающие ручной проверки (постранично)"""
+        text, markup = await self.render_deposits_page('crediting', update.effective_user.id)
+        await update.message.reply_text(text, reply_markup=markup)
+    
+    async def handle_deposits_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Листание списков депозитов"""
+        query = update.callback_query
+        await query.answer()
+        
+        _, view, direction, created_at, deposit_id = query.data.split('|')
+        if view in ADMIN_DEPOSIT_VIEWS and not self.is_admin(query.from_user.id):
+            return
+        
+        text, markup = await self.render_deposits_page(
+            view,
+            query.from_user.id,
+            cursor=(created_at, int(deposit_id)),
+            backwards=direction == 'p'
+        )
+        await query.edit_message_text(text, reply_markup=markup)
+    
+    async def render_deposits_page(self, view, user_id, cursor=None, backwards=False):
+        """Текст и кнопки одной страницы списка депозитов"""
+        page_size = self.config.DEPOSITS_PAGE_SIZE
+        if view in ADMIN_DEPOSIT_VIEWS:
+            status, title = ADMIN_DEPOSIT_VIEWS[view]
+            rows, has_more = await self.db.get_status_deposits_page(status, cursor, backwards, page_size)
+        else:
+            title = "📋 Мои депозиты"
+            rows, has_more = await self.db.get_user_deposits_page(user_id, cursor, backwards, page_size)
+        
+        if not rows:
+            return f"{title}\n\n📭 Список пуст", None
+        
+        # Страница, с которой пришли, всегда существует
+        has_prev = has_more if backwards else cursor is not None
+        has_next = cursor is not None if backwards else has_more
+        
+        # Зачисления на ручной проверке помечаются и получают кнопки просмотра
+        manual = []
+        if view == 'crediting':
+            credit_statuses = await self.db.get_credit_statuses([deposit[0] for deposit in rows])
+            manual = [deposit[0] for deposit in rows if credit_statuses.get(deposit[0]) == 'manual']
+        
+        lines = [title, ""]
+        for deposit in rows:
+            status_text = self.config.DEPOSIT_STATUS.get(deposit[4], deposit[4])
+            if deposit[0] in manual:
+                status_text = "🕵️ на ручной проверке"
+            line = f"#{deposit[0]} • {deposit[3]:.2f} ₽ • {status_text} • {deposit[9][:16]}"
+            if view in ADMIN_DEPOSIT_VIEWS:
+                line += f" • @{deposit[2]}" if deposit[2] else f" • ID {deposit[1]}"
+            lines.append(line)
+        
+        return "\n".join(lines), get_pagination_keyboard(view, rows[0], rows[-1], has_prev, has_next, manual)
     
     async def show_support(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать информацию о поддержке"""
@@ -545,7 +1127,7 @@ class WinWinBot:
     
     async def broadcast_message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик рассылки"""
-        if update.message.text == "❌ Отменить рассылку":
+        if update.message.text == BTN_CANCEL_BROADCAST:
             await update.message.reply_text(
                 "❌ Рассылка отменена",
                 reply_markup=get_admin_keyboard()
@@ -564,41 +1146,28 @@ class WinWinBot:
         
         return ConversationHandler.END
     
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отмена текущего действия (/cancel)"""
+        context.user_data.clear()
+        keyboard = get_admin_keyboard() if self.is_admin(update.effective_user.id) else get_main_keyboard()
+        await update.message.reply_text("❌ Действие отменено", reply_markup=keyboard)
+        return ConversationHandler.END
+    
     async def broadcast_confirmation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Подтверждение рассылки"""
         query = update.callback_query
         await query.answer()
         
-        if query.data == 'broadcast_confirm':
-            await query.edit_message_text("⏳ Отправка рассылки...")
-            
-            # Получаем всех пользователей
-            cursor = self.db.conn.cursor()
-            cursor.execute("SELECT user_id FROM users")
-            users = cursor.fetchall()
+        if query.data == 'broadcast_confirm' and 'broadcast_message' in context.user_data:
+            await query.edit_message_text("⏳ Рассылка поставлена в очередь...")
             
-            success_count = 0
-            fail_count = 0
-            
-            for user in users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=user[0],
-                        text=context.user_data['broadcast_message'].replace('\\', ''),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                    success_count += 1
-                    await asyncio.sleep(0.1)  # Задержка чтобы не превысить лимиты
-                except Exception as e:
-                    fail_count += 1
-                    logger.error(f"Не удалось отправить рассылку пользователю {user[0]}: {e}")
-            
-            await query.edit_message_text(
-                f"✅ Рассылка завершена!\n\n"
-                f"✅ Успешно: {success_count}\n"
-                f"❌ Не удалось: {fail_count}\n"
-                f"👥 Всего: {len(users)}"
+            # Рассылка идет в фоне, прогресс обновляется в этом сообщении
+            broadcast_id = await self.broadcasts.start(
+                query.from_user.id,
+                context.user_data['broadcast_message'],
+                query.message.message_id
             )
+            logger.info(f"Администратор {query.from_user.id} запустил рассылку #{broadcast_id}")
         else:
             await query.edit_message_text("❌ Рассылка отменена")
         
@@ -608,25 +1177,169 @@ class WinWinBot:
             reply_markup=get_admin_keyboard()
         )
     
+    async def search_player(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Поиск игрока по ID через API"""
+        player_id = update.message.text.strip()
+        if not player_id.isdigit():
+            await update.message.reply_text("❌ ID игрока должен содержать только цифры. Попробуйте еще раз:")
+            return
+        
+        context.user_data.pop('action', None)
+        player = await self.api.find_user(player_id)
+        
+        if player:
+            details = "\n".join(f"• {key}: {value}" for key, value in player.items())
+            response = f"👤 Игрок {player_id}\n\n{details}"
+        else:
+            response = self.api_unavailable_text('find_user') or f"❌ Игрок {player_id} не найден"
+        
+        await update.message.reply_text(response, reply_markup=get_admin_keyboard())
+    
+    async def show_user_balance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сумма пополнений игрока через бота"""
+        user = await self.db.get_user(update.effective_user.id)
+        balance, deposits_count = (user[3], user[4]) if user else (0, 0)
+        await update.message.reply_text(
+            f"📊 Мой баланс\n\n"
+            f"💰 Пополнено через бота: {balance:.2f} ₽\n"
+            f"📋 Зачисленных депозитов: {deposits_count}"
+        )
+    
+    async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Статистика депозитов, пользователей и маршрутов сообщений"""
+        deposits = await self.db.get_deposit_stats()
+        users = await self.db.count_active_users()
+        
+        lines = ["📊 Статистика", "", f"👥 Активных пользователей: {users}", "", "💰 Депозиты:"]
+        for status, title in self.config.DEPOSIT_STATUS.items():
+            count, total = deposits.get(status, (0, 0))
+            lines.append(f"• {title.capitalize()}: {count} ({total:.2f} ₽)")
+        
+        updates = self.update_processor.get_stats()
+        lines += [
+            "",
+            "⚙️ Обработка обновлений:",
+            f"• В работе: {updates['active']}/{updates['workers']}, в очереди: {updates['waiting']}",
+            f"• Ожидание p95: {updates['wait_p95']:.0f} мс",
+            f"• Обработка p50/p95: {updates['handle_p50']:.0f}/{updates['handle_p95']:.0f} мс"
+        ]
+        
+        credits = await self.db.get_credit_stats()
+        lines += [
+            "",
+            "🏦 Зачисления:",
+            f"• В работе: {self.credits.get_stats()['running']}/{self.config.CREDIT_WORKERS}, "
+            f"ждут повтора: {credits.get('pending', 0) + credits.get('unknown', 0)}",
+            f"• Требуют проверки: {credits.get('manual', 0)}"
+        ]
+        
+        withdrawals = await self.db.get_withdrawal_stats()
+        queued = sum(withdrawals.get(status, (0, 0))[0] for status in ('pending', 'in_flight', 'unknown'))
+        lines += [
+            "",
+            "💸 Выводы:",
+            f"• В работе: {self.payouts.get_stats()['running']}/{self.config.PAYOUT_CONCURRENCY}, в очереди: {queued}",
+            f"• Выплачено: {withdrawals.get('done', (0, 0))[0]} ({withdrawals.get('done', (0, 0))[1]:.2f} ₽)",
+            f"• Не выполнено: {withdrawals.get('failed', (0, 0))[0]}, требуют проверки: {withdrawals.get('manual', (0, 0))[0]}"
+        ]
+        
+        lines += ["", "🔌 SofiaCash:"]
+        for name, stats in self.api.get_breaker_stats().items():
+            line = f"• {name}: {BREAKER_STATE_TITLES[stats['state']]}, таймаут {stats['timeout']:.1f} с"
+            if stats['p50'] is not None:
+                line += f", p50/p95 {stats['p50'] * 1000:.0f}/{stats['p95'] * 1000:.0f} мс"
+            if stats['failures']:
+                line += f", ошибок подряд: {stats['failures']}"
+            lines.append(line)
+        
+        lines += ["", "🧭 Сообщения по маршрутам:"]
+        routes = sorted(self.router.get_stats().items(), key=lambda item: item[1], reverse=True)
+        lines += [f"• {name}: {count}" for name, count in routes] or ["• пока нет"]
+        
+        await update.message.reply_text("\n".join(lines))
+    
+    def api_unavailable_text(self, api_method):
+        """Сообщение о недоступности SofiaCash, если автомат метода разомкнут"""
+        retry_after = self.api.retry_after(api_method)
+        if retry_after is None:
+            return None
+        return f"⚠️ Касса SofiaCash временно недоступна, повторите через {format_duration(max(retry_after, 1))}"
+    
     async def show_cashier_balance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Показать баланс кассы через API"""
-        await update.message.reply_text("⏳ Запрашиваю баланс кассы...")
+        """Показать баланс кассы (из кеша или через API)"""
+        if not self.balance.is_fresh():
+            await update.message.reply_text("⏳ Запрашиваю баланс кассы...")
         
-        balance_data = self.api.get_balance()
+        balance_data = await self.balance.get()
         
         if balance_data and 'Balance' in balance_data:
+            age = int(self.balance.age())
+            updated_at = datetime.now() - timedelta(seconds=age)
             response = (
                 f"💰 **Баланс кассы SofiaCash**\n\n"
                 f"💵 Доступно: {balance_data['Balance']:.2f} ₽\n"
                 f"📊 Лимит: {balance_data.get('Limit', 0):.2f} ₽\n"
                 f"📈 Свободно: {balance_data.get('Limit', 0) - balance_data['Balance']:.2f} ₽\n\n"
-                f"🔄 Последнее обновление: {datetime.now().strftime('%H:%M:%S')}"
+                f"🔄 Последнее обновление: {updated_at.strftime('%H:%M:%S')} ({age} сек назад)"
             )
         else:
-            response = "❌ Не удалось получить баланс кассы"
+            response = self.api_unavailable_text('balance') or "❌ Не удалось получить баланс кассы"
         
         await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
     
+    async def trace_deposit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/trace <id> - хронология депозита, /trace - длительность этапов по последним депозитам"""
+        if not self.is_admin(update.effective_user.id):
+            return
+        
+        if context.args and context.args[0].isdigit():
+            text = await self.render_deposit_trace(int(context.args[0]))
+        else:
+            text = await self.render_trace_stats(self.config.TRACE_STATS_DEPOSITS)
+        await update.message.reply_text(text)
+    
+    async def render_deposit_trace(self, deposit_id):
+        """Этапы депозита с длительностями и ожиданием между ними"""
+        deposit = await self.db.get_deposit(deposit_id)
+        if not deposit:
+            return f"❌ Депозит #{deposit_id} не найден"
+        spans = await self.db.get_deposit_spans(deposit_id)
+        
+        lines = [
+            f"🧭 Депозит #{deposit_id} (trace {deposit[13] or '—'})",
+            f"📌 Статус: {self.config.DEPOSIT_STATUS.get(deposit[4], deposit[4])}",
+            f"🕒 Создан: {deposit[9]}",
+            ""
+        ]
+        if not spans:
+            lines.append("Этапы не записаны")
+            return "\n".join(lines)
+        
+        first_start = spans[0][1]
+        previous_end = first_start
+        for stage, started_at, duration_ms, ok in spans:
+            wait = started_at - previous_end
+            if wait >= 1:
+                lines.append(f"   ⏳ ожидание {format_duration(wait)}")
+            mark = "✅" if ok else "❌"
+            lines.append(
+                f"{mark} +{format_duration(started_at - first_start)} {stage}: {duration_ms:.0f} мс"
+            )
+            previous_end = max(previous_end, started_at + duration_ms / 1000)
+        lines.append("")
+        lines.append(f"⏱ Всего: {format_duration(previous_end - first_start)}")
+        return "\n".join(lines)
+    
+    async def render_trace_stats(self, deposits):
+        """p50/p95 этапов по последним депозитам"""
+        stats = await self.tracer.get_stage_stats(deposits)
+        if not stats:
+            return "📭 Нет записанных этапов"
+        lines = [f"🧭 Этапы по последним {deposits} депозитам (p50 / p95):", ""]
+        for stage, (count, p50, p95) in sorted(stats.items()):
+            lines.append(f"• {stage}: {p50:.0f} / {p95:.0f} мс ({count})")
+        return "\n".join(lines)
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Глобальный обработчик ошибок"""
         logger.error(f"Ошибка: {context.error}")
@@ -639,56 +1352,109 @@ class WinWinBot:
             except:
                 pass
 
+async def edit_admin_message(query, text, reply_markup=None):
+    """Изменение сообщения с кнопками депозита (у чека меняется подпись)"""
+    if query.message is not None and query.message.text is None:
+        await query.edit_message_caption(caption=text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+def format_duration(seconds):
+    """Длительность для людей: 850 мс, 12.4 с, 5 мин 3 с"""
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} мс"
+    if seconds < 60:
+        return f"{seconds:.1f} с"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes} мин {seconds} с"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин"
+
 def main():
     """Запуск бота"""
     # Проверка конфигурации
     if not Config.BOT_TOKEN:
         raise ValueError("BOT_TOKEN не установлен!")
     
+    if Config.BOT_MODE == 'webhook':
+        if not Config.WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL не установлен!")
+        if not Config.WEBHOOK_SECRET_TOKEN:
+            raise ValueError("WEBHOOK_SECRET_TOKEN не установлен!")
+    
+    # Пауза перед сверкой зачисления идет в счет аренды попытки
+    if Config.CREDIT_RECONCILE_HOLD * 4 > Config.CREDIT_LEASE:
+        raise ValueError("CREDIT_RECONCILE_HOLD должен быть не больше четверти CREDIT_LEASE!")
+    
     # Создаем бота
     bot = WinWinBot()
     
     # Создаем приложение
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .base_url(Config.TELEGRAM_API_URL)
+        .concurrent_updates(bot.update_processor)
+        .request(InstrumentedRequest(connection_pool_size=Config.TELEGRAM_POOL_SIZE))
+    )
+    if bot.persistence:
+        builder = builder.persistence(bot.persistence)
+    application = (
+        builder
+        .post_init(bot.post_init)
+        .post_shutdown(bot.post_shutdown)
+        .build()
+    )
+    
+    # Время обработчиков пишется в метрики; текстовые сообщения
+    # замеряются по маршрутам в MessageRouter
+    timed = instrument_handler
     
     # ConversationHandler для депозитов
     deposit_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text(["💰 Пополнить счет"]), bot.start_deposit)],
+        entry_points=[MessageHandler(filters.Text([BTN_DEPOSIT]), timed(bot.start_deposit))],
         states={
             DEPOSIT_AMOUNT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.process_deposit_amount)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed(bot.process_deposit_amount))
             ],
             PAYMENT_METHOD: [
-                CallbackQueryHandler(bot.process_payment_method, pattern="^method_")
+                CallbackQueryHandler(timed(bot.process_payment_method), pattern="^method_")
             ]
         },
-        fallbacks=[CommandHandler("cancel", bot.cancel)],
-        allow_reentry=True
+        fallbacks=[CommandHandler("cancel", timed(bot.cancel))],
+        allow_reentry=True,
+        name="deposit",
+        persistent=bot.persistence is not None
     )
     
     # ConversationHandler для рассылки
     broadcast_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text(["📢 Рассылка"]), bot.handle_message)],
+        entry_points=[MessageHandler(filters.Text([BTN_BROADCAST]), timed(bot.start_broadcast))],
         states={
             BROADCAST_MESSAGE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.broadcast_message_handler)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed(bot.broadcast_message_handler))
             ]
         },
         fallbacks=[],
-        allow_reentry=True
+        allow_reentry=True,
+        name="broadcast",
+        persistent=bot.persistence is not None
     )
     
     # Добавляем обработчики
-    application.add_handler(CommandHandler("start", bot.start))
+    application.add_handler(CommandHandler("start", timed(bot.start)))
+    application.add_handler(CommandHandler("trace", timed(bot.trace_deposit)))
     application.add_handler(deposit_conv_handler)
     application.add_handler(broadcast_conv_handler)
     
     # Обработчики callback
-    application.add_handler(CallbackQueryHandler(bot.handle_deposit_callback, pattern="^(accept|reject|contact|view)_"))
-    application.add_handler(CallbackQueryHandler(bot.handle_user_paid, pattern="^paid_"))
-    application.add_handler(CallbackQueryHandler(bot.broadcast_confirmation, pattern="^broadcast_"))
+    application.add_handler(CallbackQueryHandler(timed(bot.handle_deposit_callback), pattern="^(accept|reject|contact|view|credited|uncredited)_"))
+    application.add_handler(CallbackQueryHandler(timed(bot.handle_user_paid), pattern="^paid_"))
+    application.add_handler(CallbackQueryHandler(timed(bot.broadcast_confirmation), pattern="^broadcast_"))
+    application.add_handler(CallbackQueryHandler(timed(bot.handle_deposits_page), pattern=r"^dp\|"))
     
-    # Обработчики сообщений
+    # Остальные текстовые сообщения (кнопки меню и ожидаемый ввод) - через таблицу маршрутов
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, 
         bot.handle_message
@@ -697,21 +1463,29 @@ def main():
     # Обработчик документов (чеки)
     application.add_handler(MessageHandler(
         filters.Document.ALL | filters.PHOTO,
-        bot.handle_receipt
-    ))
-    
-    # Обработчик для платежных реквизитов от администратора
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
-        bot.process_payment_details
+        timed(bot.handle_receipt)
     ))
     
     # Обработчик ошибок
     application.add_error_handler(bot.error_handler)
     
     # Запуск бота
-    print("🤖 Бот WinWin запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if Config.BOT_MODE == 'webhook':
+        # Обновления приходят POST-запросами от Telegram; запросы без
+        # правильного секретного токена отклоняются с 403
+        print(f"🤖 Бот WinWin запущен (webhook, порт {Config.WEBHOOK_PORT})...")
+        application.run_webhook(
+            listen=Config.WEBHOOK_LISTEN,
+            port=Config.WEBHOOK_PORT,
+            url_path=Config.WEBHOOK_PATH,
+            webhook_url=f"{Config.WEBHOOK_URL.rstrip('/')}/{Config.WEBHOOK_PATH}",
+            secret_token=Config.WEBHOOK_SECRET_TOKEN,
+            max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        print("🤖 Бот WinWin запущен...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
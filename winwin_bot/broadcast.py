@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket на общий поток сообщений плюс интервал на один чат.
+
+    Telegram допускает около 30 сообщений в секунду от бота в целом и
+    около одного сообщения в секунду в один чат. После RetryAfter
+    выдача токенов приостанавливается для всех отправителей сразу.
+    """
+
+    def __init__(self, rate, burst, per_chat_interval):
+        self.rate = rate
+        self.capacity = burst
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = {}  # chat_id -> время, раньше которого писать нельзя
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, chat_id=None):
+        while True:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if chat_id is not None:
+                wait = max(wait, self._chat_next.get(chat_id, 0.0) - now)
+            if wait <= 0:
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if chat_id is not None:
+                        self._chat_next[chat_id] = now + self.per_chat_interval
+                        if len(self._chat_next) > 10000:
+                            self._prune(now)
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def _prune(self, now):
+        self._chat_next = {chat: t for chat, t in self._chat_next.items() if t > now}
+
+    def pause(self, seconds):
+        """Остановить выдачу токенов (ответ RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+class BroadcastEngine:
+    """Очередь рассылок с фоновым исполнителем.
+
+    Рассылки хранятся в таблице broadcasts и выполняются по одной.
+    Получатели читаются порциями по возрастанию user_id и отправляются
+    параллельно под RateLimiter. Каждая доставка пишется в
+    broadcast_deliveries, а после каждой порции сохраняется курсор. После
+    перезапуска рассылка продолжается с курсора, и тем, кто ее уже
+    получил, она повторно не отправляется. Пользователи, заблокировавшие
+    бота, помечаются неактивными и в следующие рассылки не попадают.
+    """
+
+    def __init__(self, db, config):
+        self.db = db
+        self.config = config
+        self.limiter = RateLimiter(
+            rate=config.BROADCAST_RATE,
+            burst=config.BROADCAST_BURST,
+            per_chat_interval=config.BROADCAST_PER_CHAT_INTERVAL
+        )
+        self._semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    async def start(self, admin_id, text, status_message_id):
+        """Поставить рассылку в очередь"""
+        total = await self.db.count_active_users()
+        broadcast_id = await self.db.create_broadcast(admin_id, text, status_message_id, total)
+        self._wakeup.set()
+        return broadcast_id
+
+    def run(self, bot):
+        """Запуск фонового исполнителя очереди рассылок"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._drain(bot))
+
+    async def stop(self):
+        """Остановить исполнителя (прогресс уже сохранен в базе)"""
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def _drain(self, bot):
+        # Первой берется рассылка, прерванная перезапуском
+        include_running = True
+        while True:
+            try:
+                broadcast_id = await self.db.claim_next_broadcast(include_running)
+            except Exception as e:
+                logger.error(f"Ошибка очереди рассылок: {e}")
+                broadcast_id = None
+            include_running = False
+
+            if broadcast_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.config.BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(bot, broadcast_id)
+
+    async def _run(self, bot, broadcast_id):
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        _, admin_id, status_message_id, text, _, last_user_id = broadcast[:6]
+        total = broadcast[8]
+        counts = await self.db.get_broadcast_delivery_counts(broadcast_id)
+        sent = counts.get('SENT', 0)
+        failed = counts.get('FAILED', 0) + counts.get('BLOCKED', 0)
+        if last_user_id:
+            logger.info(f"Продолжаю рассылку #{broadcast_id} с пользователя {last_user_id}")
+        last_report = 0.0
+
+        try:
+            while True:
+                user_ids = await self.db.get_broadcast_recipients(
+                    broadcast_id, last_user_id, self.config.BROADCAST_CHUNK_SIZE
+                )
+                if not user_ids:
+                    break
+
+                results = await asyncio.gather(
+                    *(self._deliver(bot, broadcast_id, user_id, text) for user_id in user_ids)
+                )
+                sent += sum(results)
+                failed += len(results) - sum(results)
+                last_user_id = user_ids[-1]
+                await self.db.update_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+
+                if time.monotonic() - last_report >= self.config.BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(
+                        bot, admin_id, status_message_id,
+                        f"⏳ Рассылка #{broadcast_id}\n\n"
+                        f"✅ Успешно: {sent}\n"
+                        f"❌ Не удалось: {failed}\n"
+                        f"👥 Всего: {total}"
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Рассылка #{broadcast_id} прервана: {e}")
+            await self.db.finish_broadcast(broadcast_id, 'FAILED')
+            await self._report(bot, admin_id, status_message_id, f"❌ Рассылка #{broadcast_id} прервана: {e}")
+            return
+
+        await self.db.finish_broadcast(broadcast_id)
+        await self._report(
+            bot, admin_id, status_message_id,
+            f"✅ Рассылка #{broadcast_id} завершена!\n\n"
+            f"✅ Успешно: {sent}\n"
+            f"❌ Не удалось: {failed}\n"
+            f"👥 Всего: {total}"
+        )
+
+    async def _deliver(self, bot, broadcast_id, user_id, text):
+        """Отправка одному получателю и запись в журнал; True - доставлено"""
+        status, error = await self._send(bot, user_id, text)
+        await self.db.add_broadcast_delivery(broadcast_id, user_id, status, error)
+        if status == 'BLOCKED':
+            await self.db.deactivate_user(user_id)
+        return status == 'SENT'
+
+    async def _send(self, bot, chat_id, text):
+        """Отправка с учетом лимитов: (статус, ошибка)"""
+        async with self._semaphore:
+            error = None
+            for attempt in range(self.config.BROADCAST_MAX_RETRIES):
+                await self.limiter.acquire(chat_id)
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN_V2)
+                    return 'SENT', None
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning(f"Лимит Telegram при рассылке, пауза {retry_after} с")
+                    self.limiter.pause(retry_after)
+                    error = str(e)
+                except Forbidden as e:
+                    return 'BLOCKED', str(e)
+                except BadRequest as e:
+                    if 'chat not found' in str(e).lower():
+                        return 'BLOCKED', str(e)
+                    logger.error(f"Не удалось отправить рассылку пользователю {chat_id}: {e}")
+                    return 'FAILED', str(e)
+                except (TimedOut, NetworkError) as e:
+                    logger.warning(f"Сетевая ошибка рассылки пользователю {chat_id}: {e}")
+                    error = str(e)
+                    await asyncio.sleep(2 ** attempt)
+                except TelegramError as e:
+                    logger.error(f"Не удалось отправить рассылку пользователю {chat_id}: {e}")
+                    return 'FAILED', str(e)
+            return 'FAILED', error
+
+    async def _report(self, bot, admin_id, status_message_id, text):
+        """Обновление сообщения администратора о ходе рассылки"""
+        if not status_message_id:
+            return
+        await self.limiter.acquire(admin_id)
+        try:
+            await bot.edit_message_text(chat_id=admin_id, message_id=status_message_id, text=text)
+        except BadRequest:
+            pass  # текст не изменился или сообщение удалено
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
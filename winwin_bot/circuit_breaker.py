@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import deque
+
+from metrics import REGISTRY, percentile
+
+logger = logging.getLogger(__name__)
+
+BREAKER_TRANSITIONS = REGISTRY.counter(
+    'winwin_api_breaker_transitions_total', 'Переключения автоматов запросов к SofiaCash', ['method', 'state']
+)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# Значение состояния для метрики
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Автомат разомкнут: запрос не отправлялся"""
+
+    def __init__(self, method, retry_after):
+        super().__init__(f"SofiaCash {method} временно недоступен, повтор через {retry_after:.0f} с")
+        self.method = method
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автомат и адаптивный таймаут для одного метода API.
+
+    Ошибки (таймаут, обрыв, 5xx) и медленные ответы (дольше
+    API_BREAKER_SLOW_CALL) считаются подряд; после
+    API_BREAKER_FAILURES таких вызовов автомат размыкается, и запросы
+    сразу получают CircuitOpenError. Через время размыкания пропускается
+    пробный запрос (half-open): успех замыкает автомат, ошибка снова
+    размыкает его на вдвое больший срок (не больше API_BREAKER_OPEN_MAX).
+
+    Таймаут запроса - p99 последних успешных ответов, умноженный на
+    API_TIMEOUT_MULTIPLIER, в пределах от min_timeout до API_TIMEOUT.
+    Пока замеров мало, действует API_TIMEOUT.
+    """
+
+    def __init__(self, method, config, min_timeout):
+        self.method = method
+        self.config = config
+        self.min_timeout = min_timeout
+        self.state = CLOSED
+        self.failures = 0  # подряд
+        self.opened_at = None
+        self.open_seconds = config.API_BREAKER_OPEN_SECONDS
+        self._probes = 0
+        self._latencies = deque(maxlen=config.API_LATENCY_WINDOW)
+
+    def _switch(self, state):
+        if state != self.state:
+            logger.warning(f"SofiaCash {self.method}: автомат {self.state} -> {state}")
+            BREAKER_TRANSITIONS.inc(self.method, state)
+            self.state = state
+
+    def retry_after(self):
+        """Секунд до пробного запроса, если автомат разомкнут (иначе None)"""
+        if self.state != OPEN:
+            return None
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def before_request(self):
+        """Разрешение на запрос; при разомкнутом автомате - CircuitOpenError"""
+        if self.state == OPEN:
+            retry_after = self.retry_after()
+            if retry_after > 0:
+                raise CircuitOpenError(self.method, retry_after)
+            self._switch(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probes >= self.config.API_BREAKER_HALF_OPEN_PROBES:
+                raise CircuitOpenError(self.method, 0)
+            self._probes += 1
+            return True  # пробный запрос
+        return False
+
+    def cancel(self, probe):
+        """Запрос отменен до ответа - на состояние не влияет"""
+        if probe:
+            self._probes -= 1
+
+    def record(self, duration, ok, probe=False):
+        """Итог запроса: ok - ответ получен и это не 5xx"""
+        if probe:
+            self._probes -= 1
+        slow = duration > self.config.API_BREAKER_SLOW_CALL
+        if ok:
+            self._latencies.append(duration)
+        if ok and not slow:
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self.open_seconds = self.config.API_BREAKER_OPEN_SECONDS
+                self._switch(CLOSED)
+            return
+
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, self.config.API_BREAKER_OPEN_MAX)
+            self._open()
+        elif self.state == CLOSED and self.failures >= self.config.API_BREAKER_FAILURES:
+            self._open()
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._switch(OPEN)
+
+    def timeout(self):
+        """Таймаут следующего запроса по последним задержкам"""
+        if len(self._latencies) < self.config.API_LATENCY_MIN_SAMPLES:
+            return self.config.API_TIMEOUT
+        adaptive = percentile(self._latencies, 0.99) * self.config.API_TIMEOUT_MULTIPLIER
+        return min(self.config.API_TIMEOUT, max(self.min_timeout, adaptive))
+
+    def get_stats(self):
+        latencies = list(self._latencies)
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_after': self.retry_after(),
+            'timeout': self.timeout(),
+            'p50': percentile(latencies, 0.5) if latencies else None,
+            'p95': percentile(latencies, 0.95) if latencies else None
+        }
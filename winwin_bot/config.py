@@ -7,15 +7,82 @@ class Config:
     # Токен бота
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     
+    # Получение обновлений: polling или webhook
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+    WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')  # заголовок X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # соединений от Telegram
+    
+    # Параллельная обработка обновлений (порядок для одного пользователя сохраняется)
+    CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))  # одновременно работающих обработчиков
+    UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '1000'))  # обновлений в работе и ожидании
+    
+    # Метрики Prometheus (GET /metrics)
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))  # 0 - не запускать
+    TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '256'))  # соединений к Bot API
+    
     # Данные API SofiaCash
     API_HASH = os.getenv('API_HASH')
     API_CASHIERPASS = os.getenv('API_CASHIERPASS')
     API_CASHDESKID = os.getenv('API_CASHDESKID')
     API_LOGIN = os.getenv('API_LOGIN')
     API_BASE_URL = "https://partners.servcul.com/CashdeskBotAPI/"
+    API_TIMEOUT = float(os.getenv('API_TIMEOUT', '10'))  # секунд, верхняя граница адаптивного таймаута
+    
+    # Адаптивный таймаут: p99 последних ответов метода, умноженный на множитель
+    API_TIMEOUT_MULTIPLIER = float(os.getenv('API_TIMEOUT_MULTIPLIER', '3'))
+    API_TIMEOUT_MIN = float(os.getenv('API_TIMEOUT_MIN', '2'))  # секунд, для баланса и поиска игрока
+    API_WRITE_TIMEOUT_MIN = float(os.getenv('API_WRITE_TIMEOUT_MIN', '5'))  # секунд, для зачислений и выплат
+    API_LATENCY_WINDOW = int(os.getenv('API_LATENCY_WINDOW', '200'))  # последних ответов
+    API_LATENCY_MIN_SAMPLES = int(os.getenv('API_LATENCY_MIN_SAMPLES', '20'))  # до этого - API_TIMEOUT
+    
+    # Автомат (circuit breaker) запросов к кассе
+    API_BREAKER_FAILURES = int(os.getenv('API_BREAKER_FAILURES', '5'))  # ошибок подряд до размыкания
+    API_BREAKER_SLOW_CALL = float(os.getenv('API_BREAKER_SLOW_CALL', '5'))  # секунд, медленнее - как ошибка
+    API_BREAKER_OPEN_SECONDS = float(os.getenv('API_BREAKER_OPEN_SECONDS', '30'))  # до пробного запроса
+    API_BREAKER_OPEN_MAX = float(os.getenv('API_BREAKER_OPEN_MAX', '300'))  # секунд, после неудачных проб
+    API_BREAKER_HALF_OPEN_PROBES = int(os.getenv('API_BREAKER_HALF_OPEN_PROBES', '1'))  # пробных запросов
+    
+    # Пул соединений к кассе
+    API_MAX_CONCURRENCY = int(os.getenv('API_MAX_CONCURRENCY', '10'))  # одновременных запросов
+    API_MAX_CONNECTIONS = int(os.getenv('API_MAX_CONNECTIONS', '20'))
+    API_MAX_KEEPALIVE = int(os.getenv('API_MAX_KEEPALIVE', '10'))
+    API_KEEPALIVE_EXPIRY = float(os.getenv('API_KEEPALIVE_EXPIRY', '60'))  # секунд
+    API_POOL_STATS_INTERVAL = int(os.getenv('API_POOL_STATS_INTERVAL', '300'))  # 0 - не логировать
+    
+    # Кеш поиска игроков
+    FIND_USER_CACHE_SIZE = int(os.getenv('FIND_USER_CACHE_SIZE', '1000'))  # записей
+    FIND_USER_CACHE_TTL = int(os.getenv('FIND_USER_CACHE_TTL', '120'))  # секунд
+    FIND_USER_NEGATIVE_TTL = int(os.getenv('FIND_USER_NEGATIVE_TTL', '15'))  # секунд для "не найден"
+    
+    # Баланс кассы
+    BALANCE_REFRESH_INTERVAL = int(os.getenv('BALANCE_REFRESH_INTERVAL', '60'))  # секунд
+    BALANCE_MAX_AGE = int(os.getenv('BALANCE_MAX_AGE', '30'))  # секунд, старше - запрос в API
+    
+    # База данных
+    DB_READERS = int(os.getenv('DB_READERS', '4'))  # потоков для чтения
+    DB_PROFILE = os.getenv('DB_PROFILE', 'balanced')  # legacy, balanced, durable, fast
+    DB_GROUP_COMMIT_WINDOW = float(os.getenv('DB_GROUP_COMMIT_WINDOW', '5'))  # мс ожидания попутных записей
+    DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv('DB_GROUP_COMMIT_MAX_BATCH', '200'))  # операций в транзакции
+    # commit - каждая запись ждет коммита; queued - второстепенные записи
+    # (id сообщений) не ждут коммита и могут потеряться при падении процесса
+    DB_WRITE_DURABILITY = os.getenv('DB_WRITE_DURABILITY', 'commit')
+    
+    # Хранение состояния диалогов и user_data
+    PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'sqlite')  # sqlite, memory - только в памяти
+    PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '5'))  # секунд
+    # 1 - перечитывать user_data, записанные другими процессами бота
+    # (состояния диалогов читаются только при запуске и так не обновляются)
+    PERSISTENCE_SHARED = os.getenv('PERSISTENCE_SHARED', '0') == '1'
     
     # Админы (через запятую)
     ADMINS = [int(admin_id) for admin_id in os.getenv('ADMINS', '').split(',') if admin_id]
+    ADMIN_FANOUT_CONCURRENCY = int(os.getenv('ADMIN_FANOUT_CONCURRENCY', '10'))  # одновременных отправок админам
     
     # Канал для уведомлений
     NOTIFICATION_CHANNEL = os.getenv('NOTIFICATION_CHANNEL', '')
@@ -23,14 +90,59 @@ class Config:
     # Ссылка на поддержку
     SUPPORT_USERNAME = os.getenv('SUPPORT_USERNAME', '@WinWinSupport')
     
+    # Рассылка (лимиты Telegram: ~30 сообщений/с всего, ~1/с в один чат)
+    BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # сообщений в секунду
+    BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', '25'))
+    BROADCAST_PER_CHAT_INTERVAL = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', '1'))  # секунд
+    BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '25'))  # одновременных отправок
+    BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))  # получателей за порцию
+    BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+    BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))  # секунд
+    BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', '30'))  # проверка очереди, секунд
+    
+    # Размер страницы в списках депозитов
+    DEPOSITS_PAGE_SIZE = int(os.getenv('DEPOSITS_PAGE_SIZE', '10'))
+    
     # Настройки времени
     DEPOSIT_TIMEOUT = 600  # 10 минут в секундах
+    DEPOSIT_EXPIRY_BATCH = int(os.getenv('DEPOSIT_EXPIRY_BATCH', '100'))  # отмен за транзакцию
+    DEPOSIT_EXPIRY_MAX_SLEEP = int(os.getenv('DEPOSIT_EXPIRY_MAX_SLEEP', '60'))  # секунд
+    
+    # Зачисление депозитов через очередь credit_outbox
+    CREDIT_WORKERS = int(os.getenv('CREDIT_WORKERS', '4'))  # одновременных зачислений
+    CREDIT_MAX_ATTEMPTS = int(os.getenv('CREDIT_MAX_ATTEMPTS', '5'))
+    CREDIT_BACKOFF_BASE = float(os.getenv('CREDIT_BACKOFF_BASE', '2'))  # секунд, удваивается с каждой попыткой
+    CREDIT_BACKOFF_MAX = float(os.getenv('CREDIT_BACKOFF_MAX', '300'))  # секунд
+    CREDIT_LEASE = float(os.getenv('CREDIT_LEASE', '120'))  # секунд на попытку, потом ее подхватит другой воркер
+    # секунд, наибольшая пауза перед сверкой неясного зачисления (не больше четверти CREDIT_LEASE)
+    CREDIT_RECONCILE_HOLD = float(os.getenv('CREDIT_RECONCILE_HOLD', '10'))
+    CREDIT_POLL_INTERVAL = float(os.getenv('CREDIT_POLL_INTERVAL', '30'))  # секунд
+    CREDIT_BALANCE_TOLERANCE = float(os.getenv('CREDIT_BALANCE_TOLERANCE', '0.01'))  # ₽ при сверке баланса кассы
+    
+    # Выплаты по заявкам на вывод (очередь withdrawals)
+    PAYOUT_CONCURRENCY = int(os.getenv('PAYOUT_CONCURRENCY', '2'))  # одновременных выплат на кассу
+    PAYOUT_MAX_ATTEMPTS = int(os.getenv('PAYOUT_MAX_ATTEMPTS', '5'))
+    PAYOUT_BACKOFF_BASE = float(os.getenv('PAYOUT_BACKOFF_BASE', '2'))  # секунд, удваивается с каждой попыткой
+    PAYOUT_BACKOFF_MAX = float(os.getenv('PAYOUT_BACKOFF_MAX', '300'))  # секунд
+    PAYOUT_LEASE = float(os.getenv('PAYOUT_LEASE', '120'))  # секунд на попытку
+    PAYOUT_POLL_INTERVAL = float(os.getenv('PAYOUT_POLL_INTERVAL', '30'))  # секунд
+    PAYOUT_DIGEST_INTERVAL = float(os.getenv('PAYOUT_DIGEST_INTERVAL', '300'))  # секунд между сводками админам
+    PAYOUT_DIGEST_LIMIT = int(os.getenv('PAYOUT_DIGEST_LIMIT', '50'))  # выплат в одной сводке
+    
+    # Трассировка депозитов: по скольким последним депозитам считать /trace
+    TRACE_STATS_DEPOSITS = int(os.getenv('TRACE_STATS_DEPOSITS', '100'))
+    
+    # Проверка открытых депозитов при запуске
+    RECOVERY_TIMEOUT = float(os.getenv('RECOVERY_TIMEOUT', '30'))  # секунд
+    RECOVERY_SAMPLE_SIZE = int(os.getenv('RECOVERY_SAMPLE_SIZE', '5'))  # депозитов каждого статуса в сводке
     
     # Статусы депозитов
     DEPOSIT_STATUS = {
         'PENDING': 'ожидает оплаты',
+        'ASSIGNED': 'взят администратором',
         'PAID': 'оплачен',
         'PROCESSING': 'в обработке',
+        'CREDITING': 'зачисляется',
         'COMPLETED': 'завершен',
         'CANCELLED': 'отменен'
     }
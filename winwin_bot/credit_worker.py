@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CREDIT_OUTCOMES = REGISTRY.counter(
+    'winwin_credit_outcomes_total', 'Исходы попыток зачисления депозитов', ['outcome']
+)
+
+# Поля строки credit_outbox
+JOB_DEPOSIT_ID, JOB_USER_ID, JOB_AMOUNT, JOB_ADMIN_ID, JOB_STATUS, JOB_ATTEMPTS = range(6)
+JOB_BALANCE_BEFORE, JOB_BALANCE_AT, JOB_ATTEMPT_STARTED_AT = 8, 9, 10
+JOB_RECONCILE_ATTEMPTS = 15
+
+# Больше неясных зачислений рядом - сверка не перебирает варианты
+MAX_UNCERTAIN_CREDITS = 12
+
+
+class CashdeskGate:
+    """Операции с кассой идут параллельно, сверка баланса - в одиночку.
+
+    Сверка сравнивает баланс кассы с базовым значением до попытки, и
+    одновременные зачисления исказили бы разницу. Ожидающая сверка
+    не пропускает вперед новые операции, чтобы не ждать бесконечно.
+    """
+
+    def __init__(self):
+        self._active = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self, hold=0):
+        """Единоличный доступ; hold - сколько секунд выждать, уже не пуская новые операции"""
+        async with self._condition:
+            self._exclusive_waiting += 1
+        try:
+            if hold:
+                await asyncio.sleep(hold)
+            async with self._condition:
+                await self._condition.wait_for(lambda: not self._exclusive and not self._active)
+                self._exclusive = True
+        finally:
+            async with self._condition:
+                self._exclusive_waiting -= 1
+                self._condition.notify_all()
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+class DepositCreditWorker:
+    """Зачисление депозитов из очереди credit_outbox.
+
+    Запись о зачислении создается вместе с переходом депозита в
+    CREDITING, а сам запрос deposit_to_user выполняет пул из
+    CREDIT_WORKERS фоновых задач с экспоненциальной задержкой и
+    случайным разбросом между попытками.
+
+    Если исход запроса неясен (таймаут, 5xx), зачисление не повторяется
+    вслепую: сначала баланс кассы сравнивается с запомненным перед
+    попыткой. Подтвержденные зачисления,
+    начатые после этой попытки, вычитаются, а для пересекавшихся с ней
+    или тоже неясных перебираются оба варианта. Если все варианты,
+    объясняющие изменение баланса, согласны - зачисление прошло или его
+    можно повторить; иначе оно отдается администраторам на ручную
+    проверку: лучше задержать зачисление, чем зачислить дважды.
+    """
+
+    def __init__(self, db, api, balance, tracer, config, on_settled, transitions):
+        self.db = db
+        self.api = api
+        self.balance = balance
+        self.tracer = tracer
+        self.config = config
+        self.on_settled = on_settled  # корутина (bot, job, status, result)
+        self.transitions = transitions  # исход -> (из статусов, в статус) депозита
+        self.gate = CashdeskGate()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self._bot = None
+
+    def start(self, bot):
+        if self._task is None:
+            self._bot = bot
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Прерванные попытки останутся in_flight и будут сверены после запуска
+        tasks = list(self._running)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def arm(self):
+        """Сообщить о новом зачислении в очереди"""
+        self._wakeup.set()
+
+    def get_stats(self):
+        return {'running': len(self._running), 'workers': self.config.CREDIT_WORKERS}
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            free = self.config.CREDIT_WORKERS - len(self._running)
+            if free <= 0:
+                # Слот освободится по завершении попытки
+                await self._wakeup.wait()
+                continue
+
+            try:
+                for job in await self.db.claim_credit_jobs(free, self.config.CREDIT_LEASE):
+                    task = asyncio.create_task(self._process_safe(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._on_done)
+                delay = await self.db.seconds_until_next_credit()
+            except Exception as e:
+                logger.error(f"Ошибка очереди зачислений: {e}")
+                delay = None
+
+            timeout = self.config.CREDIT_POLL_INTERVAL
+            if delay is not None:
+                timeout = min(max(delay, 0), timeout)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, task):
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def _process_safe(self, job):
+        try:
+            await self._process(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Аренда истечет, и зачисление будет взято снова
+            logger.error(f"Ошибка зачисления депозита #{job[JOB_DEPOSIT_ID]}: {e}")
+
+    async def _process(self, job):
+        deposit_id, user_id, amount = job[JOB_DEPOSIT_ID], job[JOB_USER_ID], job[JOB_AMOUNT]
+        attempts = job[JOB_ATTEMPTS]
+
+        if job[JOB_STATUS] in ('unknown', 'in_flight') and not await self._resolve(job):
+            return
+
+        if attempts >= self.config.CREDIT_MAX_ATTEMPTS:
+            await self._settle(job, 'failed', {'success': False, 'error': 'Исчерпаны попытки зачисления'})
+            return
+
+        # Пока автомат кассы разомкнут, попытки не тратятся
+        retry_after = self.api.retry_after('deposit')
+        if retry_after:
+            await self._retry(job, 'pending', 'SofiaCash временно недоступен', delay=retry_after)
+            return
+
+        # Проверка по кешу баланса (Balance - сколько касса может зачислить),
+        # только если он свежий: заведомо непосильное зачисление не занимает
+        # кассу. Запроса здесь нет - свежий баланс все равно запрашивается ниже
+        if self.balance.is_fresh() and amount > self.balance.data['Balance']:
+            await self._settle(job, 'failed', {'success': False, 'error': 'Недостаточно средств в кассе'})
+            return
+
+        async with self.gate.shared():
+            # Базовый баланс для сверки - только свежий запрос, не из кеша
+            balance_at = time.time()
+            data = await self.api.get_balance()
+            if not data or 'Balance' not in data:
+                await self._retry(job, 'pending', 'баланс кассы недоступен')
+                return
+            if amount > data['Balance']:
+                await self._settle(job, 'failed', {'success': False, 'error': 'Недостаточно средств в кассе'})
+                return
+
+            # Базовый баланс фиксируется до запроса: по нему сверяется неясный исход
+            await self.db.record_credit_attempt(deposit_id, data['Balance'], balance_at)
+            started_at, started = time.time(), time.perf_counter()
+            result = await self.api.deposit_to_user(user_id, amount)
+            finished_at = time.time()
+            await self.tracer.record(
+                deposit_id, 'deposit_to_user', started_at, time.perf_counter() - started, result['success']
+            )
+        self.balance.invalidate()
+
+        if result['success']:
+            await self._settle(job, 'done', result, finished_at)
+        elif result.get('ambiguous'):
+            await self.db.mark_credit_unknown(deposit_id, result.get('error'), finished_at)
+            job = await self.db.get_credit_job(deposit_id)
+            # Сверка сразу после паузы, пока новые попытки ждут: так рядом
+            # меньше зачислений с неясным вкладом в баланс кассы. Пауза идет
+            # в счет аренды, поэтому она ограничена CREDIT_RECONCILE_HOLD
+            hold = min(self._backoff(attempts + 1), self.config.CREDIT_RECONCILE_HOLD)
+            if await self._resolve(job, hold=hold):
+                await self._retry(job, 'pending', result.get('error'), attempts + 1)
+        elif result.get('retryable'):
+            await self._retry(job, 'pending', result.get('error'), attempts + 1, finished_at)
+        else:
+            await self._settle(job, 'failed', result, finished_at)
+
+    async def _resolve(self, job, hold=0):
+        """Сверка неясного исхода; True - зачисления не было, можно повторять"""
+        verdict = await self._reconcile(job, hold)
+        logger.info(f"Сверка зачисления депозита #{job[JOB_DEPOSIT_ID]}: {verdict}")
+        if verdict == 'credited':
+            await self._settle(job, 'done', {'success': True, 'amount': job[JOB_AMOUNT], 'reconciled': True})
+            return False
+        # Неудавшиеся сверки считаются отдельно от попыток зачисления: пока
+        # касса не отвечает, сверка повторяется с растущей паузой, а после
+        # CREDIT_MAX_ATTEMPTS неудач зачисление уходит на ручную проверку
+        failures = job[JOB_RECONCILE_ATTEMPTS] + (verdict is None)
+        if verdict == 'mismatch' or (verdict is None and (
+            job[JOB_ATTEMPTS] >= self.config.CREDIT_MAX_ATTEMPTS or failures >= self.config.CREDIT_MAX_ATTEMPTS
+        )):
+            await self._settle(job, 'manual', {
+                'success': False, 'error': 'Не удалось определить, прошло ли зачисление'
+            })
+            return False
+        if verdict is None:
+            await self._retry(job, 'unknown', 'сверка не удалась', failures, reconcile_failed=True)
+            return False
+        return True
+
+    async def _reconcile(self, job, hold=0):
+        """Прошло ли зачисление с неясным исходом.
+
+        hold - пауза перед сверкой (касса могла еще не обработать запрос),
+        на время которой новые попытки не начинаются. Возвращает
+        'credited', 'not_credited', 'mismatch' или None - проверить не удалось.
+        """
+        deposit_id, amount = job[JOB_DEPOSIT_ID], job[JOB_AMOUNT]
+        balance_before = job[JOB_BALANCE_BEFORE]
+        if balance_before is None:
+            return 'not_credited'
+
+        async with self.gate.exclusive(hold):
+            data = await self.api.get_balance()
+            if not data or 'Balance' not in data:
+                return None
+            others = await self.db.get_credit_attempts_since(job[JOB_BALANCE_AT], deposit_id)
+
+        # Зачисления и выплаты, закончившиеся до запроса базового баланса,
+        # в нем уже учтены (их нет в others). Прошедшие и начатые после этой
+        # попытки изменили баланс уже после него. Вклад остальных (неясный
+        # исход или пересечение с запросом базового баланса) - 0 или их сумма.
+        certain = 0.0
+        uncertain = []
+        for status, other_amount, other_started_at in others:
+            if other_amount is None:
+                return 'mismatch'  # выплата с неясной суммой
+            if status == 'done' and other_started_at > job[JOB_ATTEMPT_STARTED_AT]:
+                certain += other_amount
+            else:
+                uncertain.append(other_amount)
+        if len(uncertain) > MAX_UNCERTAIN_CREDITS:
+            return 'mismatch'
+
+        possible = {0.0}
+        for other_amount in uncertain:
+            possible |= {round(total + other_amount, 2) for total in possible}
+
+        # Вывод делается, только если все подходящие варианты согласны
+        change = balance_before - data['Balance'] - certain
+        tolerance = self.config.CREDIT_BALANCE_TOLERANCE
+        credited = any(abs(change - amount - total) <= tolerance for total in possible)
+        not_credited = any(abs(change - total) <= tolerance for total in possible)
+        if credited != not_credited:
+            return 'credited' if credited else 'not_credited'
+        logger.warning(
+            f"Сверка депозита #{deposit_id}: баланс кассы изменился на {change:.2f} "
+            f"(сумма {amount:.2f}, неясных зачислений рядом: {len(uncertain)})"
+        )
+        return 'mismatch'
+
+    def _backoff(self, attempts):
+        """Экспоненциальная задержка с разбросом (половина фиксирована, половина случайна)"""
+        delay = min(self.config.CREDIT_BACKOFF_MAX, self.config.CREDIT_BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _retry(self, job, status, error, attempts=None, finished_at=None, delay=None, reconcile_failed=False):
+        backoff = self._backoff(job[JOB_ATTEMPTS] if attempts is None else attempts)
+        delay = backoff if delay is None else max(delay, backoff)
+        CREDIT_OUTCOMES.inc('retry_' + status)
+        logger.warning(
+            f"Зачисление депозита #{job[JOB_DEPOSIT_ID]} будет повторено через {delay:.1f} с: {error}"
+        )
+        await self.db.reschedule_credit(job[JOB_DEPOSIT_ID], status, delay, error, finished_at, reconcile_failed)
+        self.arm()
+
+    async def _settle(self, job, status, result, finished_at=None):
+        CREDIT_OUTCOMES.inc(status)
+        await self.db.settle_credit(
+            job[JOB_DEPOSIT_ID], status, result.get('error'), self.transitions.get(status), finished_at
+        )
+        try:
+            await self.on_settled(self._bot, job, status, result)
+        except Exception as e:
+            logger.error(f"Ошибка уведомления о зачислении депозита #{job[JOB_DEPOSIT_ID]}: {e}")
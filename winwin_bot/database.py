@@ -1,17 +1,66 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
 import sqlite3
 import datetime
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from metrics import DB_SECONDS, DB_BATCH_SECONDS, DEPOSIT_TRANSITIONS
 
-class Database:
-    def __init__(self, db_name='winwin_bot.db'):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
-    
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Таблица депозитов
-        cursor.execute('''
+logger = logging.getLogger(__name__)
+
+# Профили хранения: PRAGMA соединения и размер кеша подготовленных запросов
+STORAGE_PROFILES = {
+    # Настройки SQLite по умолчанию (как было раньше)
+    'legacy': {
+        'pragmas': {},
+        'cached_statements': 128
+    },
+    # WAL + synchronous=NORMAL: коммит без fsync, целостность при падении процесса
+    'balanced': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -16000,  # ~16 МБ
+            'mmap_size': 64 * 1024 * 1024,
+            'temp_store': 'MEMORY'
+        },
+        'cached_statements': 256
+    },
+    # WAL + synchronous=FULL: каждый коммит переживает и отключение питания
+    'durable': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'cache_size': -16000,
+            'mmap_size': 0,
+            'temp_store': 'MEMORY'
+        },
+        'cached_statements': 256
+    },
+    # Без fsync вообще: только для тестов и тяжелых разовых загрузок
+    'fast': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'OFF',
+            'cache_size': -64000,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY'
+        },
+        'cached_statements': 512
+    }
+}
+
+# Миграции схемы: (версия, описание, SQL-запросы).
+# Применяются по порядку при запуске; уже примененные хранятся в schema_migrations.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (1, 'Базовые таблицы', [
+        '''
             CREATE TABLE IF NOT EXISTS deposits (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
@@ -26,10 +75,8 @@ class Database:
                 processed_at TIMESTAMP,
                 admin_id INTEGER
             )
-        ''')
-        
-        # Таблица пользователей
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -39,75 +86,726 @@ class Database:
                 last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
-        
-        # Таблица административных сообщений
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS admin_messages (
                 message_id INTEGER PRIMARY KEY,
                 deposit_id INTEGER,
                 admin_id INTEGER,
                 FOREIGN KEY (deposit_id) REFERENCES deposits (id)
             )
+        '''
+    ]),
+    (2, 'Индексы для списков депозитов', [
+        'CREATE INDEX IF NOT EXISTS idx_deposits_status_created ON deposits (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_deposits_user_created ON deposits (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_admin_messages_deposit ON admin_messages (deposit_id)'
+    ]),
+    (3, 'Рассылки с сохраняемым курсором', [
+        '''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                status_message_id INTEGER,
+                text TEXT NOT NULL,
+                status TEXT DEFAULT 'RUNNING',
+                last_user_id INTEGER DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                total_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)'
+    ]),
+    (4, 'Журнал доставки рассылок и неактивные пользователи', [
+        'ALTER TABLE users ADD COLUMN is_active INTEGER DEFAULT 1',
+        'CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE is_active = 1',
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    (5, 'Срок оплаты депозитов', [
+        'ALTER TABLE deposits ADD COLUMN expires_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS idx_deposits_status_expires ON deposits (status, expires_at)'
+    ]),
+    (6, 'Хранилище состояния диалогов и user_data', [
+        '''
+            CREATE TABLE IF NOT EXISTS persistence_user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS persistence_conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    (7, 'Трассировка этапов депозита', [
+        'ALTER TABLE deposits ADD COLUMN trace_id TEXT',
+        '''
+            CREATE TABLE IF NOT EXISTS deposit_spans (
+                deposit_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                duration_ms REAL NOT NULL,
+                ok INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (deposit_id, started_at, stage)
+            ) WITHOUT ROWID
+        '''
+    ]),
+    # message_id уникален только в пределах чата, поэтому ключ - (admin_id, message_id)
+    (8, 'Сообщения всех администраторов по депозиту', [
+        '''
+            CREATE TABLE admin_messages_new (
+                admin_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                deposit_id INTEGER NOT NULL,
+                kind TEXT NOT NULL DEFAULT 'text',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (admin_id, message_id),
+                FOREIGN KEY (deposit_id) REFERENCES deposits (id)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            INSERT OR IGNORE INTO admin_messages_new (admin_id, message_id, deposit_id)
+            SELECT admin_id, message_id, deposit_id FROM admin_messages
+            WHERE admin_id IS NOT NULL AND deposit_id IS NOT NULL
+        ''',
+        'DROP TABLE admin_messages',
+        'ALTER TABLE admin_messages_new RENAME TO admin_messages',
+        'CREATE INDEX IF NOT EXISTS idx_admin_messages_deposit ON admin_messages (deposit_id)'
+    ]),
+    # Зачисления в кассу: запись создается в одной транзакции с переходом
+    # в CREDITING и ведет попытки (время - unix time)
+    (9, 'Очередь зачислений депозитов', [
+        '''
+            CREATE TABLE credit_outbox (
+                deposit_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                admin_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_until REAL,
+                balance_before REAL,
+                balance_at REAL,
+                attempt_started_at REAL,
+                attempt_finished_at REAL,
+                settled_at REAL,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (deposit_id) REFERENCES deposits (id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_credit_outbox_status_next ON credit_outbox (status, next_attempt_at)'
+    ]),
+    # Выводы: заявка игрока и очередь выплат в одной таблице (время - unix time).
+    # Код выплаты одноразовый, поэтому (user_id, code) уникален
+    (10, 'Заявки на вывод и очередь выплат', [
+        '''
+            CREATE TABLE withdrawals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                code TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                amount REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                uncertain INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_until REAL,
+                attempt_started_at REAL,
+                attempt_finished_at REAL,
+                settled_at REAL,
+                user_message_id INTEGER,
+                last_error TEXT,
+                notified INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (user_id, code)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_status_next ON withdrawals (status, next_attempt_at)'
+    ]),
+    # Неудавшиеся сверки неясной попытки зачисления (сбрасываются новой попыткой)
+    (11, 'Счетчик сверок зачислений', [
+        'ALTER TABLE credit_outbox ADD COLUMN reconcile_attempts INTEGER NOT NULL DEFAULT 0'
+    ])
+]
+
+class Database:
+    def __init__(self, db_name='winwin_bot.db', migrate=True, profile=None):
+        self.profile = profile or Config.DB_PROFILE
+        settings = STORAGE_PROFILES[self.profile]
+        self.conn = sqlite3.connect(
+            db_name,
+            check_same_thread=False,
+            cached_statements=settings['cached_statements']
+        )
+        # Транзакции открываются явно через transaction()
+        self.conn.isolation_level = None
+        self._transaction_depth = 0
+        for pragma, value in settings['pragmas'].items():
+            self.conn.execute(f"PRAGMA {pragma} = {value}")
+        if migrate:
+            self.apply_migrations()
+    
+    def apply_migrations(self):
+        """Применение недостающих миграций схемы (идемпотентно)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
         ''')
         
-        self.conn.commit()
+        for version, description, statements in MIGRATIONS:
+            if version <= self.get_schema_version():
+                continue
+            
+            # BEGIN IMMEDIATE: второй процесс дождется блокировки записи,
+            # а читатели в режиме WAL продолжают работать во время миграции
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,))
+                if cursor.fetchone():
+                    self.conn.rollback()
+                    continue
+                started = time.perf_counter()
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    'INSERT INTO schema_migrations (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                logger.exception(f"Ошибка миграции {version}: {description}")
+                raise
+            
+            logger.info(f"Применена миграция {version}: {description} ({time.perf_counter() - started:.2f} с)")
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи; вложенные вызовы становятся SAVEPOINT внешней.
+        
+        Благодаря этому методы записи можно выполнять пачкой в одной
+        транзакции (групповой коммит), и ошибка одного из них откатывает
+        только его собственные изменения.
+        """
+        depth = self._transaction_depth
+        self.conn.execute('BEGIN' if depth == 0 else f'SAVEPOINT sp{depth}')
+        self._transaction_depth += 1
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            self._transaction_depth -= 1
+            if depth == 0:
+                self.conn.execute('ROLLBACK')
+            else:
+                self.conn.execute(f'ROLLBACK TO sp{depth}')
+                self.conn.execute(f'RELEASE sp{depth}')
+            raise
+        else:
+            self._transaction_depth -= 1
+            self.conn.execute('COMMIT' if depth == 0 else f'RELEASE sp{depth}')
     
-    def add_deposit(self, user_id, username, amount):
+    def get_schema_version(self):
         cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO deposits (user_id, username, amount, status)
-            VALUES (?, ?, ?, 'PENDING')
-        ''', (user_id, username, amount))
-        self.conn.commit()
-        return cursor.lastrowid
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        return cursor.fetchone()[0]
+    
+    def add_deposit(self, user_id, username, amount, trace_id=None):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO deposits (user_id, username, amount, status, trace_id)
+                VALUES (?, ?, ?, 'PENDING', ?)
+            ''', (user_id, username, amount, trace_id))
+            return cursor.lastrowid
+    
+    def set_user_message_id(self, deposit_id, message_id):
+        with self.transaction() as cursor:
+            cursor.execute(
+                "UPDATE deposits SET user_message_id = ? WHERE id = ?",
+                (message_id, deposit_id)
+            )
+    
+    def add_admin_messages(self, deposit_id, messages):
+        """Сообщения администраторам о депозите: [(admin_id, message_id, kind), ...]"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO admin_messages (admin_id, message_id, deposit_id, kind)
+                VALUES (?, ?, ?, ?)
+            ''', [(admin_id, message_id, deposit_id, kind) for admin_id, message_id, kind in messages])
+    
+    def get_admin_messages(self, deposit_id):
+        """[(admin_id, message_id, kind), ...] по депозиту"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT admin_id, message_id, kind FROM admin_messages WHERE deposit_id = ?',
+            (deposit_id,)
+        )
+        return cursor.fetchall()
     
     def get_deposit(self, deposit_id):
         cursor = self.conn.cursor()
         cursor.execute('SELECT * FROM deposits WHERE id = ?', (deposit_id,))
         return cursor.fetchone()
     
-    def update_deposit_status(self, deposit_id, status, admin_id=None, payment_details=None):
+    def transition_deposit(self, deposit_id, from_statuses, to_status, owner_id=None, admin_id=None,
+                           payment_details=None, receipt_file_id=None, expires_in=None):
+        """Атомарная смена статуса (compare-and-set).
+        
+        Статус меняется одним условным UPDATE, только если депозит в
+        одном из from_statuses (и, если задан owner_id, взят этим
+        администратором), поэтому из одновременных переходов выигрывает
+        один. Срок оплаты выставляется через expires_in и сбрасывается
+        при любом другом переходе. Возвращает предыдущий статус или
+        None, если переход не выполнен.
+        """
+        placeholders = ', '.join('?' * len(from_statuses))
+        owner_clause = ' AND admin_id = ?' if owner_id is not None else ''
+        with self.transaction() as cursor:
+            # Предыдущий статус нужен только для метрик переходов
+            cursor.execute('SELECT status FROM deposits WHERE id = ?', (deposit_id,))
+            row = cursor.fetchone()
+            cursor.execute(f'''
+                UPDATE deposits
+                SET status = ?,
+                    admin_id = COALESCE(?, admin_id),
+                    payment_details = COALESCE(?, payment_details),
+                    receipt_file_id = COALESCE(?, receipt_file_id),
+                    expires_at = datetime('now', ?),
+                    processed_at = CASE WHEN ? = 'COMPLETED' THEN CURRENT_TIMESTAMP ELSE processed_at END
+                WHERE id = ? AND status IN ({placeholders}){owner_clause}
+            ''', (
+                to_status, admin_id, payment_details, receipt_file_id,
+                f'+{int(expires_in)} seconds' if expires_in is not None else None,
+                to_status, deposit_id, *from_statuses,
+                *((owner_id,) if owner_id is not None else ())
+            ))
+            if cursor.rowcount != 1:
+                return None
+            return row[0]
+    
+    def start_deposit_credit(self, deposit_id, from_statuses, to_status, admin_id):
+        """Переход в CREDITING и запись зачисления в credit_outbox одной транзакцией.
+        
+        Возвращает предыдущий статус или None, если переход не выполнен.
+        """
+        with self.transaction() as cursor:
+            previous = self.transition_deposit(deposit_id, from_statuses, to_status, admin_id=admin_id)
+            if previous is None:
+                return None
+            cursor.execute('''
+                INSERT OR REPLACE INTO credit_outbox (deposit_id, user_id, amount, admin_id, status, next_attempt_at)
+                SELECT id, user_id, amount, ?, 'pending', ? FROM deposits WHERE id = ?
+            ''', (admin_id, time.time(), deposit_id))
+            return previous
+    
+    def claim_credit_jobs(self, limit, lease):
+        """Захват зачислений, срок попытки которых наступил.
+        
+        Захват - аренда на lease секунд одним UPDATE, поэтому зачисление
+        не возьмут два воркера (или два процесса); после падения процесса
+        аренда истекает, и зачисление подхватывается снова.
+        """
+        now = time.time()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE credit_outbox SET claimed_until = ?
+                WHERE deposit_id IN (
+                    SELECT deposit_id FROM credit_outbox
+                    WHERE status IN ('pending', 'unknown', 'in_flight')
+                      AND next_attempt_at <= ?
+                      AND (claimed_until IS NULL OR claimed_until < ?)
+                    ORDER BY next_attempt_at
+                    LIMIT ?
+                )
+                RETURNING *
+            ''', (now + lease, now, now, limit))
+            return cursor.fetchall()
+    
+    def record_credit_attempt(self, deposit_id, balance_before, balance_at):
+        """Начало попытки: баланс кассы до запроса в API (balance_at - когда его начали запрашивать)"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE credit_outbox
+                SET status = 'in_flight', attempts = attempts + 1, reconcile_attempts = 0, balance_before = ?,
+                    balance_at = ?, attempt_started_at = ?, attempt_finished_at = NULL
+                WHERE deposit_id = ?
+            ''', (balance_before, balance_at, time.time(), deposit_id))
+    
+    def mark_credit_unknown(self, deposit_id, error, finished_at):
+        """Неясный исход попытки; зачисление остается за воркером до сверки"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE credit_outbox SET status = 'unknown', last_error = ?, attempt_finished_at = ?
+                WHERE deposit_id = ?
+            ''', (error, finished_at, deposit_id))
+    
+    def get_credit_job(self, deposit_id):
         cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM credit_outbox WHERE deposit_id = ?', (deposit_id,))
+        return cursor.fetchone()
+    
+    def reschedule_credit(self, deposit_id, status, delay, error, finished_at=None, reconcile_failed=False):
+        """Повтор через delay секунд (status: pending или unknown - нужна сверка).
+        
+        finished_at - время ответа API, если попытка была;
+        reconcile_failed - повтор после неудавшейся сверки (считается в
+        reconcile_attempts).
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE credit_outbox
+                SET status = ?, next_attempt_at = ?, claimed_until = NULL, last_error = ?,
+                    attempt_finished_at = COALESCE(?, attempt_finished_at),
+                    reconcile_attempts = reconcile_attempts + ?
+                WHERE deposit_id = ?
+            ''', (status, time.time() + delay, error, finished_at, int(reconcile_failed), deposit_id))
+    
+    def settle_credit(self, deposit_id, status, error=None, transition=None, finished_at=None):
+        """Итог зачисления: done, failed или manual (нужна ручная проверка).
+        
+        transition - (из статусов, в статус) депозита, выполняется в той же
+        транзакции; при done к тому же пополняется баланс игрока.
+        Возвращает предыдущий статус депозита или None (в том числе если
+        записи в очереди нет).
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE credit_outbox
+                SET status = ?, settled_at = ?, claimed_until = NULL, last_error = COALESCE(?, last_error),
+                    attempt_finished_at = COALESCE(?, attempt_finished_at)
+                WHERE deposit_id = ?
+                RETURNING user_id, amount
+            ''', (status, time.time(), error, finished_at, deposit_id))
+            row = cursor.fetchone()
+            if row is None:
+                logger.warning(f"Зачисление депозита #{deposit_id} не найдено в очереди")
+                return None
+            user_id, amount = row
+            if transition is None:
+                return None
+            previous = self.transition_deposit(deposit_id, *transition)
+            if previous is not None and status == 'done':
+                self.update_user_balance(user_id, amount)
+            return previous
+    
+    def resolve_manual_credit(self, deposit_id, credited, transition):
+        """Итог ручной проверки: зачисление в статусе manual становится done или failed.
         
-        if status == 'COMPLETED':
+        transition - (из статусов, в статус) депозита, выполняется в той же
+        транзакции; если зачисление прошло, пополняется баланс игрока.
+        Возвращает предыдущий статус депозита или None, если зачисление
+        не ждало ручной проверки.
+        """
+        with self.transaction() as cursor:
             cursor.execute('''
-                UPDATE deposits 
-                SET status = ?, processed_at = CURRENT_TIMESTAMP, admin_id = ?
+                UPDATE credit_outbox SET status = ?, settled_at = ?
+                WHERE deposit_id = ? AND status = 'manual'
+                RETURNING user_id, amount
+            ''', ('done' if credited else 'failed', time.time(), deposit_id))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            previous = self.transition_deposit(deposit_id, *transition)
+            if previous is not None and credited:
+                self.update_user_balance(*row)
+            return previous
+    
+    def get_credit_statuses(self, deposit_ids):
+        """Статусы записей очереди зачислений: {deposit_id: status}"""
+        if not deposit_ids:
+            return {}
+        cursor = self.conn.cursor()
+        placeholders = ','.join('?' * len(deposit_ids))
+        cursor.execute(
+            f'SELECT deposit_id, status FROM credit_outbox WHERE deposit_id IN ({placeholders})',
+            tuple(deposit_ids)
+        )
+        return dict(cursor.fetchall())
+    
+    def get_credit_attempts_since(self, since, exclude_deposit_id):
+        """Попытки, которые могли изменить баланс кассы после since.
+        
+        Только зачисления и выплаты, прошедшие (done) или с неясным
+        исходом: [(status, amount, attempt_started_at), ...]; failed и
+        pending баланс не меняли. Выплата пополняет кассу, поэтому ее
+        сумма отрицательна; у выплаты с неясным исходом сумма неизвестна (None).
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT status, amount, attempt_started_at FROM credit_outbox
+            WHERE status IN ('done', 'unknown', 'in_flight', 'manual')
+              AND deposit_id != ?
+              AND (attempt_finished_at IS NULL OR attempt_finished_at >= ?)
+            UNION ALL
+            SELECT status, -amount, attempt_started_at FROM withdrawals
+            WHERE (status IN ('done', 'unknown', 'in_flight', 'manual') OR uncertain)
+              AND attempt_started_at IS NOT NULL
+              AND (attempt_finished_at IS NULL OR attempt_finished_at >= ?)
+        ''', (exclude_deposit_id, since, since))
+        return cursor.fetchall()
+    
+    def seconds_until_next_credit(self):
+        """Секунд до ближайшей попытки зачисления (None - очередь пуста)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT MIN(MAX(next_attempt_at, COALESCE(claimed_until, 0))) FROM credit_outbox
+            WHERE status IN ('pending', 'unknown', 'in_flight')
+        ''')
+        next_at = cursor.fetchone()[0]
+        return None if next_at is None else next_at - time.time()
+    
+    def get_credit_stats(self):
+        """Количество зачислений по статусам очереди"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT status, COUNT(*) FROM credit_outbox GROUP BY status')
+        return dict(cursor.fetchall())
+    
+    def add_withdrawal(self, user_id, username, code, hold):
+        """Заявка на вывод; возвращает (id, создана ли новая).
+        
+        Если у игрока уже есть заявка с этим кодом или незавершенная
+        заявка, новая не создается и возвращается id существующей.
+        Новая заявка не берется в работу hold секунд - до queue_withdrawal;
+        если процесс упадет раньше, она будет выплачена по истечении hold.
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT id FROM withdrawals
+                WHERE user_id = ? AND (code = ? OR status IN ('pending', 'in_flight', 'unknown'))
+                ORDER BY id DESC LIMIT 1
+            ''', (user_id, code))
+            row = cursor.fetchone()
+            if row:
+                return row[0], False
+            cursor.execute('''
+                INSERT INTO withdrawals (user_id, username, code, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, username, code, time.time() + hold))
+            return cursor.lastrowid, True
+    
+    def queue_withdrawal(self, withdrawal_id, message_id):
+        """Запись id сообщения игрока и постановка заявки в очередь выплат"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE withdrawals
+                SET user_message_id = ?,
+                    next_attempt_at = CASE WHEN attempts = 0 THEN MIN(next_attempt_at, ?) ELSE next_attempt_at END
                 WHERE id = ?
-            ''', (status, admin_id, deposit_id))
-        elif payment_details:
+            ''', (message_id, time.time(), withdrawal_id))
+    
+    def claim_withdrawals(self, limit, lease):
+        """Захват выплат, срок попытки которых наступил (аренда, как у claim_credit_jobs)"""
+        now = time.time()
+        with self.transaction() as cursor:
             cursor.execute('''
-                UPDATE deposits 
-                SET status = ?, payment_details = ?, admin_id = ?
+                UPDATE withdrawals SET claimed_until = ?
+                WHERE id IN (
+                    SELECT id FROM withdrawals
+                    WHERE status IN ('pending', 'unknown', 'in_flight')
+                      AND next_attempt_at <= ?
+                      AND (claimed_until IS NULL OR claimed_until < ?)
+                    ORDER BY next_attempt_at
+                    LIMIT ?
+                )
+                RETURNING *
+            ''', (now + lease, now, now, limit))
+            return cursor.fetchall()
+    
+    def record_withdrawal_attempt(self, withdrawal_id):
+        """Начало попытки выплаты; прерванная или неясная прошлая попытка помечается uncertain"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE withdrawals
+                SET uncertain = uncertain OR status IN ('unknown', 'in_flight'),
+                    status = 'in_flight', attempts = attempts + 1,
+                    attempt_started_at = ?, attempt_finished_at = NULL
                 WHERE id = ?
-            ''', (status, payment_details, admin_id, deposit_id))
-        else:
+            ''', (time.time(), withdrawal_id))
+    
+    def reschedule_withdrawal(self, withdrawal_id, status, delay, error, finished_at=None):
+        """Повтор через delay секунд (status: pending или unknown - исход попытки неясен)"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE withdrawals
+                SET status = ?, next_attempt_at = ?, claimed_until = NULL, last_error = ?,
+                    attempt_finished_at = COALESCE(?, attempt_finished_at)
+                WHERE id = ?
+            ''', (status, time.time() + delay, error, finished_at, withdrawal_id))
+    
+    def settle_withdrawal(self, withdrawal_id, status, amount=None, error=None, finished_at=None):
+        """Итог выплаты: done, failed или manual (нужна ручная проверка)"""
+        with self.transaction() as cursor:
             cursor.execute('''
-                UPDATE deposits 
-                SET status = ?, admin_id = ?
+                UPDATE withdrawals
+                SET status = ?, amount = COALESCE(?, amount), settled_at = ?, claimed_until = NULL,
+                    last_error = COALESCE(?, last_error), attempt_finished_at = COALESCE(?, attempt_finished_at)
                 WHERE id = ?
-            ''', (status, admin_id, deposit_id))
+            ''', (status, amount, time.time(), error, finished_at, withdrawal_id))
+    
+    def seconds_until_next_withdrawal(self):
+        """Секунд до ближайшей попытки выплаты (None - очередь пуста)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT MIN(MAX(next_attempt_at, COALESCE(claimed_until, 0))) FROM withdrawals
+            WHERE status IN ('pending', 'unknown', 'in_flight')
+        ''')
+        next_at = cursor.fetchone()[0]
+        return None if next_at is None else next_at - time.time()
+    
+    def get_withdrawal_digest(self, limit):
+        """Завершенные выплаты, еще не попавшие в сводку администраторам"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, username, status, amount, last_error FROM withdrawals
+            WHERE notified = 0 AND status IN ('done', 'failed', 'manual')
+            ORDER BY id
+            LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
+    
+    def mark_withdrawals_notified(self, withdrawal_ids):
+        """Отметка выплат, попавших в отправленную сводку"""
+        placeholders = ','.join('?' * len(withdrawal_ids))
+        with self.transaction() as cursor:
+            cursor.execute(
+                f"UPDATE withdrawals SET notified = 1 WHERE id IN ({placeholders})",
+                withdrawal_ids
+            )
+    
+    def get_withdrawal_stats(self):
+        """Количество и сумма выводов по статусам: {status: (count, total)}"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT status, COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals GROUP BY status')
+        return {status: (count, total) for status, count, total in cursor.fetchall()}
+    
+    def seconds_until_next_expiry(self, statuses):
+        """Секунд до ближайшего срока оплаты депозитов в statuses (None - ждать нечего)"""
+        placeholders = ','.join('?' * len(statuses))
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT (julianday(MIN(expires_at)) - julianday('now')) * 86400
+            FROM deposits
+            WHERE status IN ({placeholders}) AND expires_at IS NOT NULL
+        ''', tuple(statuses))
+        return cursor.fetchone()[0]
+    
+    def expire_due_deposits(self, limit, from_statuses, to_status):
+        """Переход from_statuses -> to_status для порции депозитов с истекшим сроком оплаты.
+        
+        Возвращает [(id, user_id, предыдущий статус), ...] только тех
+        депозитов, статус которых действительно изменен.
+        """
+        placeholders = ','.join('?' * len(from_statuses))
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                SELECT id, status FROM deposits
+                WHERE status IN ({placeholders}) AND expires_at <= datetime('now')
+                ORDER BY expires_at
+                LIMIT ?
+            ''', (*from_statuses, limit))
+            previous = dict(cursor.fetchall())
+            if not previous:
+                return []
+            cursor.execute(f'''
+                UPDATE deposits SET status = ?, expires_at = NULL
+                WHERE id IN ({','.join('?' * len(previous))}) AND status IN ({placeholders})
+                RETURNING id, user_id
+            ''', (to_status, *previous, *from_statuses))
+            return sorted((deposit_id, user_id, previous[deposit_id]) for deposit_id, user_id in cursor.fetchall())
+    
+    def recover_open_deposits(self, timeout, sample_size):
+        """Сводка по открытым депозитам после перезапуска.
         
-        self.conn.commit()
+        Депозитам PAID без срока оплаты (созданным до появления
+        expires_at) назначается полный срок от текущего момента.
+        Возвращает (количество перевзведенных сроков,
+        {статус: (количество, [(id, amount, created_at), ...])}).
+        """
+        open_statuses = ('PENDING', 'ASSIGNED', 'PAID', 'PROCESSING', 'CREDITING')
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE deposits SET expires_at = datetime('now', ?)
+                WHERE status = ? AND expires_at IS NULL
+            ''', (f'+{int(timeout)} seconds', 'PAID'))
+            rearmed = cursor.rowcount
+            
+            summary = {}
+            for status in open_statuses:
+                cursor.execute('SELECT COUNT(*) FROM deposits WHERE status = ?', (status,))
+                count = cursor.fetchone()[0]
+                cursor.execute('''
+                    SELECT id, amount, created_at FROM deposits
+                    WHERE status = ?
+                    ORDER BY created_at
+                    LIMIT ?
+                ''', (status, sample_size))
+                summary[status] = (count, cursor.fetchall())
+            return rearmed, summary
+    
+    def add_deposit_span(self, deposit_id, stage, started_at, duration_ms, ok=True):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO deposit_spans (deposit_id, stage, started_at, duration_ms, ok)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (deposit_id, stage, started_at, duration_ms, int(ok)))
     
-    def add_receipt(self, deposit_id, file_id):
+    def get_deposit_spans(self, deposit_id):
+        """Этапы депозита по времени: [(stage, started_at, duration_ms, ok), ...]"""
         cursor = self.conn.cursor()
         cursor.execute('''
-            UPDATE deposits 
-            SET receipt_file_id = ?, status = 'PROCESSING'
-            WHERE id = ?
-        ''', (file_id, deposit_id))
-        self.conn.commit()
+            SELECT stage, started_at, duration_ms, ok FROM deposit_spans
+            WHERE deposit_id = ?
+            ORDER BY started_at
+        ''', (deposit_id,))
+        return cursor.fetchall()
+    
+    def get_recent_span_durations(self, deposits):
+        """Длительности этапов последних deposits депозитов: [(stage, duration_ms), ...]"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT stage, duration_ms FROM deposit_spans
+            WHERE deposit_id IN (SELECT id FROM deposits ORDER BY id DESC LIMIT ?)
+        ''', (deposits,))
+        return cursor.fetchall()
     
     def get_pending_deposits(self):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM deposits WHERE status = "PENDING"')
+        cursor.execute(
+            'SELECT * FROM deposits WHERE status = ? ORDER BY created_at',
+            ('PENDING',)
+        )
         return cursor.fetchall()
     
     def get_processing_deposits(self):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM deposits WHERE status = "PROCESSING"')
+        cursor.execute(
+            'SELECT * FROM deposits WHERE status = ? ORDER BY created_at',
+            ('PROCESSING',)
+        )
         return cursor.fetchall()
     
     def get_user_deposits(self, user_id):
@@ -119,20 +817,223 @@ class Database:
         ''', (user_id,))
         return cursor.fetchall()
     
+    def _deposits_page(self, column, value, newest_first, cursor, backwards, limit):
+        """Страница депозитов с keyset-пагинацией по (created_at, id).
+        
+        cursor - (created_at, id) крайней строки предыдущей страницы;
+        backwards=True - страница перед курсором. Возвращает строки в
+        порядке показа и признак наличия строк дальше в направлении обхода.
+        """
+        # Направление обхода в индексе: вперед по порядку показа или назад
+        descending = newest_first != backwards
+        order = 'DESC' if descending else 'ASC'
+        query = f'SELECT * FROM deposits WHERE {column} = ?'
+        params = [value]
+        if cursor is not None:
+            query += f" AND (created_at, id) {'<' if descending else '>'} (?, ?)"
+            params.extend(cursor)
+        query += f' ORDER BY created_at {order}, id {order} LIMIT ?'
+        params.append(limit + 1)
+        
+        cur = self.conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        return rows, has_more
+    
+    def get_user_deposits_page(self, user_id, cursor=None, backwards=False, limit=10):
+        """Депозиты игрока, новые сверху"""
+        return self._deposits_page('user_id', user_id, True, cursor, backwards, limit)
+    
+    def get_status_deposits_page(self, status, cursor=None, backwards=False, limit=10):
+        """Очередь депозитов в статусе, старые сверху"""
+        return self._deposits_page('status', status, False, cursor, backwards, limit)
+    
+    def get_deposit_stats(self):
+        """Количество и сумма депозитов по статусам: {статус: (count, sum)}"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT status, COUNT(*), COALESCE(SUM(amount), 0) FROM deposits GROUP BY status')
+        return {status: (count, total) for status, count, total in cursor.fetchall()}
+    
     def add_or_update_user(self, user_id, username, full_name):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO users (user_id, username, full_name)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE
+                SET username = excluded.username,
+                    full_name = excluded.full_name,
+                    last_activity = CURRENT_TIMESTAMP,
+                    is_active = 1
+            ''', (user_id, username, full_name))
+    
+    def get_all_user_ids(self):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT user_id FROM users')
+        return cursor.fetchall()
+    
+    def get_broadcast_recipients(self, broadcast_id, last_user_id, limit):
+        """Порция активных получателей рассылки по возрастанию user_id.
+        
+        Пропускает тех, кому эта рассылка уже доставлялась (важно при
+        продолжении после перезапуска посреди порции).
+        """
         cursor = self.conn.cursor()
         cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, full_name)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, full_name))
+            SELECT user_id FROM users
+            WHERE user_id > ? AND is_active = 1
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_deliveries d
+                  WHERE d.broadcast_id = ? AND d.user_id = users.user_id
+              )
+            ORDER BY user_id
+            LIMIT ?
+        ''', (last_user_id, broadcast_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def count_active_users(self):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
+        return cursor.fetchone()[0]
+    
+    def deactivate_user(self, user_id):
+        """Пользователь заблокировал бота или удален - не слать ему рассылки"""
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE users SET is_active = 0 WHERE user_id = ?', (user_id,))
+    
+    def create_broadcast(self, admin_id, text, status_message_id, total_count):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO broadcasts (admin_id, text, status_message_id, total_count, status)
+                VALUES (?, ?, ?, ?, 'QUEUED')
+            ''', (admin_id, text, status_message_id, total_count))
+            return cursor.lastrowid
+    
+    def get_broadcast(self, broadcast_id):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return cursor.fetchone()
+    
+    def claim_next_broadcast(self, include_running=False):
+        """Взять следующую рассылку из очереди (QUEUED -> RUNNING).
         
+        include_running=True - сначала вернуть рассылки, прерванные перезапуском.
+        """
+        with self.transaction() as cursor:
+            if include_running:
+                cursor.execute(
+                    'SELECT id FROM broadcasts WHERE status = ? ORDER BY id LIMIT 1',
+                    ('RUNNING',)
+                )
+                row = cursor.fetchone()
+                if row:
+                    return row[0]
+            
+            cursor.execute(
+                'SELECT id FROM broadcasts WHERE status = ? ORDER BY id LIMIT 1',
+                ('QUEUED',)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                'UPDATE broadcasts SET status = ? WHERE id = ? AND status = ?',
+                ('RUNNING', row[0], 'QUEUED')
+            )
+            return row[0] if cursor.rowcount else None
+    
+    def add_broadcast_delivery(self, broadcast_id, user_id, status, error=None):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status, error)
+                VALUES (?, ?, ?, ?)
+            ''', (broadcast_id, user_id, status, error))
+    
+    def get_broadcast_delivery_counts(self, broadcast_id):
+        """Количество доставок рассылки по статусам"""
+        cursor = self.conn.cursor()
         cursor.execute('''
-            UPDATE users 
-            SET username = ?, full_name = ?, last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (username, full_name, user_id))
+            SELECT status, COUNT(*) FROM broadcast_deliveries
+            WHERE broadcast_id = ?
+            GROUP BY status
+        ''', (broadcast_id,))
+        return dict(cursor.fetchall())
+    
+    def update_broadcast_progress(self, broadcast_id, last_user_id, sent_count, failed_count):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE broadcasts
+                SET last_user_id = ?, sent_count = ?, failed_count = ?
+                WHERE id = ?
+            ''', (last_user_id, sent_count, failed_count, broadcast_id))
+    
+    def finish_broadcast(self, broadcast_id, status='COMPLETED'):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE broadcasts
+                SET status = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, broadcast_id))
+    
+    def get_persisted_user_data(self):
+        """Все сохраненные user_data: [(user_id, data, version), ...]"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT user_id, data, version FROM persistence_user_data')
+        return cursor.fetchall()
+    
+    def get_persisted_user_data_since(self, user_id, version):
+        """user_data игрока, если в базе версия новее version: (data, version) или None"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT data, version FROM persistence_user_data WHERE user_id = ? AND version > ?',
+            (user_id, version)
+        )
+        return cursor.fetchone()
+    
+    def get_persisted_conversations(self, name):
+        """Состояния диалогов ConversationHandler: [(key, state), ...]"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT key, state FROM persistence_conversations WHERE name = ?', (name,))
+        return cursor.fetchall()
+    
+    def save_persistence(self, user_data, conversations):
+        """Запись накопленных изменений одной транзакцией.
         
-        self.conn.commit()
+        user_data - [(user_id, data)], conversations - [(name, key, state)];
+        None вместо data/state удаляет запись. Возвращает {user_id: версия}
+        для сохраненных user_data.
+        """
+        versions = {}
+        with self.transaction() as cursor:
+            for user_id, data in user_data:
+                if data is None:
+                    cursor.execute('DELETE FROM persistence_user_data WHERE user_id = ?', (user_id,))
+                    continue
+                cursor.execute('''
+                    INSERT INTO persistence_user_data (user_id, data)
+                    VALUES (?, ?)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET data = excluded.data,
+                        version = version + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING version
+                ''', (user_id, data))
+                versions[user_id] = cursor.fetchone()[0]
+            
+            cursor.executemany(
+                'DELETE FROM persistence_conversations WHERE name = ? AND key = ?',
+                [(name, key) for name, key, state in conversations if state is None]
+            )
+            cursor.executemany('''
+                INSERT INTO persistence_conversations (name, key, state)
+                VALUES (?, ?, ?)
+                ON CONFLICT (name, key) DO UPDATE
+                SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+            ''', [(name, key, state) for name, key, state in conversations if state is not None])
+        return versions
     
     def get_user(self, user_id):
         cursor = self.conn.cursor()
@@ -140,10 +1041,362 @@ class Database:
         return cursor.fetchone()
     
     def update_user_balance(self, user_id, amount):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET balance = balance + ?, deposits_count = deposits_count + 1
-            WHERE user_id = ?
-        ''', (amount, user_id))
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE users 
+                SET balance = balance + ?, deposits_count = deposits_count + 1
+                WHERE user_id = ?
+            ''', (amount, user_id))
+    
+    def close(self):
+        self.conn.close()
+
+
+class AsyncDatabase:
+    """Асинхронный доступ к базе без блокировки цикла событий.
+
+    Все записи попадают в очередь одного потока-писателя со своим
+    соединением. Писатель забирает из очереди все операции, пришедшие
+    за окно DB_GROUP_COMMIT_WINDOW, и выполняет их одной транзакцией
+    (каждую в своем SAVEPOINT), так что на пачку приходится один коммит.
+    Чтение идет в небольшом пуле потоков, у каждого отдельное соединение.
+    Методы повторяют имена Database, но awaitable.
+    """
+    
+    def __init__(self, db_name='winwin_bot.db', readers=None, profile=None):
+        self.db_name = db_name
+        self.profile = profile
+        self.commit_window = Config.DB_GROUP_COMMIT_WINDOW / 1000
+        self.max_batch = Config.DB_GROUP_COMMIT_MAX_BATCH
+        self.durability = Config.DB_WRITE_DURABILITY
+        self.stats = {'batches': 0, 'writes': 0}
+        
+        self._writer = Database(db_name, profile=profile)
+        self._queue = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer_thread.start()
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=readers or Config.DB_READERS,
+            thread_name_prefix='db-reader'
+        )
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._closed = False
+    
+    def _writer_loop(self):
+        """Поток-писатель: групповой коммит операций из очереди"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < self.max_batch:
+                try:
+                    timeout = deadline - time.monotonic()
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            self._run_batch(batch)
+            if stop:
+                return
+    
+    def _run_batch(self, batch):
+        # Операции, отмененные до начала выполнения, пропускаются
+        batch = [op for op in batch if op[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        
+        results = []
+        batch_started = time.perf_counter()
+        try:
+            with self._writer.transaction():
+                for method, args, future in batch:
+                    started = time.perf_counter()
+                    try:
+                        with self._writer.transaction():
+                            results.append((getattr(self._writer, method)(*args), None))
+                    except Exception as e:
+                        results.append((None, e))
+                    DB_SECONDS.observe(time.perf_counter() - started, method, 'write')
+        except Exception as e:
+            # Коммит не удался - не сохранилась ни одна операция пачки
+            results = [(None, e)] * len(batch)
+        DB_BATCH_SECONDS.observe(time.perf_counter() - batch_started)
+        
+        self.stats['batches'] += 1
+        self.stats['writes'] += len(batch)
+        
+        for (method, args, future), (result, error) in zip(batch, results):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def _submit(self, method, args):
+        if self._closed:
+            raise RuntimeError("База данных закрыта")
+        future = concurrent.futures.Future()
+        self._queue.put((method, args, future))
+        return future
+    
+    def _reader(self):
+        """Соединение для чтения, привязанное к текущему потоку пула"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = Database(self.db_name, migrate=False, profile=self.profile)
+            self._local.db = db
+            with self._readers_lock:
+                self._readers.append(db)
+        return db
+    
+    def _call_reader(self, method, args):
+        started = time.perf_counter()
+        try:
+            return getattr(self._reader(), method)(*args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, method, 'read')
+    
+    async def _read(self, method, *args):
+        if self.db_name == ':memory:':
+            # У базы в памяти нет общих данных между соединениями
+            return await asyncio.wrap_future(self._submit(method, args))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._call_reader, method, args)
+    
+    async def _write(self, method, *args, wait=True):
+        """Постановка записи в очередь писателя.
+        
+        wait=True - дождаться коммита (результат метода доступен).
+        wait=False - при DB_WRITE_DURABILITY='queued' вернуть управление
+        сразу после постановки в очередь; запись будет закоммичена со
+        следующей пачкой, ошибки попадут в лог.
+        """
+        future = self._submit(method, args)
+        if wait or self.durability == 'commit':
+            return await asyncio.wrap_future(future)
+        future.add_done_callback(self._log_write_error)
+    
+    @staticmethod
+    def _log_write_error(future):
+        if future.exception() is not None:
+            logger.error(f"Ошибка отложенной записи в базу: {future.exception()}")
+    
+    async def flush(self):
+        """Дождаться коммита всех уже поставленных в очередь записей"""
+        await self._write('get_schema_version')
+    
+    async def add_deposit(self, user_id, username, amount, trace_id=None):
+        deposit_id = await self._write('add_deposit', user_id, username, amount, trace_id)
+        DEPOSIT_TRANSITIONS.inc('', 'PENDING')
+        return deposit_id
+    
+    async def set_user_message_id(self, deposit_id, message_id):
+        await self._write('set_user_message_id', deposit_id, message_id, wait=False)
+    
+    async def add_admin_messages(self, deposit_id, messages):
+        await self._write('add_admin_messages', deposit_id, messages)
+    
+    async def get_admin_messages(self, deposit_id):
+        return await self._read('get_admin_messages', deposit_id)
+    
+    async def get_deposit(self, deposit_id):
+        return await self._read('get_deposit', deposit_id)
+    
+    async def transition_deposit(self, deposit_id, from_statuses, to_status, owner_id=None, admin_id=None,
+                                 payment_details=None, receipt_file_id=None, expires_in=None):
+        previous = await self._write(
+            'transition_deposit', deposit_id, tuple(from_statuses), to_status, owner_id,
+            admin_id, payment_details, receipt_file_id, expires_in
+        )
+        if previous is not None:
+            DEPOSIT_TRANSITIONS.inc(previous, to_status)
+        return previous
+    
+    async def start_deposit_credit(self, deposit_id, from_statuses, to_status, admin_id):
+        previous = await self._write('start_deposit_credit', deposit_id, tuple(from_statuses), to_status, admin_id)
+        if previous is not None:
+            DEPOSIT_TRANSITIONS.inc(previous, to_status)
+        return previous
+    
+    async def claim_credit_jobs(self, limit, lease):
+        return await self._write('claim_credit_jobs', limit, lease)
+    
+    async def record_credit_attempt(self, deposit_id, balance_before, balance_at):
+        await self._write('record_credit_attempt', deposit_id, balance_before, balance_at)
+    
+    async def mark_credit_unknown(self, deposit_id, error, finished_at):
+        await self._write('mark_credit_unknown', deposit_id, error, finished_at)
+    
+    async def get_credit_job(self, deposit_id):
+        return await self._read('get_credit_job', deposit_id)
+    
+    async def reschedule_credit(self, deposit_id, status, delay, error, finished_at=None, reconcile_failed=False):
+        await self._write('reschedule_credit', deposit_id, status, delay, error, finished_at, reconcile_failed)
+    
+    async def settle_credit(self, deposit_id, status, error=None, transition=None, finished_at=None):
+        previous = await self._write('settle_credit', deposit_id, status, error, transition, finished_at)
+        if previous is not None:
+            DEPOSIT_TRANSITIONS.inc(previous, transition[1])
+        return previous
+    
+    async def resolve_manual_credit(self, deposit_id, credited, transition):
+        previous = await self._write('resolve_manual_credit', deposit_id, credited, transition)
+        if previous is not None:
+            DEPOSIT_TRANSITIONS.inc(previous, transition[1])
+        return previous
+    
+    async def get_credit_statuses(self, deposit_ids):
+        return await self._read('get_credit_statuses', tuple(deposit_ids))
+    
+    async def get_credit_attempts_since(self, since, exclude_deposit_id):
+        return await self._read('get_credit_attempts_since', since, exclude_deposit_id)
+    
+    async def seconds_until_next_credit(self):
+        return await self._read('seconds_until_next_credit')
+    
+    async def get_credit_stats(self):
+        return await self._read('get_credit_stats')
+    
+    async def add_withdrawal(self, user_id, username, code, hold):
+        return await self._write('add_withdrawal', user_id, username, code, hold)
+    
+    async def queue_withdrawal(self, withdrawal_id, message_id):
+        await self._write('queue_withdrawal', withdrawal_id, message_id)
+    
+    async def claim_withdrawals(self, limit, lease):
+        return await self._write('claim_withdrawals', limit, lease)
+    
+    async def record_withdrawal_attempt(self, withdrawal_id):
+        await self._write('record_withdrawal_attempt', withdrawal_id)
+    
+    async def reschedule_withdrawal(self, withdrawal_id, status, delay, error, finished_at=None):
+        await self._write('reschedule_withdrawal', withdrawal_id, status, delay, error, finished_at)
+    
+    async def settle_withdrawal(self, withdrawal_id, status, amount=None, error=None, finished_at=None):
+        await self._write('settle_withdrawal', withdrawal_id, status, amount, error, finished_at)
+    
+    async def seconds_until_next_withdrawal(self):
+        return await self._read('seconds_until_next_withdrawal')
+    
+    async def get_withdrawal_digest(self, limit):
+        return await self._read('get_withdrawal_digest', limit)
+    
+    async def mark_withdrawals_notified(self, withdrawal_ids):
+        await self._write('mark_withdrawals_notified', tuple(withdrawal_ids))
+    
+    async def get_withdrawal_stats(self):
+        return await self._read('get_withdrawal_stats')
+    
+    async def recover_open_deposits(self, timeout, sample_size):
+        return await self._write('recover_open_deposits', timeout, sample_size)
+    
+    async def seconds_until_next_expiry(self, statuses):
+        return await self._read('seconds_until_next_expiry', tuple(statuses))
+    
+    async def expire_due_deposits(self, limit, from_statuses, to_status):
+        expired = await self._write('expire_due_deposits', limit, tuple(from_statuses), to_status)
+        for _, _, previous in expired:
+            DEPOSIT_TRANSITIONS.inc(previous, to_status)
+        return [(deposit_id, user_id) for deposit_id, user_id, _ in expired]
+    
+    async def add_deposit_span(self, deposit_id, stage, started_at, duration_ms, ok=True):
+        await self._write('add_deposit_span', deposit_id, stage, started_at, duration_ms, ok, wait=False)
+    
+    async def get_deposit_spans(self, deposit_id):
+        return await self._read('get_deposit_spans', deposit_id)
+    
+    async def get_recent_span_durations(self, deposits):
+        return await self._read('get_recent_span_durations', deposits)
+    
+    async def get_pending_deposits(self):
+        return await self._read('get_pending_deposits')
+    
+    async def get_processing_deposits(self):
+        return await self._read('get_processing_deposits')
+    
+    async def get_user_deposits(self, user_id):
+        return await self._read('get_user_deposits', user_id)
+    
+    async def get_user_deposits_page(self, user_id, cursor=None, backwards=False, limit=10):
+        return await self._read('get_user_deposits_page', user_id, cursor, backwards, limit)
+    
+    async def get_status_deposits_page(self, status, cursor=None, backwards=False, limit=10):
+        return await self._read('get_status_deposits_page', status, cursor, backwards, limit)
+    
+    async def get_deposit_stats(self):
+        return await self._read('get_deposit_stats')
+    
+    async def add_or_update_user(self, user_id, username, full_name):
+        await self._write('add_or_update_user', user_id, username, full_name)
+    
+    async def get_all_user_ids(self):
+        return await self._read('get_all_user_ids')
+    
+    async def get_broadcast_recipients(self, broadcast_id, last_user_id, limit):
+        return await self._read('get_broadcast_recipients', broadcast_id, last_user_id, limit)
+    
+    async def count_active_users(self):
+        return await self._read('count_active_users')
+    
+    async def deactivate_user(self, user_id):
+        await self._write('deactivate_user', user_id)
+    
+    async def create_broadcast(self, admin_id, text, status_message_id, total_count):
+        return await self._write('create_broadcast', admin_id, text, status_message_id, total_count)
+    
+    async def get_broadcast(self, broadcast_id):
+        return await self._read('get_broadcast', broadcast_id)
+    
+    async def claim_next_broadcast(self, include_running=False):
+        return await self._write('claim_next_broadcast', include_running)
+    
+    async def add_broadcast_delivery(self, broadcast_id, user_id, status, error=None):
+        await self._write('add_broadcast_delivery', broadcast_id, user_id, status, error)
+    
+    async def get_broadcast_delivery_counts(self, broadcast_id):
+        return await self._read('get_broadcast_delivery_counts', broadcast_id)
+    
+    async def update_broadcast_progress(self, broadcast_id, last_user_id, sent_count, failed_count):
+        await self._write('update_broadcast_progress', broadcast_id, last_user_id, sent_count, failed_count)
+    
+    async def finish_broadcast(self, broadcast_id, status='COMPLETED'):
+        await self._write('finish_broadcast', broadcast_id, status)
+    
+    async def get_persisted_user_data(self):
+        return await self._read('get_persisted_user_data')
+    
+    async def get_persisted_user_data_since(self, user_id, version):
+        return await self._read('get_persisted_user_data_since', user_id, version)
+    
+    async def get_persisted_conversations(self, name):
+        return await self._read('get_persisted_conversations', name)
+    
+    async def save_persistence(self, user_data, conversations):
+        return await self._write('save_persistence', user_data, conversations)
+    
+    async def get_user(self, user_id):
+        return await self._read('get_user', user_id)
+    
+    async def update_user_balance(self, user_id, amount):
+        await self._write('update_user_balance', user_id, amount)
+    
+    def close(self):
+        """Записать очередь на диск и закрыть все соединения"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer_thread.join()
+        self._read_executor.shutdown(wait=True)
+        for db in self._readers:
+            db.close()
+        self._writer.close()
@@ -0,0 +1,80 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Событие -> (статусы, из которых оно допустимо, новый статус)
+TRANSITIONS = {
+    'take': (('PENDING',), 'ASSIGNED'),  # администратор взял депозит
+    'send_details': (('ASSIGNED',), 'PAID'),  # реквизиты отправлены игроку
+    'upload_receipt': (('PAID', 'PROCESSING'), 'PROCESSING'),  # игрок загрузил чек
+    'start_credit': (('PROCESSING',), 'CREDITING'),  # администратор подтвердил оплату
+    'complete': (('CREDITING',), 'COMPLETED'),
+    'credit_failed': (('CREDITING',), 'PROCESSING'),  # зачисление не прошло, можно повторить
+    # Ручная проверка неясного зачисления администратором
+    'confirm_credited': (('CREDITING',), 'COMPLETED'),
+    'confirm_not_credited': (('CREDITING',), 'PROCESSING'),
+    'reject': (('PENDING', 'ASSIGNED', 'PROCESSING'), 'CANCELLED'),
+    'expire': (('PAID',), 'CANCELLED')  # истек срок оплаты (DepositExpiryScheduler)
+}
+
+
+class DepositStateMachine:
+    """Переходы статусов депозита поверх атомарной смены статуса в базе.
+
+    Каждое событие - один условный UPDATE (transition_deposit), который
+    срабатывает, только если депозит все еще в одном из допустимых
+    статусов. Из нескольких администраторов, одновременно нажавших
+    кнопки одного депозита, переход выигрывает ровно один, остальные
+    получают None и показывают актуальный статус.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def can(status, event):
+        """Допустимо ли событие в статусе status"""
+        return status in TRANSITIONS[event][0]
+
+    async def fire(self, deposit_id, event, owner_id=None, **fields):
+        """Переход по событию; возвращает предыдущий статус или None, если переход не выполнен.
+
+        owner_id - переход только для администратора, который взял
+        депозит; fields - admin_id, payment_details, receipt_file_id,
+        expires_in (см. Database.transition_deposit).
+        """
+        from_statuses, to_status = TRANSITIONS[event]
+        previous = await self.db.transition_deposit(deposit_id, from_statuses, to_status, owner_id, **fields)
+        if previous is None:
+            logger.info(f"Депозит #{deposit_id}: событие {event} отклонено, статус уже изменен")
+        return previous
+
+    async def start_credit(self, deposit_id, admin_id):
+        """Подтверждение оплаты: переход в CREDITING вместе с записью в очередь зачислений"""
+        from_statuses, to_status = TRANSITIONS['start_credit']
+        previous = await self.db.start_deposit_credit(deposit_id, from_statuses, to_status, admin_id)
+        if previous is None:
+            logger.info(f"Депозит #{deposit_id}: событие start_credit отклонено, статус уже изменен")
+        return previous
+
+    async def resolve_credit(self, deposit_id, credited):
+        """Итог ручной проверки зачисления (только для записи очереди в статусе manual).
+
+        credited - зачисление прошло: депозит завершается и пополняется
+        баланс игрока; иначе депозит возвращается в обработку.
+        """
+        event = 'confirm_credited' if credited else 'confirm_not_credited'
+        previous = await self.db.resolve_manual_credit(deposit_id, credited, TRANSITIONS[event])
+        if previous is None:
+            logger.info(f"Депозит #{deposit_id}: событие {event} отклонено, зачисление не на ручной проверке")
+        return previous
+
+    @staticmethod
+    def expiry_transition():
+        """Переход депозита по истечении срока оплаты (для DepositExpiryScheduler)"""
+        return TRANSITIONS['expire']
+
+    @staticmethod
+    def credit_transitions():
+        """Переходы депозита по итогу зачисления (для DepositCreditWorker)"""
+        return {'done': TRANSITIONS['complete'], 'failed': TRANSITIONS['credit_failed']}
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class AdminFanout:
+    """Одновременная рассылка сообщений о депозите всем администраторам.
+
+    Отправки идут параллельно, но не больше concurrency сразу (общий
+    лимит на все депозиты). ID каждого доставленного сообщения
+    сохраняется в admin_messages, чтобы потом разом обновить сообщения
+    у остальных администраторов, когда один из них взял депозит.
+    """
+
+    def __init__(self, db, admins, concurrency):
+        self.db = db
+        self.admins = admins
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _limited(self, coroutine_factory, target):
+        async with self._semaphore:
+            return await coroutine_factory(target)
+
+    async def send(self, deposit_id, send_one, kind='text'):
+        """Отправка всем администраторам.
+
+        send_one(admin_id) - корутина, возвращающая Message; kind -
+        'text' или 'caption' (документ/фото с подписью), от него зависит
+        способ редактирования. Возвращает {admin_id: message_id}.
+        """
+        results = await asyncio.gather(
+            *(self._limited(send_one, admin_id) for admin_id in self.admins),
+            return_exceptions=True
+        )
+        delivered = {}
+        for admin_id, result in zip(self.admins, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось отправить депозит #{deposit_id} администратору {admin_id}: {result}")
+            else:
+                delivered[admin_id] = result.message_id
+
+        if delivered:
+            await self.db.add_admin_messages(
+                deposit_id, [(admin_id, message_id, kind) for admin_id, message_id in delivered.items()]
+            )
+        return delivered
+
+    async def edit_others(self, bot, deposit_id, except_admin_id, text):
+        """Заменить сообщения о депозите у всех администраторов, кроме except_admin_id.
+
+        Кнопки убираются, чтобы депозит не взяли повторно.
+        """
+        messages = [
+            (admin_id, message_id, kind)
+            for admin_id, message_id, kind in await self.db.get_admin_messages(deposit_id)
+            if admin_id != except_admin_id
+        ]
+
+        async def edit(message):
+            admin_id, message_id, kind = message
+            if kind == 'caption':
+                await bot.edit_message_caption(chat_id=admin_id, message_id=message_id, caption=text)
+            else:
+                await bot.edit_message_text(chat_id=admin_id, message_id=message_id, text=text)
+
+        results = await asyncio.gather(
+            *(self._limited(edit, message) for message in messages),
+            return_exceptions=True
+        )
+        for (admin_id, message_id, _), result in zip(messages, results):
+            if isinstance(result, BadRequest):
+                continue  # сообщение удалено или уже изменено
+            if isinstance(result, TelegramError):
+                logger.warning(f"Не удалось обновить сообщение {message_id} администратора {admin_id}: {result}")
+            elif isinstance(result, Exception):
+                logger.error(f"Ошибка обновления сообщения {message_id} администратора {admin_id}: {result}")
+        return len(messages)
@@ -1,22 +1,44 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from config import Config
 
+# Подписи кнопок меню (по ним же строится таблица маршрутов в bot.py)
+BTN_DEPOSIT = "💰 Пополнить счет"
+BTN_WITHDRAW = "💸 Вывести средства"
+BTN_MY_BALANCE = "📊 Мой баланс"
+BTN_MY_DEPOSITS = "📋 Мои депозиты"
+BTN_SUPPORT = "🆘 Поддержка"
+BTN_CONTACT_SUPPORT = "📞 Связаться с поддержкой"
+
+BTN_STATS = "📊 Статистика"
+BTN_PENDING_DEPOSITS = "⏳ Ожидающие депозиты"
+BTN_PROCESSING_DEPOSITS = "🔄 В обработке"
+BTN_CREDITING_DEPOSITS = "🏦 Зачисления"
+BTN_BROADCAST = "📢 Рассылка"
+BTN_CASHIER_BALANCE = "💼 Баланс кассы"
+BTN_SEARCH_PLAYER = "👥 Поиск игрока"
+BTN_CANCEL_BROADCAST = "❌ Отменить рассылку"
+
 def get_main_keyboard():
     """Основная клавиатура для пользователей"""
     return ReplyKeyboardMarkup([
-        [KeyboardButton("💰 Пополнить счет"), KeyboardButton("💸 Вывести средства")],
-        [KeyboardButton("📊 Мой баланс"), KeyboardButton("📋 Мои депозиты")],
-        [KeyboardButton("🆘 Поддержка"), KeyboardButton("📞 Связаться с поддержкой")]
+        [KeyboardButton(BTN_DEPOSIT), KeyboardButton(BTN_WITHDRAW)],
+        [KeyboardButton(BTN_MY_BALANCE), KeyboardButton(BTN_MY_DEPOSITS)],
+        [KeyboardButton(BTN_SUPPORT), KeyboardButton(BTN_CONTACT_SUPPORT)]
     ], resize_keyboard=True)
 
 def get_admin_keyboard():
     """Клавиатура для администратора"""
     return ReplyKeyboardMarkup([
-        [KeyboardButton("📊 Статистика"), KeyboardButton("⏳ Ожидающие депозиты")],
-        [KeyboardButton("🔄 В обработке"), KeyboardButton("📢 Рассылка")],
-        [KeyboardButton("💼 Баланс кассы"), KeyboardButton("👥 Поиск игрока")]
+        [KeyboardButton(BTN_STATS), KeyboardButton(BTN_PENDING_DEPOSITS)],
+        [KeyboardButton(BTN_PROCESSING_DEPOSITS), KeyboardButton(BTN_BROADCAST)],
+        [KeyboardButton(BTN_CASHIER_BALANCE), KeyboardButton(BTN_SEARCH_PLAYER)],
+        [KeyboardButton(BTN_CREDITING_DEPOSITS)]
     ], resize_keyboard=True)
 
+def get_broadcast_cancel_keyboard():
+    """Клавиатура ввода текста рассылки"""
+    return ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL_BROADCAST)]], resize_keyboard=True)
+
 def get_deposit_keyboard(deposit_id):
     """Клавиатура для депозита (админ)"""
     return InlineKeyboardMarkup([
@@ -30,6 +52,19 @@ def get_deposit_keyboard(deposit_id):
         ]
     ])
 
+def get_manual_credit_keyboard(deposit_id):
+    """Итог ручной проверки неясного зачисления (админ)"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Зачисление прошло", callback_data=f"credited_{deposit_id}"),
+            InlineKeyboardButton("↩️ Не прошло", callback_data=f"uncredited_{deposit_id}")
+        ],
+        [
+            InlineKeyboardButton("📞 Связаться", callback_data=f"contact_{deposit_id}"),
+            InlineKeyboardButton("👁 Просмотр", callback_data=f"view_{deposit_id}")
+        ]
+    ])
+
 def get_user_deposit_keyboard(deposit_id):
     """Клавиатура для пользователя после создания депозита"""
     return InlineKeyboardMarkup([
@@ -69,3 +104,21 @@ def get_support_keyboard():
         [InlineKeyboardButton("📞 Написать в поддержку", url=f"https://t.me/{Config.SUPPORT_USERNAME[1:]}")],
         [InlineKeyboardButton("📋 Частые вопросы", callback_data="faq")]
     ])
+
+def get_pagination_keyboard(view, first, last, has_prev, has_next, view_ids=()):
+    """Кнопки листания списка депозитов (курсор - created_at и id строки).
+
+    view_ids - депозиты, для которых нужны кнопки просмотра.
+    """
+    view_buttons = [
+        InlineKeyboardButton(f"👁 #{deposit_id}", callback_data=f"view_{deposit_id}") for deposit_id in view_ids
+    ]
+    rows = [view_buttons[i:i + 4] for i in range(0, len(view_buttons), 4)]
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"dp|{view}|p|{first[9]}|{first[0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"dp|{view}|n|{last[9]}|{last[0]}"))
+    if buttons:
+        rows.append(buttons)
+    return InlineKeyboardMarkup(rows) if rows else None
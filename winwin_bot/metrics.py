@@ -0,0 +1,264 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def percentile(values, p):
+    """Перцентиль p (от 0 до 1) выборки; 0.0 для пустой"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Счетчик с метками (значения меток передаются позиционно)"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с метками.
+
+    observe() только увеличивает счетчик корзины и сумму; накопительные
+    значения для Prometheus считаются при выдаче метрик.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счетчики корзин (+Inf последней), сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        names = self.labelnames + ('le',)
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Метрика, значение которой вычисляется только при выдаче.
+
+    func возвращает число или список ((значения меток), число).
+    """
+
+    def __init__(self, name, documentation, func, labelnames=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+            return []
+        if value is None:
+            return []
+        samples = value if isinstance(value, list) else [((), value)]
+        for labels, sample in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, func, labelnames=()):
+        return self._register(CallbackMetric(name, documentation, func, labelnames))
+
+    def counter_callback(self, name, documentation, func, labelnames=()):
+        return self._register(CallbackMetric(name, documentation, func, labelnames, kind='counter'))
+
+    def unregister(self, name):
+        self._metrics.pop(name, None)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'winwin_handler_seconds', 'Время выполнения обработчика обновления', ['handler']
+)
+API_SECONDS = REGISTRY.histogram(
+    'winwin_api_request_seconds', 'Время запроса к API SofiaCash', ['method', 'outcome']
+)
+DB_SECONDS = REGISTRY.histogram(
+    'winwin_db_query_seconds', 'Время выполнения метода Database', ['method', 'kind']
+)
+DB_BATCH_SECONDS = REGISTRY.histogram(
+    'winwin_db_batch_seconds', 'Время транзакции группового коммита'
+)
+TELEGRAM_SECONDS = REGISTRY.histogram(
+    'winwin_telegram_request_seconds', 'Время запроса к Telegram Bot API', ['method', 'outcome']
+)
+DEPOSIT_TRANSITIONS = REGISTRY.counter(
+    'winwin_deposit_transitions_total', 'Переходы статусов депозитов', ['from_status', 'to_status']
+)
+
+
+def instrument_handler(callback, name=None):
+    """Обертка обработчика PTB с замером времени выполнения"""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером времени запросов к Bot API по методам"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            outcome = str(code)
+            return code, payload
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, endpoint, outcome)
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics для Prometheus.
+
+    Метрики собираются только в момент запроса, так что без опросов
+    сервер ничего не стоит.
+    """
+
+    def __init__(self, registry, host, port):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик на {self.host}:{self.port}: {e}")
+            return
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                status, body, content_type = '404 Not Found', b'Not Found\n', 'text/plain'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import random
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PAYOUT_OUTCOMES = REGISTRY.counter(
+    'winwin_payout_outcomes_total', 'Исходы попыток выплат', ['outcome']
+)
+
+# Поля строки withdrawals
+W_ID, W_USER_ID, W_USERNAME, W_CODE, W_STATUS, W_AMOUNT, W_ATTEMPTS, W_UNCERTAIN = range(8)
+W_USER_MESSAGE_ID = 13
+
+
+class WithdrawalWorker:
+    """Выплаты по заявкам на вывод из очереди withdrawals.
+
+    Обработчик Telegram только записывает заявку; запрос
+    payout_from_user выполняет пул из PAYOUT_CONCURRENCY фоновых задач,
+    так что всплеск заявок не превращается во всплеск запросов к кассе.
+    Выплаты идут через gate.shared() кассы (CashdeskGate зачислений):
+    выплата меняет баланс кассы, и сверка зачислений не должна
+    пересекаться с ней.
+
+    Код выплаты одноразовый, поэтому после неясного исхода (таймаут, 5xx)
+    попытку можно повторить: повторная выплата по тому же коду касса не
+    выполнит. Но отказ после такой попытки может означать, что код уже
+    использован первой, - тогда заявка уходит на ручную проверку.
+
+    Игрок видит ход выплаты в сообщении заявки (on_progress), а
+    администраторы получают итоги раз в PAYOUT_DIGEST_INTERVAL одной
+    сводкой (on_digest).
+    """
+
+    def __init__(self, db, api, balance, gate, config, on_progress, on_digest):
+        self.db = db
+        self.api = api
+        self.balance = balance
+        self.gate = gate
+        self.config = config
+        self.on_progress = on_progress  # корутина (bot, withdrawal, status, result)
+        self.on_digest = on_digest  # корутина (bot, rows)
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._running = set()
+        self._bot = None
+
+    def start(self, bot):
+        if not self._tasks:
+            self._bot = bot
+            self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._digest_loop())]
+
+    async def stop(self):
+        # Прерванные выплаты останутся in_flight и будут повторены с пометкой uncertain
+        tasks = list(self._running) + self._tasks
+        self._tasks = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def arm(self):
+        """Сообщить о новой заявке в очереди"""
+        self._wakeup.set()
+
+    def get_stats(self):
+        return {'running': len(self._running), 'workers': self.config.PAYOUT_CONCURRENCY}
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            free = self.config.PAYOUT_CONCURRENCY - len(self._running)
+            if free <= 0:
+                await self._wakeup.wait()
+                continue
+
+            try:
+                for withdrawal in await self.db.claim_withdrawals(free, self.config.PAYOUT_LEASE):
+                    task = asyncio.create_task(self._process_safe(withdrawal))
+                    self._running.add(task)
+                    task.add_done_callback(self._on_done)
+                delay = await self.db.seconds_until_next_withdrawal()
+            except Exception as e:
+                logger.error(f"Ошибка очереди выплат: {e}")
+                delay = None
+
+            timeout = self.config.PAYOUT_POLL_INTERVAL
+            if delay is not None:
+                timeout = min(max(delay, 0), timeout)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, task):
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def _process_safe(self, withdrawal):
+        try:
+            await self._process(withdrawal)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Аренда истечет, и выплата будет взята снова
+            logger.error(f"Ошибка выплаты по заявке #{withdrawal[W_ID]}: {e}")
+
+    async def _process(self, withdrawal):
+        withdrawal_id, user_id, code = withdrawal[W_ID], withdrawal[W_USER_ID], withdrawal[W_CODE]
+        attempts = withdrawal[W_ATTEMPTS]
+        # Прошлая попытка могла пройти: прервана (in_flight) или с неясным исходом
+        uncertain = bool(withdrawal[W_UNCERTAIN]) or withdrawal[W_STATUS] in ('unknown', 'in_flight')
+
+        if attempts >= self.config.PAYOUT_MAX_ATTEMPTS:
+            await self._settle(withdrawal, 'manual' if uncertain else 'failed', {
+                'success': False, 'error': 'Исчерпаны попытки выплаты'
+            })
+            return
+
+        # Пока автомат кассы разомкнут, попытки не тратятся
+        retry_after = self.api.retry_after('payout')
+        if retry_after:
+            await self._retry(withdrawal, 'pending', 'SofiaCash временно недоступен', delay=retry_after)
+            return
+
+        await self._progress(withdrawal, 'in_flight', {})
+        async with self.gate.shared():
+            await self.db.record_withdrawal_attempt(withdrawal_id)
+            result = await self.api.payout_from_user(user_id, code)
+            finished_at = time.time()
+        self.balance.invalidate()
+
+        if result.get('success'):
+            amount = result.get('summa')
+            if amount is not None:
+                amount = abs(float(amount))
+            await self._settle(withdrawal, 'done', result, amount, finished_at)
+        elif result.get('ambiguous'):
+            await self._retry(withdrawal, 'unknown', result.get('error'), attempts + 1, finished_at)
+        elif result.get('retryable'):
+            await self._retry(withdrawal, 'pending', result.get('error'), attempts + 1, finished_at)
+        else:
+            # Отказ после неясной попытки: код мог быть использован ею
+            await self._settle(withdrawal, 'manual' if uncertain else 'failed', result, finished_at=finished_at)
+
+    def _backoff(self, attempts):
+        """Экспоненциальная задержка с разбросом (половина фиксирована, половина случайна)"""
+        delay = min(self.config.PAYOUT_BACKOFF_MAX, self.config.PAYOUT_BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _retry(self, withdrawal, status, error, attempts=None, finished_at=None, delay=None):
+        backoff = self._backoff(withdrawal[W_ATTEMPTS] if attempts is None else attempts)
+        delay = backoff if delay is None else max(delay, backoff)
+        PAYOUT_OUTCOMES.inc('retry_' + status)
+        logger.warning(f"Выплата по заявке #{withdrawal[W_ID]} будет повторена через {delay:.1f} с: {error}")
+        await self.db.reschedule_withdrawal(withdrawal[W_ID], status, delay, error, finished_at)
+        await self._progress(withdrawal, 'retry', {'error': error, 'delay': delay})
+        self.arm()
+
+    async def _settle(self, withdrawal, status, result, amount=None, finished_at=None):
+        PAYOUT_OUTCOMES.inc(status)
+        await self.db.settle_withdrawal(withdrawal[W_ID], status, amount, result.get('error'), finished_at)
+        await self._progress(withdrawal, status, dict(result, amount=amount))
+
+    async def _progress(self, withdrawal, status, result):
+        try:
+            await self.on_progress(self._bot, withdrawal, status, result)
+        except Exception as e:
+            logger.error(f"Ошибка уведомления о выплате по заявке #{withdrawal[W_ID]}: {e}")
+
+    async def _digest_loop(self):
+        """Сводка завершенных выплат администраторам раз в PAYOUT_DIGEST_INTERVAL.
+
+        Выплаты отмечаются только после отправки сводки: если она не ушла,
+        они попадут в следующую.
+        """
+        while True:
+            await asyncio.sleep(self.config.PAYOUT_DIGEST_INTERVAL)
+            try:
+                rows = await self.db.get_withdrawal_digest(self.config.PAYOUT_DIGEST_LIMIT)
+                if rows:
+                    await self.on_digest(self._bot, rows)
+                    await self.db.mark_withdrawals_notified([row[0] for row in rows])
+            except Exception as e:
+                logger.error(f"Ошибка сводки выплат: {e}")
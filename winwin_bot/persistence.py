@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data и состояний ConversationHandler в SQLite.
+
+    Изменения, которые Application передает раз в update_interval,
+    складываются в память (write-behind) и записываются на диск одной
+    транзакцией в flush(): периодически из run() и при остановке бота.
+    Данные, не изменившиеся с прошлой записи, повторно не пишутся.
+
+    При shared=True перед каждым обновлением user_data игрока
+    перечитывается из базы, если другой процесс записал более новую
+    версию. Состояния диалогов shared не покрывает: ConversationHandler
+    получает их из get_conversations один раз при запуске и дальше
+    хранит у себя, а BasePersistence не дает способа обновить их. Второй
+    процесс видит диалог игрока таким, каким тот был при его запуске,
+    поэтому при нескольких процессах обновления одного игрока должны
+    приходить в один и тот же процесс.
+    """
+
+    def __init__(self, db, flush_interval, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval
+        )
+        self.db = db
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._user_data = None  # user_id -> JSON последней записанной версии
+        self._versions = {}  # user_id -> версия строки в базе
+        self._conversations = {}  # name -> {key: state}
+        self._dirty_users = {}  # user_id -> JSON или None (удалить)
+        self._dirty_conversations = {}  # (name, key) -> JSON или None (удалить)
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    async def get_user_data(self):
+        rows = await self.db.get_persisted_user_data()
+        self._user_data = {user_id: data for user_id, data, _ in rows}
+        self._versions = {user_id: version for user_id, _, version in rows}
+        return {user_id: json.loads(data) for user_id, data, _ in rows}
+
+    async def update_user_data(self, user_id, data):
+        serialized = self._dumps(data)
+        if self._user_data.get(user_id) == serialized:
+            # Совпадает с записанным: писать нечего
+            self._dirty_users.pop(user_id, None)
+        else:
+            self._dirty_users[user_id] = serialized
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.shared or user_id in self._dirty_users:
+            return
+        row = await self.db.get_persisted_user_data_since(user_id, self._versions.get(user_id, 0))
+        if row is None:
+            return
+        data, version = row
+        user_data.clear()
+        user_data.update(json.loads(data))
+        self._user_data[user_id] = data
+        self._versions[user_id] = version
+
+    async def get_conversations(self, name):
+        rows = await self.db.get_persisted_conversations(name)
+        conversations = {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+        self._conversations[name] = dict(conversations)
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        states = self._conversations.setdefault(name, {})
+        if states.get(key) == new_state:
+            return
+        if new_state is None:
+            states.pop(key, None)
+        else:
+            states[key] = new_state
+        self._dirty_conversations[(name, key)] = None if new_state is None else self._dumps(new_state)
+
+    async def flush(self):
+        """Запись накопленных изменений в базу одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty_users and not self._dirty_conversations:
+                return
+            users, self._dirty_users = self._dirty_users, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                versions = await self.db.save_persistence(
+                    list(users.items()),
+                    [(name, self._dumps(list(key)), state) for (name, key), state in conversations.items()]
+                )
+            except Exception:
+                # Вернуть изменения в очередь, если их не перезаписали новые
+                self._dirty_users = {**users, **self._dirty_users}
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                raise
+
+            for user_id, data in users.items():
+                if data is None:
+                    self._user_data.pop(user_id, None)
+                    self._versions.pop(user_id, None)
+                else:
+                    self._user_data[user_id] = data
+                    self._versions[user_id] = versions[user_id]
+            logger.debug(f"Состояние сохранено: user_data {len(users)}, диалогов {len(conversations)}")
+
+    async def run(self):
+        """Периодическая запись накопленных изменений"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояния бота: {e}")
+
+    # bot_data, chat_data и callback_data не хранятся (store_data)
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
@@ -0,0 +1,56 @@
+import logging
+import time
+from collections import Counter
+
+from metrics import HANDLER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRouter:
+    """Маршрутизация текстовых сообщений по таблице.
+
+    Таблица (роль, подпись кнопки) -> обработчик строится один раз при
+    запуске, поэтому выбор обработчика - один поиск в словаре вместо
+    цепочки сравнений. Текст, не совпавший ни с одной кнопкой, уходит в
+    обработчик ожидаемого ввода по context.user_data['action']
+    (реквизиты, поиск игрока). Счетчики вызовов и время обработки
+    ведутся по имени маршрута.
+    """
+
+    def __init__(self, get_role):
+        self.get_role = get_role  # user_id -> роль ('admin', 'user')
+        self._buttons = {}  # (роль, текст) -> (имя, обработчик)
+        self._actions = {}  # (роль, action) -> (имя, обработчик)
+        self.counters = Counter()
+
+    def add_button(self, role, label, handler, name=None):
+        self._buttons[(role, label)] = (name or handler.__name__, handler)
+
+    def add_action(self, role, action, handler, name=None):
+        self._actions[(role, action)] = (name or handler.__name__, handler)
+
+    def resolve(self, user_id, text, action=None):
+        """Маршрут для сообщения: (имя, обработчик) или None"""
+        role = self.get_role(user_id)
+        route = self._buttons.get((role, text))
+        if route is None and action is not None:
+            route = self._actions.get((role, action))
+        return route
+
+    async def dispatch(self, update, context):
+        route = self.resolve(update.effective_user.id, update.message.text, context.user_data.get('action'))
+        if route is None:
+            self.counters['unmatched'] += 1
+            return None
+        name, handler = route
+        self.counters[name] += 1
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    def get_stats(self):
+        """Количество вызовов по маршрутам"""
+        return dict(self.counters)
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DepositExpiryScheduler:
+    """Один таймер на все сроки оплаты депозитов.
+
+    Сроки хранятся в deposits.expires_at (индекс по status, expires_at).
+    Планировщик спит до ближайшего срока, отменяет просроченные депозиты
+    порциями переходом transition (событие expire DepositStateMachine)
+    и снова засыпает. Сроки читаются из базы, поэтому после
+    перезапуска ничего восстанавливать не нужно, а стоимость таймера не
+    зависит от количества открытых депозитов.
+    """
+
+    def __init__(self, db, transition, on_expired, batch_size, max_sleep):
+        self.db = db
+        self.from_statuses, self.to_status = transition  # (из статусов, в статус)
+        self.on_expired = on_expired
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, bot):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def arm(self):
+        """Сообщить о новом сроке: он может быть раньше текущего ожидания"""
+        self._wakeup.set()
+
+    async def _run(self, bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                expired = await self.db.expire_due_deposits(self.batch_size, self.from_statuses, self.to_status)
+                if expired:
+                    logger.info(f"Отменено просроченных депозитов: {len(expired)}")
+                    await self.on_expired(bot, expired)
+                    if len(expired) == self.batch_size:
+                        continue
+
+                delay = await self.db.seconds_until_next_expiry(self.from_statuses)
+            except Exception as e:
+                logger.error(f"Ошибка планировщика сроков оплаты: {e}")
+                delay = None
+
+            # Периодическая проверка на случай сроков, добавленных другим процессом
+            timeout = self.max_sleep if delay is None else min(max(delay, 0), self.max_sleep)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,94 @@
+import hashlib
+
+_sha256 = hashlib.sha256
+_md5 = hashlib.md5
+
+
+class SofiaCashSigner:
+    """Подпись запросов SofiaCash с заранее подготовленными константами.
+    
+    Каждая подпись = sha256(sha256(A) + md5(B)), где строки A и B состоят
+    из постоянных фрагментов (hash, cashierpass, cashdeskid) и параметров
+    запроса. Постоянные фрагменты кодируются один раз при создании, а
+    ведущий фрагмент A (в нем 64-символьный hash) сразу скармливается
+    sha256, так что на каждый запрос остается только copy() и хвост.
+    """
+    
+    def __init__(self, api_hash, cashierpass, cashdeskid):
+        h = f"{api_hash}".encode()
+        p = f"{cashierpass}".encode()
+        c = f"{cashdeskid}".encode()
+        
+        # balance: A = hash=..&cashierpass=..&dt={dt}, B = dt={dt}&cashierpass=..&cashdeskid=..
+        self._balance_a = _sha256(b"hash=" + h + b"&cashierpass=" + p + b"&dt=")
+        self._balance_b = b"&cashierpass=" + p + b"&cashdeskid=" + c
+        
+        # find_user: A = hash=..&userid={id}&cashdeskid=.., B = userid={id}&cashierpass=..&hash=..
+        self._find_user_a = _sha256(b"hash=" + h + b"&userid=")
+        self._find_user_a_tail = b"&cashdeskid=" + c
+        self._find_user_b = b"&cashierpass=" + p + b"&hash=" + h
+        
+        # deposit/payout: A = hash=..&lng={lng}&UserId={id}, B = summa|code={v}&cashierpass=..&cashdeskid=..
+        self._operation_a = _sha256(b"hash=" + h + b"&lng=")
+        self._operation_b = b"&cashierpass=" + p + b"&cashdeskid=" + c
+        
+        self._confirm_suffix = b":" + h
+        
+        # Таблица рецептов подписи по имени метода API
+        self._recipes = {
+            "balance": self._sign_balance,
+            "find_user": self._sign_find_user,
+            "deposit": self._sign_deposit,
+            "payout": self._sign_payout,
+        }
+        
+        self.cashdesk_confirm = self.confirm(cashdeskid)
+    
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.API_HASH, config.API_CASHIERPASS, config.API_CASHDESKID)
+    
+    def _sign_balance(self, dt=None, **_):
+        dt = f"{dt}".encode()
+        sha_a = self._balance_a.copy()
+        sha_a.update(dt)
+        hash_b = _md5(b"dt=" + dt + self._balance_b).hexdigest()
+        return _sha256((sha_a.hexdigest() + hash_b).encode()).hexdigest()
+    
+    def _sign_find_user(self, user_id=None, **_):
+        user_id = f"{user_id}".encode()
+        sha_a = self._find_user_a.copy()
+        sha_a.update(user_id + self._find_user_a_tail)
+        hash_b = _md5(b"userid=" + user_id + self._find_user_b).hexdigest()
+        return _sha256((sha_a.hexdigest() + hash_b).encode()).hexdigest()
+    
+    def _sign_operation(self, user_id, lng, field, value):
+        sha_a = self._operation_a.copy()
+        sha_a.update(f"{lng}&UserId={user_id}".encode())
+        hash_b = _md5(field + f"{value}".encode() + self._operation_b).hexdigest()
+        return _sha256((sha_a.hexdigest() + hash_b).encode()).hexdigest()
+    
+    def _sign_deposit(self, user_id=None, amount=None, lng="ru", **_):
+        return self._sign_operation(user_id, lng, b"summa=", amount)
+    
+    def _sign_payout(self, user_id=None, code=None, lng="ru", **_):
+        return self._sign_operation(user_id, lng, b"code=", code)
+    
+    def confirm(self, param_value):
+        """Расчет confirm строки: md5("<значение>:<hash>")"""
+        return _md5(f"{param_value}".encode() + self._confirm_suffix).hexdigest()
+    
+    def _recipe(self, method):
+        try:
+            return self._recipes[method]
+        except KeyError:
+            raise ValueError(f"Неизвестный метод подписи: {method}")
+    
+    def sign(self, method, **params):
+        """Подпись одного запроса"""
+        return self._recipe(method)(**params)
+    
+    def sign_many(self, requests):
+        """Подпись пачки запросов: [(method, params), ...] -> [sign, ...]"""
+        recipe = self._recipe
+        return [recipe(method)(**params) for method, params in requests]
@@ -0,0 +1,62 @@
+import logging
+import secrets
+import time
+from contextlib import asynccontextmanager
+
+from metrics import REGISTRY, percentile
+
+logger = logging.getLogger(__name__)
+
+DEPOSIT_STAGE_SECONDS = REGISTRY.histogram(
+    'winwin_deposit_stage_seconds', 'Длительность этапов обработки депозита', ['stage'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+
+def new_trace_id():
+    """Идентификатор трассировки депозита"""
+    return secrets.token_hex(8)
+
+
+class DepositTracer:
+    """Замер этапов обработки депозита.
+
+    Каждый этап пишется в deposit_spans как (начало, длительность,
+    успех) без ожидания коммита, поэтому трассировка не добавляет
+    задержки обработчикам. По спанам восстанавливается хронология
+    депозита, а промежутки между ними - это ожидание админа или игрока.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def record(self, deposit_id, stage, started_at, duration, ok=True):
+        """Запись готового спана (started_at - time.time(), duration - секунды)"""
+        DEPOSIT_STAGE_SECONDS.observe(duration, stage)
+        logger.debug(f"Депозит #{deposit_id}: {stage} {duration * 1000:.0f} мс{'' if ok else ' (ошибка)'}")
+        try:
+            await self.db.add_deposit_span(deposit_id, stage, started_at, duration * 1000, ok)
+        except Exception as e:
+            logger.error(f"Не удалось записать этап {stage} депозита #{deposit_id}: {e}")
+
+    @asynccontextmanager
+    async def span(self, deposit_id, stage):
+        """Замер этапа: async with tracer.span(deposit_id, 'stage'): ..."""
+        started_at = time.time()
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            await self.record(deposit_id, stage, started_at, time.perf_counter() - started, ok)
+
+    async def get_stage_stats(self, deposits):
+        """p50/p95 длительности этапов по последним deposits депозитам, мс"""
+        durations = {}
+        for stage, duration_ms in await self.db.get_recent_span_durations(deposits):
+            durations.setdefault(stage, []).append(duration_ms)
+        return {
+            stage: (len(values), percentile(values, 0.5), percentile(values, 0.95))
+            for stage, values in durations.items()
+        }
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import nullcontext
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import percentile
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для одного пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно, не
+    более workers штук сразу. Обновления одного пользователя (или чата,
+    если пользователя нет) ждут друг друга в порядке поступления, поэтому
+    диалоги и переходы статусов депозита не перемешиваются.
+
+    Порядок держится на замке пользователя, а лимит воркеров берется уже
+    после него: очередь сообщений одного пользователя ждет на своем
+    замке и не занимает воркеров, нужных остальным. max_pending -
+    сколько обновлений может одновременно находиться в обработке и
+    ожидании, сверх этого Application ждет освобождения места.
+    """
+
+    def __init__(self, workers, max_pending, latency_window=1000):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.workers = workers
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._locks = {}  # ключ -> [asyncio.Lock, количество обновлений в очереди]
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self._wait_times = deque(maxlen=latency_window)
+        self._handle_times = deque(maxlen=latency_window)
+
+    @staticmethod
+    def _key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return 'user', user.id
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None:
+            return 'chat', chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        lock = None
+        if key is not None:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            lock = entry[0]
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        running = False
+        try:
+            async with lock or nullcontext(), self._worker_slots:
+                self.waiting -= 1
+                running = True
+                started = time.perf_counter()
+                self._wait_times.append(started - queued_at)
+                self.active += 1
+                try:
+                    await coroutine
+                finally:
+                    self.active -= 1
+                    self.processed += 1
+                    self._handle_times.append(time.perf_counter() - started)
+        finally:
+            if not running:
+                self.waiting -= 1
+            if key is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_stats(self):
+        """Очередь и задержки обработки (по последним обновлениям, в мс)"""
+        wait_times = list(self._wait_times)
+        handle_times = list(self._handle_times)
+        return {
+            'waiting': self.waiting,
+            'active': self.active,
+            'workers': self.workers,
+            'users_in_flight': len(self._locks),
+            'processed': self.processed,
+            'wait_p50': percentile(wait_times, 0.5) * 1000,
+            'wait_p95': percentile(wait_times, 0.95) * 1000,
+            'handle_p50': percentile(handle_times, 0.5) * 1000,
+            'handle_p95': percentile(handle_times, 0.95) * 1000,
+            'handle_max': max(handle_times, default=0.0) * 1000
+        }